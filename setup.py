@@ -9,11 +9,16 @@ setup(
     author='Björn Busse',
     author_email='bj.rn@baerlin.eu',
     license='BSD-3-Clause',
-    py_modules=['webdriver_util'],
+    py_modules=['webdriver_util', 'webdriver_async', 'webdriver_bench'],
     install_requires=[
         'configargparse>=1.7.1',
         'selenium>=4.36.0',
     ],
+    extras_require={
+        'cache': ['cryptography'],
+        'images': ['Pillow', 'numpy'],
+        'yaml': ['PyYAML'],
+    },
     entry_points={
         'console_scripts': [
             'webdriver-util=webdriver_util:main',
@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+#
+# webdriver-util asyncio API
+#
+# Speaks the W3C WebDriver protocol to geckodriver over pooled
+# keep-alive connections, so one event loop can drive many sessions
+#
+# Copyright (c) 2020 Björn Busse <bj.rn@baerlin.eu>
+#
+
+import asyncio
+import base64
+import json
+import logging
+import socket
+import time
+
+import webdriver_util
+from webdriver_util import metrics
+
+
+# Key of element references in WebDriver responses
+w3c_element_key = "element-6066-11e4-a52e-4f735466cecf"
+
+
+class WebDriverError(Exception):
+
+    def __init__(self, error, message=""):
+        super().__init__(error + ": " + message)
+        self.error = error
+        self.message = message
+
+
+# A bounded pool of keep-alive HTTP/1.1 connections to one host
+# exchanging JSON bodies
+class AsyncHTTPPool:
+
+    def __init__(self, host, port, size=4):
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+
+    async def connect(self):
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def roundtrip(self, conn, method, path, body):
+        reader, writer = conn
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        head = (method + " " + path + " HTTP/1.1\r\n"
+                + "Host: " + self.host + ":" + str(self.port) + "\r\n"
+                + "Content-Type: application/json; charset=utf-8\r\n"
+                + "Content-Length: " + str(len(payload)) + "\r\n"
+                + "Connection: keep-alive\r\n\r\n")
+        writer.write(head.encode("ascii") + payload)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by " + self.host)
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = line.decode("latin-1").partition(":")
+            headers[k.strip().lower()] = v.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            data = b""
+            while True:
+                n = int((await reader.readline()).split(b";")[0], 16)
+                chunk = await reader.readexactly(n + 2)
+                if n == 0:
+                    break
+                data += chunk[:-2]
+        else:
+            data = await reader.readexactly(int(headers.get("content-length", 0)))
+
+        keep = headers.get("connection", "").lower() != "close"
+
+        return status, json.loads(data) if data else None, keep
+
+    # Send a request, retrying once on a fresh connection
+    # when a reused one was closed by the server
+    async def request(self, method, path, body=None):
+        async with self.slots:
+            reused = bool(self.idle)
+            conn = self.idle.pop() if reused else await self.connect()
+            try:
+                status, data, keep = await self.roundtrip(conn, method, path, body)
+            except (OSError, asyncio.IncompleteReadError):
+                conn[1].close()
+                if not reused:
+                    raise
+                conn = await self.connect()
+                status, data, keep = await self.roundtrip(conn, method, path, body)
+
+            if keep:
+                self.idle.append(conn)
+            else:
+                conn[1].close()
+
+        return status, data
+
+    async def close(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            writer.close()
+
+
+# Selenium locator strategies in W3C terms
+def w3c_locator(by, value):
+    if by == "id":
+        return "css selector", '[id="' + value + '"]'
+    elif by == "name":
+        return "css selector", '[name="' + value + '"]'
+
+    return by, value
+
+
+# A WebDriver session spoken to over an AsyncHTTPPool
+class AsyncWebDriver:
+
+    def __init__(self, http, session_id=None):
+        self.http = http
+        self.session_id = session_id
+
+    async def command(self, method, path, body=None):
+        status, data = await self.http.request(
+            method, "/session/" + self.session_id + path, body)
+        value = data.get("value") if data else None
+        if status >= 400:
+            value = value or {}
+            raise WebDriverError(value.get("error", str(status)),
+                                 value.get("message", ""))
+
+        return value
+
+    async def start(self, capabilities):
+        status, data = await self.http.request(
+            "POST", "/session", {"capabilities": {"alwaysMatch": capabilities}})
+        value = data.get("value") if data else {}
+        if status >= 400:
+            raise WebDriverError(value.get("error", str(status)),
+                                 value.get("message", ""))
+        self.session_id = value["sessionId"]
+
+        return self.session_id
+
+    async def quit(self):
+        await self.command("DELETE", "")
+
+    async def get(self, url):
+        await self.command("POST", "/url", {"url": url})
+
+    async def current_url(self):
+        return await self.command("GET", "/url")
+
+    async def find_elements(self, by, value):
+        using, value = w3c_locator(by, value)
+        elements = await self.command("POST", "/elements",
+                                      {"using": using, "value": value})
+        return [e[w3c_element_key] for e in elements]
+
+    async def find_element(self, by, value):
+        using, value = w3c_locator(by, value)
+        e = await self.command("POST", "/element",
+                               {"using": using, "value": value})
+        return e[w3c_element_key]
+
+    async def element_clear(self, element):
+        await self.command("POST", "/element/" + element + "/clear", {})
+
+    async def element_send_keys(self, element, text):
+        await self.command("POST", "/element/" + element + "/value",
+                           {"text": text})
+
+    async def element_click(self, element):
+        await self.command("POST", "/element/" + element + "/click", {})
+
+    async def execute_script(self, script, *args):
+        return await self.command("POST", "/execute/sync",
+                                  {"script": script, "args": list(args)})
+
+    async def window_handle(self):
+        return await self.command("GET", "/window")
+
+    async def window_handles(self):
+        return await self.command("GET", "/window/handles")
+
+    async def switch_to_window(self, handle):
+        await self.command("POST", "/window", {"handle": handle})
+
+    async def new_window(self, kind="tab"):
+        value = await self.command("POST", "/window/new", {"type": kind})
+        await self.switch_to_window(value["handle"])
+
+        return value["handle"]
+
+    async def close_window(self):
+        return await self.command("DELETE", "/window")
+
+    async def delete_all_cookies(self):
+        await self.command("DELETE", "/cookie")
+
+    async def get_screenshot_as_png(self):
+        return base64.b64decode(await self.command("GET", "/screenshot"))
+
+
+# Readiness conditions, awaited with the driver
+async def async_ready_document(driver):
+    state = await driver.execute_script("return document.readyState")
+
+    return state == "complete"
+
+
+def async_ready_url(predicate):
+    async def condition(driver):
+        return predicate(await driver.current_url())
+
+    return condition
+
+
+def async_readiness_login(target, url):
+    t = webdriver_util.targets.get(target)
+    if t is not None and t["validate"] is not None:
+        return async_ready_url(lambda current_url:
+                               webdriver_util.web_validate_login(target,
+                                                                 current_url,
+                                                                 url))
+
+    return async_ready_document
+
+
+async def async_wait_until(driver, condition, timeout_s, poll_s=0.1,
+                           what="page"):
+    t0 = time.monotonic()
+    ready = False
+
+    while True:
+        try:
+            ready = await condition(driver)
+        except WebDriverError as e:
+            logging.debug("browser: Readiness check failed: " + str(e))
+        if ready or time.monotonic() - t0 >= timeout_s:
+            break
+        await asyncio.sleep(poll_s)
+
+    t_ms = int(round((time.monotonic() - t0) * 1000))
+    if ready:
+        logging.info("browser: " + what + " ready after " + str(t_ms) + " ms")
+    else:
+        logging.warning("browser: " + what + " not ready after "
+                        + str(t_ms) + " ms, giving up")
+
+    return ready
+
+
+# See webdriver_util.find_element_chain
+async def async_find_element_chain(driver, chain, target, field):
+    for locator in chain:
+        with metrics.span("login_locator", target=target, field=field,
+                          method=locator[0]):
+            elements = await driver.find_elements(*locator)
+        if elements:
+            if locator != chain[0]:
+                logging.info("locators: " + target + " " + field + " found by "
+                             + locator[0] + " " + locator[1])
+                metrics.inc("locator_fallbacks", target=target, field=field)
+            return elements[0], locator
+
+    raise WebDriverError("no such element",
+                         "No locator found the " + field + " element")
+
+
+# Log into web-app, see webdriver_util.web_login
+async def async_web_login(driver, browser_options, login, html_login):
+    try:
+        locators = webdriver_util.target_login_locators(login['target'],
+                                                        html_login)
+    except ValueError as e:
+        logging.error(str(e))
+        return False
+
+    fill = browser_options.get('login_fill', "keys")
+    t = webdriver_util.targets.get(login['target'])
+    if t is not None and t["fill"] is not None:
+        fill = t["fill"]
+
+    cache = browser_options.get('locator_cache')
+    found = {}
+
+    try:
+        logging.info("Opening " + login['url'] + " with browser")
+        with metrics.span("login_page", target=login['target']):
+            await driver.get(login['url'])
+
+        if cache is not None:
+            version = webdriver_util.app_version(
+                await driver.execute_script(webdriver_util.js_app_assets))
+            locators = cache.order(locators, login['target'], login['url'], version)
+
+        if fill == "fast":
+            with metrics.span("login_fast_fill", target=login['target']):
+                try:
+                    result = await driver.execute_script(
+                        webdriver_util.js_fast_fill,
+                        {k: [list(l) for l in v] for k, v in locators.items()},
+                        {"user": login['user'], "pw": login['pw']})
+                except WebDriverError as e:
+                    logging.warning("Fast login form fill failed on " + login['url']
+                                    + ", typing instead: " + str(e).strip())
+                    result = None
+            if str(result).startswith("ok:"):
+                if cache is not None:
+                    cache.store(login['target'], login['url'], version,
+                                {k: locators[k][i]
+                                 for k, i in json.loads(result[3:]).items()})
+                logging.info("Trying to log into " + login['url'])
+                return True
+            logging.debug("Fast login form fill failed: " + str(result))
+
+        for field in ("user", "pw"):
+            with metrics.span("login_find_element", target=login['target'],
+                              field=field):
+                e, found[field] = await async_find_element_chain(
+                    driver, locators[field], login['target'], field)
+            await driver.element_clear(e)
+            await driver.element_send_keys(e, login[field])
+
+        with metrics.span("login_find_element", target=login['target'],
+                          field="submit"):
+            e, found['submit'] = await async_find_element_chain(
+                driver, locators['submit'], login['target'], "submit")
+        if cache is not None:
+            cache.store(login['target'], login['url'], version, found)
+        logging.info("Trying to log into " + login['url'])
+        with metrics.span("login_submit", target=login['target']):
+            await driver.element_click(e)
+    except WebDriverError as e:
+        logging.error("Failed to fill login form on " + login['url']
+                      + ": " + str(e))
+        return False
+
+    return True
+
+
+async def async_web_logout(driver, target, url):
+    if target not in webdriver_util.targets or target == "unknown":
+        return False
+
+    await driver.get(url + webdriver_util.targets[target]["logout"])
+
+    return True
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# W3C capabilities for the browser options of webdriver_util
+def async_capabilities(browser_options):
+    firefox_options = {"args": [], "prefs": {}}
+    if browser_options.get('headless'):
+        firefox_options["args"].append("-headless")
+    firefox_options["prefs"].update(browser_options.get('prefs') or {})
+    window_size = browser_options.get('window_size')
+    if window_size and browser_options.get('headless'):
+        firefox_options["args"] += ["--width=" + str(window_size[0]),
+                                    "--height=" + str(window_size[1])]
+    if browser_options.get('drm'):
+        firefox_options["prefs"]["media.gmp-manager.updateEnabled"] = True
+        firefox_options["prefs"]["media.eme.enabled"] = True
+    if browser_options.get('firefox_binary'):
+        firefox_options["binary"] = browser_options['firefox_binary']
+
+    capabilities = {
+        "browserName": "firefox",
+        "moz:firefoxOptions": firefox_options
+    }
+    if browser_options.get('page_load_strategy'):
+        capabilities["pageLoadStrategy"] = browser_options['page_load_strategy']
+
+    return capabilities
+
+
+# Start geckodriver and wait until it accepts sessions
+async def async_geckodriver_start(browser_options, timeout_s=30):
+    path = (browser_options.get('geckodriver_path')
+            or webdriver_util.which('geckodriver'))
+    if path is None:
+        raise FileNotFoundError("Could not find geckodriver")
+
+    port = free_port()
+    process = await asyncio.create_subprocess_exec(
+        path, "--port", str(port),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL)
+
+    http = AsyncHTTPPool("127.0.0.1", port)
+    t0 = time.monotonic()
+    while True:
+        try:
+            status, data = await http.request("GET", "/status")
+            if status == 200 and data["value"].get("ready"):
+                break
+        except OSError:
+            pass
+        if time.monotonic() - t0 >= timeout_s:
+            process.kill()
+            raise TimeoutError("geckodriver did not start within "
+                               + str(timeout_s) + " s")
+        await asyncio.sleep(0.05)
+
+    return process, http
+
+
+# asyncio counterpart of webdriver_util.Browser
+# Either starts geckodriver itself or uses a WebDriver server at url
+class AsyncBrowser:
+
+    def __init__(self, browser_options, driver, process=None):
+        self.browser_options = browser_options
+        self.driver = driver
+        self.process = process
+
+    async def login(self, login, html_login, ready=None):
+        if not await async_web_login(self.driver, self.browser_options,
+                                     login, html_login):
+            metrics.inc("logins", target=login['target'], result="failed")
+            return False
+
+        if ready is None:
+            ready = async_readiness_login(login['target'], login['url'])
+        with metrics.span("login_validate", target=login['target']):
+            await async_wait_until(self.driver, ready,
+                                   self.browser_options.get('ready_timeout', 30),
+                                   what="login")
+            ok = webdriver_util.web_validate_login(login['target'],
+                                                   await self.driver.current_url(),
+                                                   login['url'])
+
+        metrics.inc("logins", target=login['target'],
+                    result="ok" if ok else "failed")
+
+        return ok
+
+    async def logout(self, target, url):
+        return await async_web_logout(self.driver, target, url)
+
+    async def get_url(self, url):
+        logging.debug("browser: Requesting " + url)
+        await self.driver.get(url)
+
+        return True
+
+    async def open_tab_with_url(self, url):
+        await self.driver.new_window('tab')
+        await self.get_url(url)
+
+        return True
+
+    # Capture screenshots every t_wait_s seconds into pipeline,
+    # see webdriver_util.Browser.screenshot
+    async def screenshot(self, img_path, t_wait_s, pipeline=None,
+                         max_frames=None, report_s=10, schedule=None,
+                         activity="frames", diff_threshold=8):
+        if pipeline is None:
+            pipeline = webdriver_util.ScreenshotPipeline(img_path)
+
+        n = 0
+        t_next = time.monotonic()
+        t_report = t_next
+        diff = None
+        if schedule is not None and activity == "frames":
+            diff = webdriver_util.FrameDiff(threshold=diff_threshold)
+
+        while max_frames is None or n < max_frames:
+            t0 = time.monotonic()
+            with metrics.span("screenshot_capture"):
+                png = await self.driver.get_screenshot_as_png()
+            pipeline.stats_add("capture_ms", (time.monotonic() - t0) * 1000)
+            pipeline.submit(n, png)
+            n += 1
+
+            # See webdriver_util.page_changed
+            if schedule is not None:
+                if activity == "mutations":
+                    changed = int(await self.driver.execute_script(
+                        webdriver_util.js_mutations) or 0) > 0
+                else:
+                    changed = bool(diff.compare(png))
+                schedule.observe(changed)
+                t_wait_s = schedule.next_s()
+
+            t_next += t_wait_s
+            now = time.monotonic()
+            if t_wait_s > 0 and t_next <= now:
+                missed = int((now - t_next) / t_wait_s) + 1
+                pipeline.stats_add("dropped", missed)
+                t_next += missed * t_wait_s
+
+            if now - t_report >= report_s:
+                pipeline.report(now - t_report)
+                t_report = now
+
+            await asyncio.sleep(max(t_next - now, 0))
+
+        await asyncio.get_running_loop().run_in_executor(None, pipeline.close)
+
+        return True
+
+    # Show every tab for dwell_s seconds in turn until stop is set
+    async def rotate_tabs(self, dwell_s, stop=None):
+        stop = stop or asyncio.Event()
+        t_next = time.monotonic()
+
+        while not stop.is_set():
+            handles = await self.driver.window_handles()
+            current = await self.driver.window_handle()
+            if len(handles) > 1:
+                k = handles.index(current) if current in handles else -1
+                with metrics.span("tab_switch"):
+                    await self.driver.switch_to_window(
+                        handles[(k + 1) % len(handles)])
+
+            t_next = max(t_next + dwell_s, time.monotonic())
+            try:
+                await asyncio.wait_for(stop.wait(), t_next - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
+
+        return True
+
+    async def close(self):
+        try:
+            await self.driver.quit()
+        except (WebDriverError, OSError) as e:
+            logging.debug("browser: Failed to end session: " + str(e))
+        await self.driver.http.close()
+        if self.process is not None:
+            self.process.terminate()
+            await self.process.wait()
+
+        return True
+
+
+# Start a session, on the WebDriver server at url if given,
+# otherwise on a geckodriver started for it
+async def async_browser_start(browser_options, url=None):
+    process = None
+    if url is None:
+        process, http = await async_geckodriver_start(browser_options)
+    else:
+        host, _, port = url.split("://", 1)[-1].rstrip("/").partition(":")
+        http = AsyncHTTPPool(host, int(port or 80))
+
+    driver = AsyncWebDriver(http)
+    try:
+        with metrics.span("browser_setup"):
+            await driver.start(async_capabilities(browser_options))
+    except BaseException:
+        if process is not None:
+            process.kill()
+        raise
+
+    if browser_options.get('fullscreen'):
+        await driver.command("POST", "/window/fullscreen", {})
+
+    return AsyncBrowser(browser_options, driver, process)
+
+
+# Log into every job concurrently, one session per job
+# Returns whether each login validated
+async def async_login_all(browser_options, jobs, html_login, url=None):
+    async def run(job):
+        browser = await async_browser_start(browser_options, url)
+        try:
+            return await browser.login(job, html_login)
+        finally:
+            await browser.close()
+
+    return await asyncio.gather(*(run(job) for job in jobs))
@@ -0,0 +1,1245 @@
+#!/usr/bin/env python3
+#
+# webdriver-util benchmarks
+#
+# Measures webdriver_util against a local stand-in web-app,
+# driving either Firefox or an in-process fake WebDriver
+#
+# Copyright (c) 2020 Björn Busse <bj.rn@baerlin.eu>
+#
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+import asyncio
+import base64
+import http.client
+import itertools
+import json
+import logging
+import os
+import re
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode, urljoin, urlsplit
+import zlib
+
+from selenium.common.exceptions import NoSuchElementException
+
+import webdriver_async
+import webdriver_util
+
+
+# The grafana5 submit button is located by its absolute xpath
+grafana5_form_html = """<!DOCTYPE html>
+<html>
+<head><title>Grafana</title></head>
+<body><grafana-app><div><div><div><div><div>
+<div></div>
+<div><div>
+<form method="post" action="/grafana/login">
+<div><input type="text" name="username"></div>
+<div><input type="password" id="inputPassword" name="password"></div>
+<div><button type="submit">Log In</button></div>
+</form>
+</div></div>
+</div></div></div></div></div></grafana-app></body>
+</html>
+"""
+
+roundcube_form_html = """<!DOCTYPE html>
+<html>
+<head><title>Roundcube</title></head>
+<body>
+<form method="post" action="/roundcube/?_task=login">
+<input type="hidden" name="_token" value="bench-token">
+<input type="text" id="rcmloginuser" name="_user">
+<input type="password" id="rcmloginpwd" name="_pass">
+<button type="submit" id="rcmloginsubmit">Login</button>
+</form>
+</body>
+</html>
+"""
+
+spotify_form_html = """<!DOCTYPE html>
+<html>
+<head><title>Spotify</title></head>
+<body>
+<form method="post" action="/spotify/login">
+<input type="text" name="username">
+<input type="password" name="password">
+<button type="submit" id="login-button">Log In</button>
+</form>
+</body>
+</html>
+"""
+
+login_form_html = """<!DOCTYPE html>
+<html>
+<head><title>Login</title></head>
+<body>
+<form method="post" action="/form/login">
+<input type="text" id="user" name="user">
+<input type="password" id="pw" name="pw">
+<button type="submit" id="submit">Log in</button>
+</form>
+</body>
+</html>
+"""
+
+page_html = """<!DOCTYPE html>
+<html>
+<head><title>{title}</title></head>
+<body><h1>{title}</h1></body>
+</html>
+"""
+
+# Login pages by path, with the page the form post redirects to
+login_forms = {
+    "/grafana/":   (grafana5_form_html, "/grafana/?orgId=1"),
+    "/roundcube/": (roundcube_form_html, "/roundcube/?_task=mail"),
+    "/spotify/":   (spotify_form_html, "/spotify/en/status"),
+    "/form/login": (login_form_html, "/form/?orgId=1")
+}
+
+login_html = {
+    "selector_user":          "id",
+    "selector_pw":            "id",
+    "selector_submit":        "id",
+    "selector_value_user":    "user",
+    "selector_value_pw":      "pw",
+    "selector_value_submit":  "submit"
+}
+
+# Login paths whose pages need the session cookie set by the login post
+# and whose forms carry a hidden token that must be posted back
+session_paths = {
+    "/roundcube/": ("roundcube_sessid", "_token=bench-token")
+}
+
+# Targets logged into by the web_login benchmark and their login paths
+bench_targets = {
+    "grafana5":  "/grafana/",
+    "roundcube": "/roundcube/",
+    "spotify":   "/spotify/"
+}
+
+
+# Serves the login forms, redirects their posts to the pages
+# web_validate_login expects and anything else as a plain page
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        cookie, _ = session_paths.get(url.path, (None, None))
+        logged_in = cookie and (cookie + "=") in self.headers.get("Cookie", "")
+        if url.path in login_forms and not url.query and logged_in:
+            self.reply(302, headers={"Location": login_forms[url.path][1]})
+        elif url.path in login_forms and not url.query:
+            self.reply(200, login_forms[url.path][0].encode("utf-8"))
+        elif cookie and not logged_in:
+            self.reply(302, headers={"Location": url.path})
+        else:
+            self.reply(200, page_html.format(title=url.path).encode("utf-8"))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        for path, (html, redirect) in login_forms.items():
+            if ('action="' + self.path + '"') not in html:
+                continue
+            headers = {"Location": redirect}
+            if path in session_paths:
+                cookie, token = session_paths[path]
+                if token not in body.decode("utf-8"):
+                    self.reply(403)
+                    return
+                headers["Set-Cookie"] = cookie + "=" + str(id(body)) + "; Path=" + path
+            self.reply(302, headers=headers)
+            return
+        self.reply(404)
+
+    def log_message(self, format, *args):
+        logging.debug("server: " + format % args)
+
+
+class BenchHTTPServer(ThreadingHTTPServer):
+
+    # Many sessions connect at once
+    request_queue_size = 128
+
+
+# Serve the stand-in web-app on a free local port in a background thread
+def serve(handler=StandInHandler):
+    server = BenchHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+# In-memory stand-in for a Redis server speaking the commands of
+# webdriver_util.RedisQueue, with the data shared by all connections
+class StandInRedisHandler(StreamRequestHandler):
+
+    def request_args(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            n = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(n + 2)[:-2].decode("utf-8"))
+
+        return args
+
+    def encode(self, value):
+        if value is True:
+            return b"+OK\r\n"
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return b":" + str(value).encode("ascii") + b"\r\n"
+        if isinstance(value, list):
+            return (b"*" + str(len(value)).encode("ascii") + b"\r\n"
+                    + b"".join(self.encode(v) for v in value))
+        value = str(value).encode("utf-8")
+
+        return b"$" + str(len(value)).encode("ascii") + b"\r\n" + value + b"\r\n"
+
+    def handle(self):
+        while True:
+            args = self.request_args()
+            if args is None:
+                return
+            with self.server.lock:
+                try:
+                    reply = self.encode(self.command(args[0].upper(), *args[1:]))
+                except (KeyError, ValueError) as e:
+                    reply = b"-ERR " + str(e).encode("utf-8") + b"\r\n"
+            self.wfile.write(reply)
+
+    def get(self, key, default=None):
+        data, expiry = self.server.data, self.server.expiry
+        if key in expiry and expiry[key] <= time.monotonic():
+            data.pop(key, None)
+            del expiry[key]
+
+        return data.get(key, default)
+
+    def zrange(self, key, lo, hi):
+        zset = self.get(key, {})
+        return sorted((m for m, score in zset.items() if lo <= score <= hi),
+                      key=lambda m: (zset[m], m))
+
+    def command(self, name, *args):
+        data = self.server.data
+        if name in ("PING", "AUTH", "SELECT"):
+            return True
+        if name == "INCR":
+            data[args[0]] = int(self.get(args[0], 0)) + 1
+            return data[args[0]]
+        if name == "GET":
+            return self.get(args[0])
+        if name == "SET":
+            options = [a.upper() for a in args[2:]]
+            if "NX" in options and self.get(args[0]) is not None:
+                return None
+            data[args[0]] = args[1]
+            self.server.expiry.pop(args[0], None)
+            if "PX" in options:
+                self.server.expiry[args[0]] = (time.monotonic()
+                                               + int(args[3 + options.index("PX")]) / 1000)
+            return True
+        if name == "DEL":
+            return sum(1 for key in args if data.pop(key, None) is not None)
+        if name == "SADD":
+            members = data.setdefault(args[0], set())
+            n = len(members)
+            members.update(args[1:])
+            return len(members) - n
+        if name == "SMEMBERS":
+            return sorted(self.get(args[0], set()))
+        if name == "ZADD":
+            options = [a.upper() for a in args[1:-2]]
+            zset = data.setdefault(args[0], {})
+            member, score = args[-1], float(args[-2])
+            if "XX" in options and member not in zset:
+                return 0
+            changed = zset.get(member) != score
+            zset[member] = score
+            return int(changed) if "CH" in options else int(not changed)
+        if name == "ZRANGEBYSCORE":
+            members = self.zrange(args[0], float(args[1]), float(args[2]))
+            if len(args) > 3:
+                members = members[int(args[4]):int(args[4]) + int(args[5])]
+            return members
+        if name == "ZCOUNT":
+            return len(self.zrange(args[0], float(args[1]), float(args[2])))
+        if name == "ZCARD":
+            return len(self.get(args[0], {}))
+        if name == "ZREM":
+            zset = self.get(args[0], {})
+            return sum(1 for m in args[1:] if zset.pop(m, None) is not None)
+        if name == "HINCRBY":
+            h = data.setdefault(args[0], {})
+            h[args[1]] = str(int(h.get(args[1], 0)) + int(args[2]))
+            return int(h[args[1]])
+        if name == "HSET":
+            h = data.setdefault(args[0], {})
+            new = args[1] not in h
+            h[args[1]] = args[2]
+            return int(new)
+        if name == "HGETALL":
+            return [v for kv in self.get(args[0], {}).items() for v in kv]
+        if name == "HLEN":
+            return len(self.get(args[0], {}))
+
+        raise ValueError("unknown command " + name)
+
+
+# Serve a StandInRedisHandler on a free local port
+def serve_redis():
+    server = ThreadingTCPServer(("127.0.0.1", 0), StandInRedisHandler)
+    server.daemon_threads = True
+    server.data = {}
+    server.expiry = {}
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+# Point the spotify validation at the stand-in status page
+def stand_in_targets(base_url):
+    definition = dict(webdriver_util.targets_bundled["spotify"])
+    definition["validate"] = {"url_prefix": base_url + "/spotify/en/status"}
+    webdriver_util.targets["spotify"] = \
+        webdriver_util.compile_target("spotify", definition)
+
+
+# A gray PNG of width x height pixels
+def png_image(width, height):
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data)))
+
+    rows = b"".join(b"\x00" + b"\x80" * width for _ in range(height))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows))
+            + chunk(b"IEND", b""))
+
+
+class FakeElement:
+
+    def __init__(self, driver, submit):
+        self.driver = driver
+        self.submit = submit
+
+    def clear(self):
+        pass
+
+    def send_keys(self, *value):
+        pass
+
+    def click(self):
+        if self.submit:
+            self.driver.submit_form()
+
+
+class FakeSwitchTo:
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def window(self, handle):
+        if handle not in self.driver.windows:
+            raise NoSuchElementException("No window " + handle)
+        self.driver.current_window_handle = handle
+
+    def new_window(self, kind='tab'):
+        handle = "window-" + str(next(self.driver.handles))
+        self.driver.windows[handle] = {"url": "about:blank", "html": ""}
+        self.driver.current_window_handle = handle
+
+
+# In-process stand-in for a Firefox WebDriver session
+# Pages are fetched over keep-alive HTTP connections, elements are
+# found by their id or name in the page source, submitting a form
+# posts it and follows the redirect
+class FakeWebDriver:
+
+    def __init__(self, screenshot_size=(1280, 720)):
+        self.handles = itertools.count()
+        self.session_id = "fake-" + str(id(self))
+        self.windows = {}
+        self.connections = {}
+        self.png = png_image(*screenshot_size)
+        self.cookies = {}
+        self.switch_to = FakeSwitchTo(self)
+        self.switch_to.new_window()
+
+    @property
+    def window_handles(self):
+        return list(self.windows)
+
+    @property
+    def current_url(self):
+        return self.windows[self.current_window_handle]["url"]
+
+    @property
+    def page_source(self):
+        return self.windows[self.current_window_handle]["html"]
+
+    def request(self, method, url, body=b""):
+        if url.startswith("about:"):
+            return url, ""
+
+        for _ in range(5):
+            u = urlsplit(url)
+            conn = self.connections.get(u.netloc)
+            if conn is None:
+                conn = http.client.HTTPConnection(u.netloc)
+                self.connections[u.netloc] = conn
+            path = u.path + ("?" + u.query if u.query else "")
+            headers = {}
+            if self.cookies:
+                headers["Cookie"] = "; ".join(c["name"] + "=" + c["value"]
+                                              for c in self.cookies.values())
+            conn.request(method, path, body=body if method == "POST" else None,
+                         headers=headers)
+            r = conn.getresponse()
+            html = r.read().decode("utf-8")
+            set_cookie = r.getheader("Set-Cookie")
+            if set_cookie:
+                name, _, value = set_cookie.split(";", 1)[0].partition("=")
+                self.add_cookie({"name": name, "value": value})
+            if r.status not in (301, 302, 303):
+                return url, html
+            url = urljoin(url, r.getheader("Location"))
+            method = "GET"
+
+        return url, html
+
+    def get(self, url):
+        window = self.windows[self.current_window_handle]
+        window["url"], window["html"] = self.request("GET", url)
+
+    def submit_form(self):
+        window = self.windows[self.current_window_handle]
+        action = window["html"].split('action="', 1)[1].split('"', 1)[0]
+        hidden = re.findall('<input type="hidden" name="([^"]*)" value="([^"]*)">',
+                            window["html"])
+        window["url"], window["html"] = \
+            self.request("POST", urljoin(window["url"], action),
+                         urlencode(hidden).encode("utf-8"))
+
+    def find_elements(self, by, value):
+        html = self.windows[self.current_window_handle]["html"]
+        if by in ("id", "name"):
+            found = (by + '="' + value + '"') in html
+            submit = found and ('type="submit" ' + by + '="' + value + '"') in html
+        else:
+            found = "<form" in html
+            submit = "button" in value
+        return [FakeElement(self, submit)] if found else []
+
+    def find_element(self, by, value):
+        elements = self.find_elements(by, value)
+        if not elements:
+            raise NoSuchElementException(by + "=" + value)
+        return elements[0]
+
+    def execute_script(self, script, *args):
+        if "readyState" in script:
+            return "complete"
+        if script == webdriver_util.js_fast_fill:
+            found = {}
+            for field, chain in args[0].items():
+                found[field] = next((k for k, (by, value) in enumerate(chain)
+                                     if self.find_elements(by, value)), None)
+                if found[field] is None:
+                    return "missing:" + field
+            self.submit_form()
+            return "ok:" + json.dumps(found)
+        return None
+
+    def get_screenshot_as_png(self):
+        return self.png
+
+    def delete_all_cookies(self):
+        self.cookies.clear()
+
+    def get_cookies(self):
+        return list(self.cookies.values())
+
+    def add_cookie(self, cookie):
+        self.cookies[cookie["name"]] = {"name": cookie["name"],
+                                        "value": cookie["value"]}
+
+    def close(self):
+        del self.windows[self.current_window_handle]
+
+    def quit(self):
+        for conn in self.connections.values():
+            conn.close()
+
+
+# W3C WebDriver server backed by a FakeWebDriver per session,
+# implementing the commands used by webdriver_async
+class StubWebDriverHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    sessions = {}
+    elements = {}
+
+    def reply(self, status, value):
+        body = json.dumps({"value": value}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, status, error, message=""):
+        self.reply(status, {"error": error, "message": message})
+
+    def body(self):
+        n = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(n)) if n else {}
+
+    # Translate the css selectors webdriver_async uses for id and name
+    def locator(self, using, value):
+        if using == "css selector" and value.startswith("[") and '="' in value:
+            by, _, v = value[1:-2].partition('="')
+            if by in ("id", "name"):
+                return by, v
+
+        return using, value
+
+    def element(self, driver, using, value):
+        e = driver.find_elements(*self.locator(using, value))
+        if not e:
+            return None
+        element_id = "element-" + str(len(self.elements))
+        self.elements[element_id] = e[0]
+
+        return {"element-6066-11e4-a52e-4f735466cecf": element_id}
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        body = self.body() if method == "POST" else {}
+        parts = self.path.strip("/").split("/")
+
+        if parts == ["status"]:
+            return self.reply(200, {"ready": True, "message": ""})
+        if parts == ["session"] and method == "POST":
+            driver = FakeWebDriver()
+            self.sessions[driver.session_id] = driver
+            return self.reply(200, {"sessionId": driver.session_id,
+                                    "capabilities": {}})
+
+        driver = self.sessions.get(parts[1]) if len(parts) > 1 else None
+        if driver is None:
+            return self.error(404, "invalid session id")
+        command = (method, "/".join(parts[2:]))
+
+        try:
+            if command == ("DELETE", ""):
+                driver.quit()
+                del self.sessions[parts[1]]
+                return self.reply(200, None)
+            elif command == ("POST", "url"):
+                driver.get(body["url"])
+                return self.reply(200, None)
+            elif command == ("GET", "url"):
+                return self.reply(200, driver.current_url)
+            elif command == ("POST", "element"):
+                e = self.element(driver, body["using"], body["value"])
+                if e is None:
+                    return self.error(404, "no such element", body["value"])
+                return self.reply(200, e)
+            elif command == ("POST", "elements"):
+                e = self.element(driver, body["using"], body["value"])
+                return self.reply(200, [e] if e else [])
+            elif method == "POST" and parts[2] == "element" and len(parts) == 5:
+                e = self.elements[parts[3]]
+                if parts[4] == "click":
+                    e.click()
+                elif parts[4] == "value":
+                    e.send_keys(body["text"])
+                else:
+                    e.clear()
+                return self.reply(200, None)
+            elif command == ("POST", "execute/sync"):
+                return self.reply(200, driver.execute_script(body["script"],
+                                                             *body["args"]))
+            elif command == ("GET", "window"):
+                return self.reply(200, driver.current_window_handle)
+            elif command == ("GET", "window/handles"):
+                return self.reply(200, driver.window_handles)
+            elif command == ("POST", "window"):
+                driver.switch_to.window(body["handle"])
+                return self.reply(200, None)
+            elif command == ("POST", "window/new"):
+                driver.switch_to.new_window(body.get("type", "tab"))
+                return self.reply(200, {"handle": driver.current_window_handle,
+                                        "type": "tab"})
+            elif command == ("DELETE", "window"):
+                driver.close()
+                return self.reply(200, driver.window_handles)
+            elif command == ("DELETE", "cookie"):
+                driver.delete_all_cookies()
+                return self.reply(200, None)
+            elif command == ("GET", "screenshot"):
+                png = driver.get_screenshot_as_png()
+                return self.reply(200, base64.b64encode(png).decode("ascii"))
+            elif command == ("POST", "window/fullscreen"):
+                return self.reply(200, None)
+        except NoSuchElementException as e:
+            return self.error(404, "no such window", str(e))
+
+        self.error(404, "unknown command", method + " " + self.path)
+
+    def log_message(self, format, *args):
+        logging.debug("stub: " + format % args)
+
+
+def percentiles(samples_ms):
+    q = statistics.quantiles(samples_ms, n=100, method="inclusive")
+
+    return {"p50": q[49], "p95": q[94], "p99": q[98]}
+
+
+def report(name, samples_ms):
+    p = percentiles(samples_ms)
+    print("{:<28} n={:<5} p50={:8.3f} ms  p95={:8.3f} ms  p99={:8.3f} ms"
+          .format(name, len(samples_ms), p["p50"], p["p95"], p["p99"]))
+
+    return p
+
+
+# Run fn iterations times, returning the duration of each run in ms
+def timed(fn, iterations):
+    samples_ms = []
+    for k in range(iterations):
+        t0 = time.monotonic()
+        fn(k)
+        samples_ms.append((time.monotonic() - t0) * 1000)
+
+    return samples_ms
+
+
+# A Browser on an existing session, skipping setup and login
+def browser_for(driver):
+    b = webdriver_util.Browser.__new__(webdriver_util.Browser)
+    b.browser = driver
+
+    return b
+
+
+# Log into every stand-in target
+def bench_web_login(driver, base_url, iterations, fill="keys"):
+    results = {}
+
+    for target, path in bench_targets.items():
+        login = {
+            "target": target,
+            "url":    base_url + path,
+            "user":   "user",
+            "pw":     "secret"
+        }
+        # roundcube has no validation, wait for the mailbox instead
+        if target == "roundcube":
+            ready = webdriver_util.ready_url(lambda url: "_task=mail" in url)
+        else:
+            ready = webdriver_util.readiness_login(target, login["url"])
+
+        def run(k):
+            driver.delete_all_cookies()
+            webdriver_util.web_login(driver, {"login_fill": fill},
+                                     login, login_html)
+            if not webdriver_util.wait_until(driver, ready, 10,
+                                             poll_s=0.005, what="bench"):
+                raise RuntimeError("Login into " + target + " did not complete")
+
+        name = "web_login " + target + " fill=" + fill
+        results[name] = report(name, timed(run, iterations))
+
+    return results
+
+
+# Log into the stand-in targets of the http engine with a form post
+# alone and by seeding a browser session with its cookies, to compare
+# against the browser logins of web_login
+def bench_http_login(driver, base_url, iterations):
+    results = {}
+
+    for target, path in bench_targets.items():
+        if webdriver_util.login_engine(target, "auto") != "http":
+            continue
+        login = {
+            "target": target,
+            "url":    base_url + path,
+            "user":   "user",
+            "pw":     "secret"
+        }
+
+        def run(k):
+            r = webdriver_util.http_login(login, login_html)
+            if not r["ok"]:
+                raise RuntimeError("HTTP login into " + target + " failed: "
+                                   + str(r["error"]))
+
+        name = "http_login " + target
+        results[name] = report(name, timed(run, iterations))
+
+        options = {"login_engine": "http", "ready_timeout": 10}
+        ready = webdriver_util.ready_url(lambda url: "_task=mail" in url)
+
+        def run_seeded(k):
+            driver.delete_all_cookies()
+            if not webdriver_util.web_login_cached(driver, options, login,
+                                                   login_html, ready=ready):
+                raise RuntimeError("Seeded login into " + target + " failed")
+
+        name = "web_login " + target + " engine=http"
+        results[name] = report(name, timed(run_seeded, iterations))
+
+    return results
+
+
+# Time every locator of the stand-in targets' chains on its own,
+# slow ones are candidates for replacement by a css selector
+# Fallbacks not matching the stand-in forms are timed as misses
+def bench_locators(driver, base_url, iterations):
+    results = {}
+
+    for target, path in bench_targets.items():
+        driver.delete_all_cookies()
+        driver.get(base_url + path)
+        for field, chain in webdriver_util.targets[target]["login"].items():
+            for k, (by, value) in enumerate(chain):
+                hit = bool(driver.find_elements(by, value))
+                name = ("locator " + target + " " + field + " " + str(k) + ":" + by
+                        + ("" if hit else " miss"))
+                results[name] = report(name, timed(
+                    lambda k: driver.find_elements(by, value), iterations))
+
+    return results
+
+
+# Put jobs of four targets into the SQLite queue and the Redis queue on
+# the stand-in server, then lease and complete them from one worker
+# owning half of the targets
+def bench_queue(driver, base_url, iterations):
+    redis = serve_redis()
+    results = {}
+
+    with tempfile.TemporaryDirectory() as path:
+        queues = {
+            "sqlite": webdriver_util.queue_open(os.path.join(path, "queue.db")),
+            "redis":  webdriver_util.queue_open(
+                "redis://127.0.0.1:" + str(redis.server_address[1]))
+        }
+        for backend, q in queues.items():
+            def put(k):
+                q.put({"target": "target" + str(k % 4), "url": base_url + "/page/"})
+
+            def lease(k):
+                job = q.lease("bench", {"target0", "target1"}, 0, 60)
+                if job is None:
+                    raise RuntimeError("Queue " + backend + " ran empty")
+                q.complete(job, "bench", {"id": job["id"], "target": job["target"],
+                                          "success": True, "latency_ms": 0})
+
+            name = "queue " + backend + " put"
+            results[name] = report(name, timed(put, iterations))
+            name = "queue " + backend + " lease+complete"
+            results[name] = report(name, timed(lease, iterations))
+            if q.depth()["done"] != iterations:
+                raise RuntimeError("Queue " + backend + " lost jobs")
+
+    redis.shutdown()
+
+    return results
+
+
+# Log into the local login form with both fill strategies
+def bench_login_fill(driver, base_url, iterations):
+    login = {
+        "target": "unknown",
+        "url":    base_url + "/form/login",
+        "user":   "user",
+        "pw":     "secret"
+    }
+    logged_in = webdriver_util.ready_url(lambda url: "?orgId=" in url)
+    results = {}
+
+    for fill in ("keys", "fast"):
+        def run(k):
+            webdriver_util.web_login(driver, {"login_fill": fill},
+                                     login, login_html)
+            if not webdriver_util.wait_until(driver, logged_in, 10,
+                                             poll_s=0.005, what="bench"):
+                raise RuntimeError("Login with " + fill + " fill did not complete")
+
+        name = "web_login form fill=" + fill
+        results[name] = report(name, timed(run, iterations))
+
+    return results
+
+
+def bench_open_tab_with_url(driver, base_url, iterations):
+    b = browser_for(driver)
+    first = driver.current_window_handle
+    samples_ms = timed(lambda k: b.open_tab_with_url(base_url + "/page/" + str(k)),
+                       iterations)
+
+    # Close the tabs again
+    for handle in driver.window_handles:
+        if handle != first:
+            driver.switch_to.window(handle)
+            driver.close()
+    driver.switch_to.window(first)
+
+    return {"open_tab_with_url": report("open_tab_with_url", samples_ms)}
+
+
+def bench_switch_tab(driver, base_url, iterations, ntabs=4):
+    b = browser_for(driver)
+    first = driver.current_window_handle
+    for k in range(ntabs - 1):
+        b.open_tab_with_url(base_url + "/page/" + str(k))
+
+    samples_ms = timed(lambda k: b.switch_tab(driver.current_window_handle),
+                       iterations)
+
+    for handle in driver.window_handles:
+        if handle != first:
+            driver.switch_to.window(handle)
+            driver.close()
+    driver.switch_to.window(first)
+
+    return {"switch_tab": report("switch_tab", samples_ms)}
+
+
+# Capture, encode and write a single frame per iteration
+def bench_screenshot(driver, base_url, iterations):
+    b = browser_for(driver)
+    b.get_url(base_url + "/page/screenshot")
+
+    with tempfile.TemporaryDirectory() as img_path:
+        def run(k):
+            pipeline = webdriver_util.ScreenshotPipeline(img_path, ring_size=4)
+            b.screenshot(img_path, 0, pipeline, max_frames=1)
+
+        samples_ms = timed(run, iterations)
+
+    return {"screenshot": report("screenshot", samples_ms)}
+
+
+# Records the time between the frames handed to a pipeline
+class FrameIntervals:
+
+    def __init__(self):
+        self.t_last = None
+        self.intervals_ms = []
+
+    def put(self, png):
+        now = time.monotonic()
+        if self.t_last is not None:
+            self.intervals_ms.append((now - self.t_last) * 1000)
+        self.t_last = now
+
+    def close(self):
+        pass
+
+
+# Capture a static page with a fixed pause of 10 ms and with the
+# adaptive pause between 10 and 100 ms, reporting the frame intervals
+def bench_adaptive_capture(driver, base_url, iterations):
+    b = browser_for(driver)
+    b.get_url(base_url + "/page/static")
+    results = {}
+
+    for name, schedule in (("capture fixed", None),
+                           ("capture adaptive",
+                            webdriver_util.AdaptiveSchedule(0.01, 0.1))):
+        intervals = FrameIntervals()
+        pipeline = webdriver_util.ScreenshotPipeline("", sinks=[intervals],
+                                                     files=False)
+        b.screenshot("", 0.01, pipeline, max_frames=iterations + 1,
+                     schedule=schedule)
+        results[name] = report(name, intervals.intervals_ms)
+
+    return results
+
+
+# Log into the stand-in targets from concurrent asyncio sessions on the
+# stub WebDriver server, one session per login, reporting per login
+# latency and the total time of each round
+def bench_async_sessions(driver, base_url, iterations, sessions=16):
+    stub = serve(StubWebDriverHandler)
+    stub_url = "http://127.0.0.1:" + str(stub.server_address[1])
+    browser_options = {"ready_timeout": 10}
+    jobs = [{"target": target,
+             "url":    base_url + bench_targets[target],
+             "user":   "user",
+             "pw":     "secret"}
+            for target in itertools.islice(itertools.cycle(bench_targets),
+                                           sessions)]
+    login_ms = []
+
+    async def login(browser, job):
+        t0 = time.monotonic()
+        await browser.driver.delete_all_cookies()
+        if not await browser.login(job, login_html):
+            raise RuntimeError("Login into " + job["target"] + " failed")
+        login_ms.append((time.monotonic() - t0) * 1000)
+
+    async def run():
+        browsers = await asyncio.gather(
+            *(webdriver_async.async_browser_start(browser_options, stub_url)
+              for _ in jobs))
+        rounds_ms = []
+        try:
+            for _ in range(iterations):
+                t0 = time.monotonic()
+                await asyncio.gather(*(login(b, job)
+                                       for b, job in zip(browsers, jobs)))
+                rounds_ms.append((time.monotonic() - t0) * 1000)
+        finally:
+            await asyncio.gather(*(b.close() for b in browsers))
+
+        return rounds_ms
+
+    try:
+        rounds_ms = asyncio.run(run())
+    finally:
+        stub.shutdown()
+
+    name = "async " + str(sessions) + " sessions"
+
+    return {
+        name + " login": report(name + " login", login_ms),
+        name + " round": report(name + " round", rounds_ms)
+    }
+
+
+# Start a fresh interpreter per iteration to time importing webdriver_util,
+# printing the help of its CLI and importing what starting a browser needs
+def bench_startup(driver, base_url, iterations):
+    module_dir = os.path.dirname(os.path.abspath(webdriver_util.__file__))
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(filter(None, [module_dir,
+                                                        os.getenv("PYTHONPATH")])))
+    commands = {
+        "startup_python":         [sys.executable, "-c", "pass"],
+        "startup_import":         [sys.executable, "-c", "import webdriver_util"],
+        "startup_help":           [sys.executable, "-m", "webdriver_util", "--help"],
+        "startup_browser_import": [sys.executable, "-c",
+                                   "import webdriver_util\n"
+                                   "from selenium import webdriver\n"
+                                   "from selenium.webdriver.firefox.service import Service"]
+    }
+
+    results = {}
+    for name, command in commands.items():
+        samples_ms = timed(lambda k: subprocess.run(command,
+                                                    env=env,
+                                                    stdout=subprocess.DEVNULL,
+                                                    check=True),
+                           iterations)
+        results[name] = report(name, samples_ms)
+
+    # Modules imported by webdriver_util itself, most expensive first
+    importtime = subprocess.run([sys.executable, "-X", "importtime",
+                                 "-c", "import webdriver_util"],
+                                env=env,
+                                stderr=subprocess.PIPE,
+                                text=True,
+                                check=True).stderr
+    imports, children = [], []
+    for line in importtime.splitlines():
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        depth = (len(fields[2]) - len(fields[2].lstrip()) - 1) // 2
+        if depth == 1:
+            children.append((int(fields[1]), fields[2].strip()))
+        elif depth == 0:
+            if fields[2].strip() == "webdriver_util":
+                imports = children
+            children = []
+    for cumulative_us, module in sorted(imports, reverse=True)[:5]:
+        print("{:<28} {:8.3f} ms".format("  import " + module,
+                                         cumulative_us / 1000))
+
+    return results
+
+
+# Start a session per profile preset, load a few stand-in pages and report
+# the resident memory of geckodriver and firefox with their idle CPU usage
+def bench_profiles(args, base_url, iterations, ntabs=4, idle_s=5):
+    if args.driver != "firefox":
+        print("profiles: Needs --driver firefox, skipped")
+        return {}
+
+    results = {}
+    for name in webdriver_util.profile_presets:
+        t0 = time.monotonic()
+        driver = browser_start(args, profile=name)
+        startup_ms = (time.monotonic() - t0) * 1000
+        try:
+            b = browser_for(driver)
+            b.get_url(base_url + "/page/0")
+            for k in range(1, ntabs):
+                b.open_tab_with_url(base_url + "/page/" + str(k))
+            pid = driver.service.process.pid
+            _, cpu0_s = webdriver_util.process_tree_usage(pid)
+            time.sleep(idle_s)
+            rss, cpu1_s = webdriver_util.process_tree_usage(pid)
+        finally:
+            driver.quit()
+
+        results["profile_" + name] = {
+            "startup_ms":    startup_ms,
+            "rss_mb":        rss / 2**20,
+            "idle_cpu_pct":  (cpu1_s - cpu0_s) / idle_s * 100
+        }
+        print("{:<28} startup={:8.1f} ms  rss={:8.1f} MiB  idle cpu={:5.1f} %"
+              .format("profile_" + name, startup_ms, rss / 2**20,
+                      (cpu1_s - cpu0_s) / idle_s * 100))
+
+    return results
+
+
+# Benchmarks that do not drive a browser
+standalone_benchmarks = {"startup", "queue"}
+
+# Benchmarks starting browsers of their own, called with the options
+# instead of a driver
+launch_benchmarks = {
+    "profiles": bench_profiles
+}
+
+benchmarks = {
+    "web_login":         bench_web_login,
+    "login_fill":        bench_login_fill,
+    "http_login":        bench_http_login,
+    "locators":          bench_locators,
+    "queue":             bench_queue,
+    "open_tab_with_url": bench_open_tab_with_url,
+    "switch_tab":        bench_switch_tab,
+    "screenshot":        bench_screenshot,
+    "adaptive_capture":  bench_adaptive_capture,
+    "async_sessions":    bench_async_sessions,
+    "startup":           bench_startup
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Append a run to the results file as a JSON line
+def results_store(path, record):
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+
+
+# Print the change of every p50 against the last stored run
+# with the same driver
+def results_compare(path, record):
+    previous = None
+    try:
+        with open(path) as f:
+            for line in f:
+                r = json.loads(line)
+                if r["driver"] == record["driver"]:
+                    previous = r
+    except FileNotFoundError:
+        pass
+
+    if previous is None:
+        print("No previous results to compare with")
+        return None
+
+    print("Compared to " + str(previous["commit"]) + ":")
+    for name, p in record["results"].items():
+        if name not in previous["results"]:
+            continue
+        # Timings compare by median, profiles by memory
+        key, unit = ("p50", "ms") if "p50" in p else ("rss_mb", "MiB")
+        before = previous["results"][name][key]
+        change = (p[key] - before) / before * 100 if before else 0
+        print("{:<28} {} {:8.3f} {} -> {:8.3f} {}  {:+6.1f} %"
+              .format(name, key, before, unit, p[key], unit, change))
+
+    return previous
+
+
+def browser_start(args, profile="default"):
+    if args.driver == "fake":
+        return FakeWebDriver()
+
+    preset = webdriver_util.profile_preset(profile)
+    return webdriver_util.gecko_browser_setup({
+        "log_level":        "warn",
+        "prefs":            preset["prefs"],
+        "window_size":      preset.get("window_size"),
+        "headless":         args.headless or preset.get("headless", False),
+        "fullscreen":       False,
+        "drm":              preset.get("drm", False),
+        "geckodriver_path": args.geckodriver_path or os.getenv('GECKODRIVER'),
+        "firefox_binary":   args.firefox_binary or os.getenv('FIREFOX_BIN'),
+    }, [])
+
+
+def run(args):
+    server = serve()
+    base_url = "http://127.0.0.1:" + str(server.server_address[1])
+    stand_in_targets(base_url)
+
+    names = ((args.benchmarks or []) + args.names
+             or list(benchmarks) + list(launch_benchmarks))
+    unknown = set(names) - set(benchmarks) - set(launch_benchmarks)
+    if unknown:
+        logging.error("Unknown benchmarks: " + ", ".join(sorted(unknown)))
+        sys.exit(1)
+
+    driver = None
+    if set(names) - standalone_benchmarks - set(launch_benchmarks):
+        driver = browser_start(args)
+    results = {}
+    try:
+        for name in names:
+            if name in launch_benchmarks:
+                results.update(launch_benchmarks[name](args, base_url,
+                                                       args.iterations))
+            else:
+                results.update(benchmarks[name](driver, base_url,
+                                                args.iterations))
+    finally:
+        if driver is not None:
+            driver.quit()
+        server.shutdown()
+
+    record = {
+        "time":       time.time(),
+        "commit":     git_commit(),
+        "driver":     args.driver,
+        "iterations": args.iterations,
+        "results":    results
+    }
+    if args.results:
+        results_compare(args.results, record)
+        results_store(args.results, record)
+
+    return record
+
+
+def parser_add_arguments(parser):
+    parser.add_argument('names',
+                        help="Benchmarks to run, like --benchmark",
+                        nargs='*')
+    parser.add_argument('--driver',
+                        dest='driver',
+                        env_var='BENCH_DRIVER',
+                        help="WebDriver to benchmark with: firefox or fake",
+                        type=str,
+                        choices=["firefox", "fake"],
+                        default="fake")
+    parser.add_argument('--benchmark',
+                        dest='benchmarks',
+                        env_var='BENCH_BENCHMARK',
+                        help="Benchmark to run, can be specified multiple times, "
+                             "defaults to all: "
+                             + ", ".join(list(benchmarks) + list(launch_benchmarks)),
+                        type=str,
+                        action='append')
+    parser.add_argument('--iterations',
+                        dest='iterations',
+                        env_var='BENCH_ITERATIONS',
+                        help="Number of iterations per benchmark",
+                        type=int,
+                        default=50)
+    parser.add_argument('--results',
+                        dest='results',
+                        env_var='BENCH_RESULTS',
+                        help="File to store results in and compare them with",
+                        type=str,
+                        default="bench_results.jsonl")
+    parser.add_argument('--headless',
+                        dest='headless',
+                        env_var='BROWSER_HEADLESS',
+                        help="Run the browser in headless mode",
+                        type=bool,
+                        default=True)
+    parser.add_argument('--geckodriver-path',
+                        dest='geckodriver_path',
+                        env_var='GECKODRIVER',
+                        help='Path to geckodriver binary',
+                        type=str)
+    parser.add_argument('--firefox-binary',
+                        dest='firefox_binary',
+                        env_var='FIREFOX_BIN',
+                        help='Path to firefox binary',
+                        type=str)
+
+    return parser
+
+
+def main(argv=None):
+    import configargparse
+
+    parser = configargparse.ArgParser(description="webdriver-util benchmarks")
+    args = parser_add_arguments(parser).parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    run(args)
+
+    return True
+
+
+if __name__ == '__main__':
+    main()
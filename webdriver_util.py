@@ -8,30 +8,227 @@
 # Copyright (c) 2020 Björn Busse <bj.rn@baerlin.eu>
 #
 
+import atexit
 import base64
-import configargparse
+import collections
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import copy
+import csv
+import hashlib
+import io
+import itertools
+import json
 import logging
+import math
 import os
+from html.parser import HTMLParser
 from pathlib import Path
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.firefox.service import Service
+from urllib.parse import parse_qs, urlencode, urljoin, urlsplit, urlunsplit
+import queue
+import re
+from selenium.common.exceptions import WebDriverException
 import sys
+import threading
 import time
 
 
 url_releases_geckodriver = "https://github.com/mozilla/geckodriver/releases/"
 
-path_logout = {
-    "gitea":     "",
-    "grafana5":   "logout",
-    "roundcube": "?_task=logout",
-    "spotify":   ""
+msg_error_selector = "No valid selection method supplied. \
+Use one of id/name/css/xpath"
+
+# Selection methods of login form elements, the values of selenium's By
+# spelled out to not import selenium.webdriver before a browser is started
+locator_methods = {
+    "id":    "id",
+    "name":  "name",
+    "css":   "css selector",
+    "xpath": "xpath"
 }
 
-msg_error_selector = "No valid selection method supplied. \
-Use one of id/name/xpath"
+# Bundled target definitions
+# login:    [method, value] locators of the user and password inputs
+#           and the submit button, or lists of fallback locators
+#           tried in the order given, cheap and stable ones first
+# validate: Predicate on the URL after login, "{url}" is replaced
+#           by the login URL
+# logout:   Path to append to the login URL to log out
+# fill:     "keys" for forms rejecting script input, "fast" to always
+#           fill by script, defaults to --login-fill
+targets_bundled = {
+    "gitea": {
+        "logout": ""
+    },
+    "grafana5": {
+        "login": {
+            "user":   [["css", "form input[name='user'], form input[name='username']"],
+                       ["name", "username"],
+                       ["name", "user"]],
+            "pw":     [["css", "form input[type='password']"],
+                       ["id", "inputPassword"],
+                       ["name", "password"]],
+            "submit": [["css", "form button[type='submit']"],
+                       ["xpath", "//form//button"],
+                       ["xpath", "/html/body/grafana-app/div/div/div/div/div/div[2]/div[1]/form/div[3]/button"]]
+        },
+        "validate": {"url_prefix": "{url}?orgId="},
+        "logout": "logout"
+    },
+    "roundcube": {
+        "login": {
+            "user":   [["id", "rcmloginuser"], ["name", "_user"]],
+            "pw":     [["id", "rcmloginpwd"], ["name", "_pass"]],
+            "submit": [["id", "rcmloginsubmit"], ["css", "form button[type='submit']"]]
+        },
+        "logout": "?_task=logout",
+        "engine": "http"
+    },
+    "spotify": {
+        "login": {
+            "user":   ["name", "username"],
+            "pw":     ["name", "password"],
+            "submit": ["id", "login-button"]
+        },
+        "validate": {"url_prefix": "https://accounts.spotify.com/en/status"},
+        "logout": ""
+    },
+    "unknown": {}
+}
+
+login_fields = ["user", "pw", "submit"]
+
+
+# Compile a [method, value] locator into a (By, value) tuple
+def compile_locator(locator, what):
+    if (not isinstance(locator, (list, tuple)) or len(locator) != 2
+            or not isinstance(locator[1], str) or not locator[1]):
+        raise ValueError(what + ": Locator must be [method, value]")
+    if locator[0] not in locator_methods:
+        raise ValueError(what + ": " + msg_error_selector)
+
+    return (locator_methods[locator[0]], locator[1])
+
+
+# Compile a locator or a list of fallback locators into a tuple
+# of (By, value) tuples, kept in the order they are given in
+def compile_chain(chain, what):
+    if (isinstance(chain, (list, tuple)) and chain
+            and all(isinstance(locator, (list, tuple)) for locator in chain)):
+        locators = [compile_locator(locator, what) for locator in chain]
+    else:
+        locators = [compile_locator(chain, what)]
+
+    return tuple(locators)
+
+
+def compile_validate(validate, what):
+    if validate is None:
+        return None
+    if not isinstance(validate, dict) or len(validate) != 1:
+        raise ValueError(what + ": validate must have exactly one predicate")
+
+    kind, prefix = next(iter(validate.items()))
+    if not isinstance(prefix, str):
+        raise ValueError(what + ": " + kind + " must be a string")
+    if kind == "url_prefix":
+        return lambda current_url, url: \
+            current_url.startswith(prefix.replace("{url}", url))
+    elif kind == "url_not_prefix":
+        return lambda current_url, url: \
+            not current_url.startswith(prefix.replace("{url}", url))
+
+    raise ValueError(what + ": Unknown validate predicate " + kind)
+
+
+# Validate a target definition and compile it for lookups at login time
+def compile_target(name, definition):
+    if not isinstance(definition, dict):
+        raise ValueError("Target " + name + ": Definition must be a mapping")
+    unknown = set(definition) - {"login", "validate", "logout", "fill", "engine"}
+    if unknown:
+        raise ValueError("Target " + name + ": Unknown keys "
+                         + ", ".join(sorted(unknown)))
+
+    login = definition.get("login") or {}
+    if login and sorted(login) != sorted(login_fields):
+        raise ValueError("Target " + name + ": login needs exactly "
+                         + ", ".join(login_fields))
+
+    logout = definition.get("logout", "")
+    if not isinstance(logout, str):
+        raise ValueError("Target " + name + ": logout must be a string")
+
+    fill = definition.get("fill")
+    if fill not in (None, "keys", "fast"):
+        raise ValueError("Target " + name + ": fill must be keys or fast")
+
+    # Whether the login form works without JS
+    engine = definition.get("engine", "browser")
+    if engine not in ("browser", "http"):
+        raise ValueError("Target " + name + ": engine must be browser or http")
+
+    return {
+        "login": {field: compile_chain(login[field],
+                                       "Target " + name + " " + field)
+                  for field in login} or None,
+        "validate": compile_validate(definition.get("validate"),
+                                     "Target " + name),
+        "logout": logout,
+        "fill": fill,
+        "engine": engine
+    }
+
+
+# Read a JSON or YAML file
+def load_data_file(path):
+    ext = os.path.splitext(path)[1].lower()
+
+    with open(path) as f:
+        if ext == ".json":
+            return json.load(f)
+        elif ext in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                logging.error("Reading YAML files requires PyYAML")
+                sys.exit(1)
+            return yaml.safe_load(f)
+
+    raise ValueError("Unsupported file format: " + path)
+
+
+# Add the target definitions of a JSON or YAML file to the registry,
+# replacing bundled targets of the same name
+def load_targets(path):
+    definitions = load_data_file(path)
+    if not isinstance(definitions, dict):
+        raise ValueError(path + ": Must map target names to definitions")
+
+    compiled = {name: compile_target(name, definition)
+                for name, definition in definitions.items()}
+    targets.update(compiled)
+    logging.info("Loaded targets " + ", ".join(sorted(compiled))
+                 + " from " + path)
+
+    return compiled
+
+
+# Locator chains of the login form of target
+# Targets without bundled locators use the selectors supplied by the user
+def target_login_locators(target, html_login):
+    t = targets.get(target)
+    if t is not None and t["login"] is not None:
+        return t["login"]
+
+    return {field: compile_chain([html_login['selector_' + field],
+                                  html_login['selector_value_' + field]],
+                                 "Selector " + field)
+            for field in login_fields}
+
+
+targets = {name: compile_target(name, definition)
+           for name, definition in targets_bundled.items()}
 
 
 def which(cmd):
@@ -51,322 +248,4057 @@ def which(cmd):
     return None
 
 
-# Check for a successful login
-def web_validate_login(target, validate_url, url):
-    logging.info("Validating Login: ", validate_url)
-    if target == "grafana5":
-        if not validate_url.startswith(url + "?orgId="):
-            return False
+# Histogram buckets of phase durations in seconds
+metrics_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+# A label value with backslashes, quotes and newlines escaped
+def label_escape(value):
+    return (str(value).replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+# Timing histograms and counters, exposed in the Prometheus text format
+# Spans optionally are kept as a trace of the run
+class Metrics:
+
+    def __init__(self, prefix="webdriver_util"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+        self.trace = None
+        self.t0 = time.time()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    # Record a duration of value_s seconds
+    def observe(self, name, value_s, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = {"buckets": [0] * len(metrics_buckets),
+                                   "sum": 0.0, "count": 0}
+            for k, le in enumerate(metrics_buckets):
+                if value_s <= le:
+                    h["buckets"][k] += 1
+            h["sum"] += value_s
+            h["count"] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.gauges.setdefault(name, {})[key] = value
+
+    # Time the enclosed block as a phase
+    @contextmanager
+    def span(self, phase, **labels):
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            t_s = time.monotonic() - t0
+            self.observe("phase_seconds", t_s, phase=phase, **labels)
+            if self.trace is not None:
+                with self.lock:
+                    self.trace.append({
+                        "phase": phase,
+                        "start_ms": round((time.time() - t_s - self.t0) * 1000, 3),
+                        "duration_ms": round(t_s * 1000, 3),
+                        "labels": labels,
+                        "thread": threading.current_thread().name
+                    })
+
+    def render(self):
+        def labels_text(key, extra=()):
+            items = list(key) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(k + '="' + label_escape(v) + '"'
+                                  for k, v in items) + "}"
+
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.histograms.items()):
+                fullname = self.prefix + "_" + name
+                lines.append("# HELP " + fullname + " " + self.help.get(name, name))
+                lines.append("# TYPE " + fullname + " histogram")
+                for key, h in sorted(series.items()):
+                    for le, n in zip(metrics_buckets, h["buckets"]):
+                        lines.append(fullname + "_bucket"
+                                     + labels_text(key, [("le", repr(float(le)))])
+                                     + " " + str(n))
+                    lines.append(fullname + "_bucket"
+                                 + labels_text(key, [("le", "+Inf")])
+                                 + " " + str(h["count"]))
+                    lines.append(fullname + "_sum" + labels_text(key)
+                                 + " " + repr(h["sum"]))
+                    lines.append(fullname + "_count" + labels_text(key)
+                                 + " " + str(h["count"]))
+            for name, series in sorted(self.counters.items()):
+                fullname = self.prefix + "_" + name
+                lines.append("# HELP " + fullname + " " + self.help.get(name, name))
+                lines.append("# TYPE " + fullname + " counter")
+                for key, value in sorted(series.items()):
+                    lines.append(fullname + "_total" + labels_text(key)
+                                 + " " + str(value))
+            for name, series in sorted(self.gauges.items()):
+                fullname = self.prefix + "_" + name
+                lines.append("# HELP " + fullname + " " + self.help.get(name, name))
+                lines.append("# TYPE " + fullname + " gauge")
+                for key, value in sorted(series.items()):
+                    lines.append(fullname + labels_text(key) + " " + str(value))
+        lines.append("# EOF")
+
+        return "\n".join(lines) + "\n"
+
+    # Serve /metrics on a local port in a background thread
+    def serve(self, port, address="127.0.0.1"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "application/openmetrics-text; version=1.0.0; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("metrics: " + format % args)
+
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info("metrics: Serving /metrics on " + address + ":" + str(port))
+
+        return server
+
+    def trace_enable(self):
+        self.trace = []
+
+    def trace_write(self, path):
+        with self.lock:
+            trace = list(self.trace or [])
+        with open(path, 'w') as f:
+            json.dump({"start": self.t0, "spans": trace}, f, indent=1)
+
         return True
-    elif target == "spotify":
-        url_login_spotify = "https://accounts.spotify.com/en/status"
-        if not validate_url.startswith(url_login_spotify):
-            logging.info(url)
+
+
+metrics = Metrics()
+metrics.describe("phase_seconds", "Time spent per phase")
+metrics.describe("logins", "Logins by target and result")
+metrics.describe("frames", "Screenshot frames by state")
+metrics.describe("memory_bytes", "Resident memory of geckodriver and firefox, "
+                                 "JS heap of the visible tab")
+metrics.describe("recycles", "Tab reloads and session restarts by the watchdog")
+metrics.describe("queue_jobs", "Queued jobs run by worker and result")
+metrics.describe("queue_depth", "Jobs in the shared queue by state")
+metrics.describe("worker_jobs_per_min", "Jobs completed per minute by worker "
+                                        "since its last report")
+metrics.describe("host_load", "CPU and memory load of the host")
+metrics.describe("capture_interval_seconds", "Current adaptive pause between screenshots")
+metrics.describe("locator_fallbacks", "Login form elements found by a locator "
+                                      "other than the first of their chain")
+
+
+# Readiness conditions
+# Each condition is called with the browser and returns True
+# as soon as the page is considered ready
+
+# The current URL satisfies the given predicate
+def ready_url(predicate):
+    def condition(browser):
+        return predicate(browser.current_url)
+
+    return condition
+
+
+# An element matching the css selector is present
+def ready_element(css_selector):
+    def condition(browser):
+        return len(browser.find_elements(locator_methods["css"], css_selector)) > 0
+
+    return condition
+
+
+# The document finished loading
+def ready_document(browser):
+    return browser.execute_script("return document.readyState") == "complete"
+
+
+# The document finished loading and no new resources
+# were fetched for idle_ms milliseconds
+def ready_network_idle(idle_ms=500):
+    state = {"resources": -1, "since": 0.0}
+
+    def condition(browser):
+        if not ready_document(browser):
             return False
+        n = browser.execute_script(
+            "return performance.getEntriesByType('resource').length")
+        now = time.monotonic()
+        if n != state["resources"]:
+            state["resources"] = n
+            state["since"] = now
+            return False
+        return (now - state["since"]) * 1000 >= idle_ms
+
+    return condition
+
+
+# Build a readiness condition from its command line description:
+# readystate, networkidle, element:<css-selector> or url:<prefix>
+def readiness_condition(spec):
+    kind, _, value = spec.partition(":")
+    if kind == "readystate":
+        return ready_document
+    elif kind == "networkidle":
+        return ready_network_idle(int(value) if value else 500)
+    elif kind == "element" and value:
+        return ready_element(value)
+    elif kind == "url" and value:
+        return ready_url(lambda current_url: current_url.startswith(value))
+
+    return None
+
+
+# The readiness condition after logging into target on url
+def readiness_login(target, url):
+    if target in targets and targets[target]["validate"] is not None:
+        return ready_url(lambda current_url:
+                         web_validate_login(target, current_url, url))
+
+    return ready_document
+
+
+# Poll condition until it holds or timeout_s passed
+# Returns whether the condition was met
+def wait_until(browser, condition, timeout_s, poll_s=0.1, what="page"):
+    t0 = time.monotonic()
+    ready = False
+
+    while True:
+        try:
+            ready = condition(browser)
+        except WebDriverException as e:
+            logging.debug("browser: Readiness check failed: " + str(e))
+        if ready or time.monotonic() - t0 >= timeout_s:
+            break
+        time.sleep(poll_s)
+
+    t_ms = int(round((time.monotonic() - t0) * 1000))
+    if ready:
+        logging.info("browser: " + what + " ready after " + str(t_ms) + " ms")
+    else:
+        logging.warning("browser: " + what + " not ready after "
+                        + str(t_ms) + " ms, giving up")
+
+    return ready
+
+
+# Check for a successful login
+def web_validate_login(target, validate_url, url):
+    logging.debug("Validating Login: " + validate_url)
+    t = targets.get(target)
+    if t is None or t["validate"] is None:
+        logging.debug("Can not validate login for target " + target)
         return True
-    elif target == "unknown":
-        logging.debug("Can not validate login for unknown target")
 
-    return True
+    return t["validate"](validate_url, url)
 
 
 # Logout
-def web_logout(browser, target, url, path_logout):
-    if target == "unknown":
+def web_logout(browser, target, url):
+    if target not in targets or target == "unknown":
+        return False
+
+    browser.get(url + targets[target]["logout"])
+
+    return True
+
+
+# Sources of the generator meta tag, scripts and stylesheets of a page,
+# which carry the version or build hash of most web-apps
+js_app_assets = """
+var assets = [];
+document.querySelectorAll('meta[name="generator"], script[src], link[rel="stylesheet"]')
+    .forEach(function (e) { assets.push(e.content || e.src || e.href); });
+return assets.join("\\n");
+"""
+
+
+# Hash identifying the version of the web-app on the current page
+def app_version(assets):
+    return hashlib.sha256(str(assets or "").encode("utf-8")).hexdigest()[:16]
+
+
+# On-disk cache of the locators that found the login form elements,
+# keyed by target, login URL and app version so they are tried first
+# until an update of the app changes its assets
+class LocatorCache:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except ValueError:
+            logging.warning("locators: Ignoring unreadable cache " + str(self.path))
+            self.entries = {}
+
+    def key(self, target, url, version):
+        return target + " " + url + " " + version
+
+    # The cached locator chains, each starting with the locator that
+    # found its element last, provided it is still part of the chain
+    def order(self, locators, target, url, version):
+        with self.lock:
+            winners = self.entries.get(self.key(target, url, version), {})
+
+        ordered = {}
+        for field, chain in locators.items():
+            winner = tuple(winners.get(field, ()))
+            if winner in chain:
+                chain = (winner,) + tuple(l for l in chain if l != winner)
+            ordered[field] = chain
+
+        return ordered
+
+    def store(self, target, url, version, winners):
+        key = self.key(target, url, version)
+        winners = {field: list(locator) for field, locator in winners.items()}
+        with self.lock:
+            if self.entries.get(key) == winners:
+                return
+            self.entries[key] = winners
+            path_tmp = self.path.with_suffix(".tmp." + str(threading.get_ident()))
+            with open(path_tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(path_tmp, self.path)
+
+        logging.info("locators: Cached " + ", ".join(
+            field + "=" + locator[0] for field, locator in winners.items())
+            + " for " + target)
+
+
+# Find the first element matched by a chain of locators, timing every
+# lookup by locator method to spot slow ones
+# Returns the element and the locator that found it
+def find_element_chain(browser, chain, target, field):
+    for locator in chain:
+        with metrics.span("login_locator", target=target, field=field,
+                          method=locator[0]):
+            elements = browser.find_elements(*locator)
+        if elements:
+            if locator != chain[0]:
+                logging.info("locators: " + target + " " + field + " found by "
+                             + locator[0] + " " + locator[1])
+                metrics.inc("locator_fallbacks", target=target, field=field)
+            return elements[0], locator
+
+    raise WebDriverException("No locator found the " + field + " element")
+
+
+# Locate the login form elements, fill them and submit in a single
+# script execution. Values are set through the native setter and
+# input/change events are dispatched for frameworks tracking the inputs
+# Returns "ok:<indexes of the locators found>", "missing:<field>"
+# or "rejected:<field>"
+js_fast_fill = """
+var locators = arguments[0], values = arguments[1], elements = {}, found = {};
+function find(by, value) {
+    if (by === "id") return document.getElementById(value);
+    if (by === "name") return document.getElementsByName(value)[0] || null;
+    if (by === "css selector") return document.querySelector(value);
+    return document.evaluate(value, document, null,
+        XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+}
+for (var field in locators) {
+    for (var k = 0; k < locators[field].length && !elements[field]; k++) {
+        elements[field] = find(locators[field][k][0], locators[field][k][1]);
+        found[field] = k;
+    }
+    if (!elements[field]) return "missing:" + field;
+}
+for (var field in values) {
+    var e = elements[field];
+    var proto = Object.getPrototypeOf(e);
+    var setter = Object.getOwnPropertyDescriptor(proto, "value").set;
+    e.focus();
+    setter.call(e, values[field]);
+    e.dispatchEvent(new Event("input", {bubbles: true}));
+    e.dispatchEvent(new Event("change", {bubbles: true}));
+    if (e.value !== values[field]) return "rejected:" + field;
+}
+elements.submit.click();
+return "ok:" + JSON.stringify(found);
+"""
+
+
+# Fill and submit the login form in one WebDriver round trip
+# Returns the locators that found the elements, None on failure
+def web_login_fast(browser, locators, login):
+    try:
+        result = browser.execute_script(js_fast_fill,
+                                        {k: [list(l) for l in v]
+                                         for k, v in locators.items()},
+                                        {"user": login['user'], "pw": login['pw']})
+    except WebDriverException as e:
+        logging.warning("Fast login form fill failed on " + login['url']
+                        + ", typing instead: " + str(e).strip())
+        return None
+    if not str(result).startswith("ok:"):
+        logging.debug("Fast login form fill failed: " + str(result))
+        return None
+
+    logging.info("Trying to log into " + login['url'])
+
+    return {k: locators[k][i] for k, i in json.loads(result[3:]).items()}
+
+
+# Log into web-app
+# With login_fill "fast" the form is filled by a single script,
+# falling back to typing into each element if that fails or the
+# target's definition asks for typed input
+# With a locator cache the locators that worked last are tried first
+def web_login(browser, browser_options, login, html_login):
+    try:
+        locators = target_login_locators(login['target'], html_login)
+    except ValueError as e:
+        logging.error(str(e))
+        return False
+
+    fill = browser_options.get('login_fill', "keys")
+    t = targets.get(login['target'])
+    if t is not None and t["fill"] is not None:
+        fill = t["fill"]
+
+    cache = browser_options.get('locator_cache')
+    found = {}
+
+    try:
+        logging.info("Opening " + login['url'] + " with browser")
+        with metrics.span("login_page", target=login['target']):
+            browser.get(login['url'])
+
+        if cache is not None:
+            version = app_version(browser.execute_script(js_app_assets))
+            locators = cache.order(locators, login['target'], login['url'], version)
+
+        if fill == "fast":
+            with metrics.span("login_fast_fill", target=login['target']):
+                fast = web_login_fast(browser, locators, login)
+            if fast:
+                if cache is not None:
+                    cache.store(login['target'], login['url'], version, fast)
+                return True
+
+        # User: Find and fill user input
+        with metrics.span("login_find_element", target=login['target'],
+                          field="user"):
+            e, found['user'] = find_element_chain(browser, locators['user'],
+                                                  login['target'], "user")
+        e.clear()
+        e.send_keys(login['user'])
+
+        # Password: Find and fill password input
+        with metrics.span("login_find_element", target=login['target'],
+                          field="pw"):
+            e, found['pw'] = find_element_chain(browser, locators['pw'],
+                                                login['target'], "pw")
+        e.clear()
+        e.send_keys(login['pw'])
+
+        # Submit: Find and click submit button
+        with metrics.span("login_find_element", target=login['target'],
+                          field="submit"):
+            e, found['submit'] = find_element_chain(browser, locators['submit'],
+                                                    login['target'], "submit")
+        if cache is not None:
+            cache.store(login['target'], login['url'], version, found)
+        logging.info("Trying to log into " + login['url'])
+        with metrics.span("login_submit", target=login['target']):
+            e.click()
+    except WebDriverException as e:
+        logging.error("Failed to fill login form on " + login['url']
+                      + ": " + str(e).strip())
         return False
+
+    return True
+
+
+# Options for browser setup as collected from the command line
+# Prefs keeping Firefox from updating, reporting and fetching
+# anything on its own, shared by all presets but default
+prefs_quiet = {
+    "app.normandy.enabled":                            False,
+    "app.update.auto":                                 False,
+    "app.update.checkInstallTime":                     False,
+    "browser.discovery.enabled":                       False,
+    "browser.newtabpage.enabled":                      False,
+    "browser.ping-centre.telemetry":                   False,
+    "browser.safebrowsing.blockedURIs.enabled":        False,
+    "browser.safebrowsing.downloads.enabled":          False,
+    "browser.safebrowsing.downloads.remote.enabled":   False,
+    "browser.safebrowsing.malware.enabled":            False,
+    "browser.safebrowsing.phishing.enabled":           False,
+    "browser.search.update":                           False,
+    "browser.shell.checkDefaultBrowser":               False,
+    "browser.startup.homepage":                        "about:blank",
+    "browser.startup.page":                            0,
+    "datareporting.healthreport.uploadEnabled":        False,
+    "datareporting.policy.dataSubmissionEnabled":      False,
+    "extensions.getAddons.cache.enabled":              False,
+    "extensions.pocket.enabled":                       False,
+    "extensions.update.enabled":                       False,
+    "media.gmp-manager.updateEnabled":                 False,
+    "network.captive-portal-service.enabled":          False,
+    "network.connectivity-service.enabled":            False,
+    "network.dns.disablePrefetch":                     True,
+    "network.http.speculative-parallel-limit":         0,
+    "network.predictor.enabled":                       False,
+    "network.prefetch-next":                           False,
+    "toolkit.telemetry.archive.enabled":               False,
+    "toolkit.telemetry.enabled":                       False,
+    "toolkit.telemetry.unified":                       False
+}
+
+# Keep the cache in memory and session history off the disk
+prefs_memory_cache = {
+    "browser.cache.disk.enable":                       False,
+    "browser.cache.memory.enable":                     True,
+    "browser.cache.memory.capacity":                   65536,
+    "browser.sessionstore.interval":                   3600000,
+    "browser.sessionstore.resume_from_crash":          False
+}
+
+prefs_drm = {
+    "media.eme.enabled":                               True,
+    "media.gmp-manager.updateEnabled":                 True,
+    "media.gmp-widevinecdm.enabled":                   True,
+    "media.gmp-widevinecdm.visible":                   True
+}
+
+# Named sets of prefs and window settings, selected with --browser-profile
+# headless, fullscreen and drm are enabled by a preset or the options
+# Per-session RSS and CPU of the presets are measured by the profiles
+# benchmark of webdriver_bench.py with --driver firefox
+profile_presets = {
+    "default": {
+        "prefs": {}
+    },
+    # Many headless capture sessions per host: one content process,
+    # no animations or autoplay and a fixed viewport for screenshots
+    "lean-headless": {
+        "headless":    True,
+        "window_size": [1280, 720],
+        "prefs": dict(prefs_quiet, **prefs_memory_cache, **{
+            "dom.ipc.processCount":                    1,
+            "dom.ipc.processCount.webIsolated":        1,
+            "dom.ipc.processPrelaunch.enabled":        False,
+            "fission.autostart":                       False,
+            "image.animation_mode":                    "none",
+            "media.autoplay.default":                  5,
+            "toolkit.cosmeticAnimations.enabled":      False,
+            "ui.prefersReducedMotion":                 1
+        })
+    },
+    # Dashboards shown around the clock on a screen
+    "kiosk": {
+        "fullscreen":  True,
+        "prefs": dict(prefs_quiet, **prefs_memory_cache, **{
+            "browser.tabs.warnOnClose":                False,
+            "dom.ipc.processCount":                    2,
+            "full-screen-api.transition-duration.enter": "0 0",
+            "full-screen-api.transition-duration.leave": "0 0",
+            "full-screen-api.warning.timeout":         0,
+            "toolkit.cosmeticAnimations.enabled":      False
+        })
+    },
+    # Playback of DRM protected media, keeping the CDM up to date
+    "drm-media": {
+        "drm":         True,
+        "window_size": [1920, 1080],
+        "prefs": dict(prefs_quiet, **prefs_memory_cache, **prefs_drm, **{
+            "media.autoplay.default":                  0
+        })
+    }
+}
+
+
+# The preset name with prefs from the files in prefs_files applied on top
+# Raises ValueError for unknown presets and files not holding a mapping
+def profile_preset(name, prefs_files=None):
+    if name not in profile_presets:
+        raise ValueError("Unknown profile preset: " + str(name)
+                         + ", use one of " + ", ".join(profile_presets))
+
+    preset = copy.deepcopy(profile_presets[name])
+    for path in prefs_files or []:
+        prefs = load_data_file(path)
+        if not isinstance(prefs, dict):
+            raise ValueError(path + ": Prefs must be a mapping of pref to value")
+        preset["prefs"].update(prefs)
+
+    return preset
+
+
+# Prefs of template profiles: enable the extensions placed in the profile
+# without asking
+prefs_template = {
+    "extensions.autoDisableScopes":                    0,
+    "extensions.enabledScopes":                        15
+}
+
+# Files of a running Firefox not to carry over into clones
+profile_lock_files = {"lock", ".parentlock", "parent.lock"}
+
+
+# The add-on id declared in the manifest of the extension at path, or None
+def extension_id(path):
+    import zipfile
+
+    try:
+        with zipfile.ZipFile(path) as xpi:
+            manifest = json.loads(xpi.read("manifest.json"))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
+    settings = (manifest.get("browser_specific_settings")
+                or manifest.get("applications") or {})
+
+    return settings.get("gecko", {}).get("id")
+
+
+# Template profiles with prefs applied, extensions in place and,
+# with DRM enabled, the CDM downloaded, built once per hash of their
+# inputs and cloned for every session
+# Clones share the extension and CDM files of the template by hardlinks
+class ProfileCache:
+
+    def __init__(self, path, cdm_timeout_s=120):
+        self.path = path
+        self.cdm_timeout_s = cdm_timeout_s
+        self.lock = threading.Lock()
+        self.digests = {}
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+    def digest(self, path):
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+        if key not in self.digests:
+            with open(path, "rb") as f:
+                self.digests[key] = hashlib.sha256(f.read()).hexdigest()
+
+        return self.digests[key]
+
+    # Hash of everything going into a template, including the
+    # Firefox binary as profiles are migrated on upgrades
+    def key(self, browser_options, extensions):
+        firefox = browser_options.get('firefox_binary') or which('firefox') or ""
+        if firefox:
+            firefox = os.path.realpath(firefox)
+        inputs = {
+            "prefs":      browser_options.get('prefs') or {},
+            "drm":        bool(browser_options['drm']),
+            "firefox":    [firefox, os.stat(firefox).st_mtime_ns if firefox else 0],
+            "extensions": sorted(self.digest(ext) for ext in extensions)
+        }
+
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True)
+                              .encode("utf-8")).hexdigest()[:32]
+
+    # The template for browser_options and extensions, built if missing,
+    # and the extensions without an id that still need installing per session
+    def template(self, browser_options, extensions):
+        import shutil
+        import tempfile
+
+        path = os.path.join(self.path, self.key(browser_options, extensions))
+        remaining = [ext for ext in extensions if extension_id(ext) is None]
+
+        with self.lock:
+            if os.path.isdir(path):
+                return path, remaining
+
+            logging.info("profile: Building template " + path)
+            tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + ".",
+                                   dir=self.path)
+            try:
+                with metrics.span("profile_template"):
+                    self.build(tmp, browser_options, extensions)
+                os.rename(tmp, path)
+            except OSError:
+                shutil.rmtree(tmp, ignore_errors=True)
+                # Built by another process in the meantime
+                if not os.path.isdir(path):
+                    raise
+            except BaseException:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+
+        return path, remaining
+
+    def build(self, path, browser_options, extensions):
+        import shutil
+
+        prefs = dict(browser_options.get('prefs') or {}, **prefs_template)
+        if browser_options['drm']:
+            prefs.update(prefs_drm)
+        with open(os.path.join(path, "user.js"), "w") as f:
+            for name, value in sorted(prefs.items()):
+                f.write("user_pref(" + json.dumps(name) + ", "
+                        + json.dumps(value) + ");\n")
+
+        os.makedirs(os.path.join(path, "extensions"))
+        for ext in extensions:
+            addon_id = extension_id(ext)
+            if addon_id is not None:
+                shutil.copyfile(ext, os.path.join(path, "extensions",
+                                                  addon_id + ".xpi"))
+
+        self.warm(path, browser_options)
+
+        return True
+
+    # Start Firefox once on the template so that clones find registered
+    # extensions and, with DRM enabled, the downloaded CDM
+    def warm(self, path, browser_options):
+        warm_options = dict(browser_options,
+                            profile_cache=None,
+                            profile_dir=path,
+                            prefs={},
+                            headless=True,
+                            fullscreen=False,
+                            window_size=None,
+                            page_load_strategy=None)
+        browser = gecko_browser_setup(warm_options, [])
+        try:
+            if browser_options['drm']:
+                cdm = os.path.join(path, "gmp-widevinecdm")
+                t_end = time.monotonic() + self.cdm_timeout_s
+                while not any(files for _, _, files in os.walk(cdm)):
+                    if time.monotonic() > t_end:
+                        logging.warning("profile: CDM was not downloaded within "
+                                        + str(self.cdm_timeout_s) + "s")
+                        break
+                    time.sleep(1)
+        finally:
+            browser.quit()
+
+        return True
+
+    # A private copy of template, hardlinking files Firefox does not modify
+    def clone(self, template):
+        import shutil
+        import tempfile
+
+        clone = tempfile.mkdtemp(prefix="webdriver-util-profile-")
+        with metrics.span("profile_clone"):
+            for root, dirs, files in os.walk(template):
+                rel = os.path.relpath(root, template)
+                target = os.path.normpath(os.path.join(clone, rel))
+                os.makedirs(target, exist_ok=True)
+                top = rel.split(os.sep)[0]
+                shared = top == "extensions" or top.startswith("gmp-")
+                for name in files:
+                    if name in profile_lock_files:
+                        continue
+                    src = os.path.join(root, name)
+                    dst = os.path.join(target, name)
+                    if shared:
+                        try:
+                            os.link(src, dst)
+                            continue
+                        except OSError:
+                            pass
+                    shutil.copy2(src, dst)
+
+        return clone
+
+
+def browser_options_from_args(args, log_level):
+    preset = profile_preset(args.browser_profile, args.browser_prefs_files)
+
+    return {
+        "gecko_logfile":          args.gecko_logfile,
+        "log_level":              log_level,
+        "profile":                args.browser_profile,
+        "prefs":                  preset["prefs"],
+        "window_size":            preset.get("window_size"),
+        "headless":               args.browser_headless or preset.get("headless", False),
+        "fullscreen":             args.browser_fullscreen or preset.get("fullscreen", False),
+        "ready":                  args.browser_ready,
+        "ready_timeout":          args.browser_ready_timeout,
+        "drm":                    args.browser_drm or preset.get("drm", False),
+        "profile_cache":          (ProfileCache(args.profile_cache)
+                                   if args.profile_cache else None),
+        "close":                  args.browser_close,
+        "fast_open":              args.browser_fast_open,
+        "fast_open_concurrency":  args.browser_fast_open_concurrency,
+        "login_fill":             args.login_fill,
+        "login_engine":           args.login_engine,
+        "locator_cache":          (LocatorCache(args.locator_cache)
+                                   if args.locator_cache else None),
+        # Optional explicit paths to bypass Selenium Manager
+        "geckodriver_path":       args.geckodriver_path or os.getenv('GECKODRIVER'),
+        "firefox_binary":         args.firefox_binary or os.getenv('FIREFOX_BIN'),
+    }
+
+
+# Start geckodriver and firefox
+def gecko_browser_setup(browser_options, extensions):
+    from selenium import webdriver
+    from selenium.webdriver.firefox.options import Options
+    from selenium.webdriver.firefox.service import Service
+
+    # Start from a clone of the cached template, which already
+    # holds the prefs, the extensions with an id and the CDM
+    profile_cache = browser_options.get('profile_cache')
+    if profile_cache is not None:
+        template, extensions = profile_cache.template(browser_options, extensions)
+        browser_options = dict(browser_options,
+                               profile_dir=profile_cache.clone(template),
+                               prefs={})
+
+    options = Options()
+    geckodriver_path = browser_options.get('geckodriver_path')
+    firefox_binary = browser_options.get('firefox_binary')
+
+    # Explicit Firefox binary prevents Selenium Manager browser resolution
+    if firefox_binary:
+        options.binary_location = firefox_binary
+
+    # Providing geckodriver path prevents Selenium Manager driver resolution:
+    # Did not work for linux/aarch64
+    if geckodriver_path:
+        service = Service(executable_path=geckodriver_path, log_path=os.devnull)
     else:
-        url_logout = url + path_logout[target]
-        browser.get(url_logout)
+        service = Service(log_path=os.devnull)
+
+    service.log_path = os.devnull
+    options.log.level = browser_options['log_level']
+
+    if browser_options['headless']:
+        options.add_argument("-headless")
+
+    # geckodriver uses a profile given by argument in place
+    if browser_options.get('profile_dir'):
+        options.add_argument("-profile")
+        options.add_argument(browser_options['profile_dir'])
+
+    for name, value in browser_options.get('prefs', {}).items():
+        options.set_preference(name, value)
+
+    # "none" returns from navigation without waiting for the page load
+    if browser_options.get('page_load_strategy'):
+        options.page_load_strategy = browser_options['page_load_strategy']
+
+    if browser_options["drm"]:
+        options.set_preference("media.gmp-manager.updateEnabled", True)
+        options.set_preference("media.eme.enabled", True)
+
+    window_size = browser_options.get('window_size')
+    if window_size and browser_options['headless']:
+        options.add_argument("--width=" + str(window_size[0]))
+        options.add_argument("--height=" + str(window_size[1]))
+
+    with metrics.span("browser_setup"):
+        browser = webdriver.Firefox(options=options,
+                                    service=service)
+
+    # Remove the clone once the session is gone
+    if profile_cache is not None:
+        import shutil
+        import weakref
+        weakref.finalize(browser, shutil.rmtree,
+                         browser_options['profile_dir'], True)
+
+    with metrics.span("install_extensions"):
+        install_extensions(browser, extensions)
+
+    if browser_options['fullscreen']:
+        browser.fullscreen_window()
+    elif window_size:
+        browser.set_window_size(*window_size)
+
+    return browser
+
+
+# Pids of pid and all its descendants, read from /proc
+def process_tree(pid):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/" + entry + "/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, []))
+
+    return pids
+
+
+# Resident memory in bytes and CPU time in seconds used by pid
+# and its descendants, like geckodriver with its firefox processes
+def process_tree_usage(pid):
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    ticks = os.sysconf("SC_CLK_TCK")
+    rss, cpu_s = 0, 0.0
+    for p in process_tree(pid):
+        try:
+            with open("/proc/" + str(p) + "/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        cpu_s += (int(fields[11]) + int(fields[12])) / ticks
+        rss += int(fields[21]) * page_size
+
+    return rss, cpu_s
+
+
+def install_extensions(browser, extensions):
+    for ext in extensions:
+        browser.install_addon(ext, temporary=True)
+
+    return True
+
+
+# Clear cookies and storage of the document loaded in the current window
+def clear_session_state(browser):
+    browser.delete_all_cookies()
+    browser.execute_script("try { localStorage.clear(); "
+                           "sessionStorage.clear(); } catch (e) {}")
+
+
+# The scheme and host of url, None for pages like about:blank
+def url_origin(url):
+    u = urlsplit(url or "")
+    if not u.netloc:
+        return None
+
+    return u.scheme + "://" + u.netloc
+
+
+# A pool of pre-warmed browser sessions
+# Sessions are started in the background, reset between uses
+# and recycled after max_uses, when older than max_age_s or
+# after visiting more than one origin
+class SessionPool:
+
+    def __init__(self,
+                 browser_options,
+                 extensions,
+                 size=2,
+                 max_uses=50,
+                 max_age_s=3600,
+                 prewarm=None,
+                 spawn_attempts=3):
+
+        self.browser_options = browser_options
+        self.extensions = extensions
+        self.size = size
+        self.max_uses = max_uses
+        self.max_age_s = max_age_s
+        self.spawn_attempts = spawn_attempts
+        self.idle = queue.Queue()
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=size)
+
+        # Sessions beyond prewarm are only started once needed
+        prewarm = size if prewarm is None else min(prewarm, size)
+        self.cold = size - prewarm
+        logging.info("pool: Warming " + str(prewarm) + " of " + str(size) + " sessions")
+        for _ in range(prewarm):
+            self.warm()
+
+    def warm(self):
+        self.executor.submit(self.spawn)
+
+    # Start a session, retrying with backoff up to spawn_attempts times
+    # If all attempts fail the error is queued in place of the session,
+    # so that a waiting acquire fails with it instead of timing out
+    def spawn(self):
+        t0 = time.monotonic()
+        for attempt in range(self.spawn_attempts):
+            try:
+                browser = gecko_browser_setup(self.browser_options,
+                                              self.extensions)
+                break
+            except WebDriverException as e:
+                logging.error("pool: Failed to start session: " + str(e).strip())
+                error = e
+            if attempt + 1 < self.spawn_attempts and self.closing.wait(2 ** attempt):
+                return None
+        else:
+            self.idle.put(error)
+            return None
+
+        t_ms = int(round((time.monotonic() - t0) * 1000))
+        logging.info("pool: Session " + browser.session_id
+                     + " warmed in " + str(t_ms) + " ms")
+        with self.lock:
+            self.sessions[browser.session_id] = {
+                "uses":    0,
+                "created": time.monotonic(),
+                "origins": set()
+            }
+        self.idle.put(browser)
+
+        return browser
+
+    def healthy(self, browser):
+        try:
+            return len(browser.window_handles) > 0
+        except WebDriverException:
+            return False
+
+    def expired(self, browser):
+        session = self.sessions[browser.session_id]
+        if session["uses"] >= self.max_uses:
+            return True
+        return time.monotonic() - session["created"] >= self.max_age_s
+
+    # Hand out an idle session, replacing dead ones on the way and
+    # starting a cold one when none is idle
+    # Raises queue.Empty if no session became available within timeout_s,
+    # or the WebDriverException of a session that failed to start
+    def acquire(self, timeout_s=120):
+        while True:
+            with self.lock:
+                if self.cold and self.idle.empty():
+                    self.cold -= 1
+                    self.warm()
+            browser = self.idle.get(timeout=timeout_s)
+            if isinstance(browser, WebDriverException):
+                # Try again for the next caller
+                self.warm()
+                raise browser
+            if self.healthy(browser):
+                with self.lock:
+                    self.sessions[browser.session_id]["uses"] += 1
+                logging.debug("pool: Acquired session " + browser.session_id)
+                return browser
+
+            logging.warning("pool: Session " + browser.session_id
+                            + " failed health check, recycling")
+            self.retire(browser)
+            self.warm()
+
+    # Note that a session loaded url, so its origin counts as visited
+    def visit(self, browser, url):
+        with self.lock:
+            session = self.sessions.get(browser.session_id)
+            if session is not None:
+                session["origins"].add(url_origin(url))
+
+        return True
+
+    # Return a session to the pool
+    def release(self, browser):
+        if not self.healthy(browser) or self.expired(browser):
+            logging.info("pool: Recycling session " + browser.session_id)
+            self.retire(browser)
+            self.warm()
+            return True
+
+        try:
+            origins = self.reset(browser)
+        except WebDriverException as e:
+            logging.warning("pool: Failed to reset session "
+                            + browser.session_id + ": " + str(e))
+            self.retire(browser)
+            self.warm()
+            return True
+
+        # Only the state of the origins loaded last is cleared,
+        # cookies of the others would leak into the next job
+        if len(origins) > 1:
+            logging.info("pool: Recycling session " + browser.session_id
+                         + " after visiting " + str(len(origins)) + " origins")
+            self.retire(browser)
+            self.warm()
+            return True
+
+        self.idle.put(browser)
+
+        return True
+
+    # Close all but the first window, clearing cookies and storage
+    # of every document before leaving it
+    # Returns the origins visited since the last reset
+    def reset(self, browser):
+        with self.lock:
+            session = self.sessions.get(browser.session_id, {})
+            origins = session.get("origins", set())
+            session["origins"] = set()
+
+        handles = browser.window_handles
+        for handle in handles[1:]:
+            browser.switch_to.window(handle)
+            origins.add(url_origin(browser.current_url))
+            clear_session_state(browser)
+            browser.close()
+        browser.switch_to.window(handles[0])
+        origins.add(url_origin(browser.current_url))
+        clear_session_state(browser)
+        browser.get("about:blank")
+        origins.discard(None)
+
+        return origins
+
+    def retire(self, browser):
+        with self.lock:
+            self.sessions.pop(browser.session_id, None)
+        try:
+            browser.quit()
+        except WebDriverException:
+            pass
+
+    def close(self):
+        self.closing.set()
+        self.executor.shutdown(wait=True)
+        while not self.idle.empty():
+            browser = self.idle.get()
+            if not isinstance(browser, WebDriverException):
+                self.retire(browser)
+
+        return True
+
+
+# Encode PNG screenshot data to img_format: png, jpeg or webp
+def screenshot_encode(png, img_format, quality):
+    if img_format == "png":
+        return png
+
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(png))
+    if img_format == "jpeg":
+        img = img.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format=img_format.upper(), quality=quality)
+
+    return buf.getvalue()
+
+
+# Detects changes between screenshots on a downscaled grayscale copy
+# Frames are compared tile by tile against the last changed frame,
+# a tile changed when its mean absolute difference exceeds threshold
+class FrameDiff:
+
+    def __init__(self, scale=4, tile=16, threshold=8):
+        import numpy
+        from PIL import Image
+
+        self.np = numpy
+        self.image = Image
+        self.scale = scale
+        self.tile = tile
+        self.threshold = threshold
+        self.last = None
+
+    def gray(self, png):
+        img = self.image.open(io.BytesIO(png)).convert("L")
+        if self.scale > 1:
+            img = img.reduce(self.scale)
+
+        return self.np.asarray(img, dtype=self.np.int16)
+
+    # Returns the bounding boxes of changed regions in screenshot
+    # pixels as (x0, y0, x1, y1), an empty list if nothing changed
+    def compare(self, png):
+        np = self.np
+        frame = self.gray(png)
+
+        if self.last is None or self.last.shape != frame.shape:
+            self.last = frame
+            h, w = frame.shape
+            return [(0, 0, w * self.scale, h * self.scale)]
+
+        # Mean difference per tile, partial tiles at the edges are padded
+        t = self.tile
+        h, w = frame.shape
+        ph, pw = -h % t, -w % t
+        diff = np.abs(frame - self.last)
+        diff = np.pad(diff, ((0, ph), (0, pw)))
+        tiles = diff.reshape((h + ph) // t, t, (w + pw) // t, t).mean(axis=(1, 3))
+        changed = tiles > self.threshold
+
+        if not changed.any():
+            return []
+
+        self.last = frame
+
+        return [(x0 * t * self.scale, y0 * t * self.scale,
+                 min(x1 * t, w) * self.scale, min(y1 * t, h) * self.scale)
+                for x0, y0, x1, y1 in tile_regions(changed)]
+
+
+# Bounding boxes (x0, y0, x1, y1) in tiles of the 8-connected
+# groups of changed tiles
+def tile_regions(changed):
+    rows, cols = changed.shape
+    seen = set()
+    regions = []
+
+    for y, x in zip(*changed.nonzero()):
+        if (y, x) in seen:
+            continue
+        seen.add((y, x))
+        stack = [(y, x)]
+        x0, y0, x1, y1 = x, y, x + 1, y + 1
+        while stack:
+            cy, cx = stack.pop()
+            x0, y0 = min(x0, cx), min(y0, cy)
+            x1, y1 = max(x1, cx + 1), max(y1, cy + 1)
+            for ny in range(max(cy - 1, 0), min(cy + 2, rows)):
+                for nx in range(max(cx - 1, 0), min(cx + 2, cols)):
+                    if changed[ny, nx] and (ny, nx) not in seen:
+                        seen.add((ny, nx))
+                        stack.append((ny, nx))
+        regions.append((int(x0), int(y0), int(x1), int(y1)))
+
+    return regions
+
+
+# Count the DOM mutations of the page since the last call, observing
+# the document from the first call on, which counts as a change
+js_mutations = """
+if (!window.__webdriverUtilMutations) {
+    window.__webdriverUtilMutations = {count: 1};
+    new MutationObserver(function (records) {
+        window.__webdriverUtilMutations.count += records.length;
+    }).observe(document, {subtree: true, childList: true,
+                          attributes: true, characterData: true});
+}
+var count = window.__webdriverUtilMutations.count;
+window.__webdriverUtilMutations.count = 0;
+return count;
+"""
+
+
+# CPU and memory pressure of the host, sampled at most every sample_s
+# seconds and shared by all sessions of the process
+# CPU load is the busy share of /proc/stat since the last sample,
+# memory load the share of memory not available
+# stretch() turns it into a factor from 1 below the low marks
+# to max_stretch at the high marks for intervals to be multiplied by
+class HostPressure:
+
+    def __init__(self, cpu_marks=(0.6, 0.95), memory_marks=(0.8, 0.95),
+                 max_stretch=4, sample_s=1):
+        self.cpu_marks = cpu_marks
+        self.memory_marks = memory_marks
+        self.max_stretch = max_stretch
+        self.sample_s = sample_s
+        self.cpu_times = None
+        self.load = {"cpu": 0.0, "memory": 0.0}
+        self.t_sample = 0
+        self.lock = threading.Lock()
+
+    def sample(self):
+        try:
+            with open("/proc/stat") as f:
+                times = [int(v) for v in f.readline().split()[1:]]
+            with open("/proc/meminfo") as f:
+                meminfo = {line.split(":")[0]: int(line.split()[1]) for line in f}
+        except (OSError, ValueError, IndexError):
+            return self.load
+
+        # idle and iowait
+        idle, total = times[3] + times[4], sum(times)
+        if self.cpu_times is not None and total > self.cpu_times[1]:
+            self.load["cpu"] = 1 - (idle - self.cpu_times[0]) / (total - self.cpu_times[1])
+        self.cpu_times = (idle, total)
+        if meminfo.get("MemTotal"):
+            self.load["memory"] = 1 - meminfo.get("MemAvailable", 0) / meminfo["MemTotal"]
+        for kind, value in self.load.items():
+            metrics.set("host_load", round(value, 3), kind=kind)
+
+        return self.load
+
+    def stretch(self):
+        with self.lock:
+            if time.monotonic() - self.t_sample >= self.sample_s:
+                self.sample()
+                self.t_sample = time.monotonic()
+            load = dict(self.load)
+
+        x = 0.0
+        for value, (low, high) in ((load["cpu"], self.cpu_marks),
+                                   (load["memory"], self.memory_marks)):
+            x = max(x, min(max((value - low) / (high - low), 0), 1))
+
+        return 1 + (self.max_stretch - 1) * x
+
+
+host_pressure = HostPressure()
+
+
+# Interval between captures adapting to page activity within min_s
+# and max_s: halved on every change, growing by a quarter for every
+# unchanged frame, then stretched by the host pressure
+class AdaptiveSchedule:
+
+    def __init__(self, min_s, max_s, pressure=None):
+        if not 0 <= min_s <= max_s:
+            raise ValueError("Adaptive interval needs 0 <= min <= max")
+
+        self.min_s = min_s
+        self.max_s = max_s
+        self.pressure = pressure or host_pressure
+        self.interval_s = min_s
+
+    def observe(self, changed):
+        if changed:
+            self.interval_s = max(self.min_s, self.interval_s / 2)
+        else:
+            self.interval_s = min(self.max_s, max(self.interval_s, 0.01) * 1.25)
+
+    def next_s(self):
+        t_s = min(self.max_s, self.interval_s * self.pressure.stretch())
+        metrics.set("capture_interval_seconds", round(t_s, 3))
+
+        return t_s
+
+
+# Whether the page changed since the last frame: by the DOM mutations
+# counted in the page, or by a tile of the frame differing beyond the
+# threshold of diff, a FrameDiff, so blinking carets and clocks don't count
+def page_changed(browser, activity, png, diff):
+    if activity == "mutations":
+        return int(browser.execute_script(js_mutations) or 0) > 0
+
+    return bool(diff.compare(png))
+
+
+# Encodes and writes screenshots in background threads
+# The last ring_size frames are kept as image_0000 to image_<ring_size - 1>,
+# frames arriving while max_pending frames are queued are dropped
+# With a FrameDiff, unchanged frames are dropped and the changed regions
+# of the others are appended to changes.jsonl
+# A warning is logged when nothing changed for freeze_s seconds
+class ScreenshotPipeline:
+
+    def __init__(self,
+                 img_path,
+                 img_format="png",
+                 quality=85,
+                 ring_size=100,
+                 workers=2,
+                 max_pending=None,
+                 diff=None,
+                 freeze_s=0,
+                 sinks=None,
+                 files=True):
+
+        if img_format not in ("png", "jpeg", "webp"):
+            raise ValueError("Unsupported screenshot format: " + img_format)
+        if img_format != "png":
+            # Fail early when Pillow is missing
+            import PIL  # noqa: F401
+
+        self.img_path = Path(img_path)
+        self.img_format = img_format
+        self.quality = quality
+        self.ring_size = ring_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = threading.BoundedSemaphore(max_pending or 2 * workers)
+        self.diff = diff
+        self.freeze_s = freeze_s
+        self.sinks = sinks or []
+        self.files = files
+        self.t_changed = time.monotonic()
+        self.frozen = False
+        self.seq = 0
+        self.lock = threading.Lock()
+        # Frames are compared in order on a single thread
+        self.diff_executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = {}
+        self.stats_reset()
+
+        if files:
+            self.img_path.mkdir(parents=True, exist_ok=True)
+
+    def stats_reset(self):
+        self.stats = {
+            "captured":   0,
+            "written":    0,
+            "dropped":    0,
+            "unchanged":  0,
+            "capture_ms": 0.0,
+            "diff_ms":    0.0,
+            "encode_ms":  0.0
+        }
+
+    def stats_add(self, key, value):
+        with self.lock:
+            self.stats[key] += value
+        if not key.endswith("_ms"):
+            metrics.inc("frames", value, state=key)
+
+    def filename(self, n):
+        ext = "jpg" if self.img_format == "jpeg" else self.img_format
+        return self.img_path / ("image_" + str(n % self.ring_size).zfill(4)
+                                + "." + ext)
+
+    # Hand frame n to the sinks and queue it for encoding,
+    # returns False if it was dropped
+    def submit(self, n, png):
+        self.stats_add("captured", 1)
+        for sink in self.sinks:
+            sink.put(png)
+        if not self.files and self.diff is None:
+            return True
+
+        if not self.pending.acquire(blocking=False):
+            self.stats_add("dropped", 1)
+            logging.debug("screenshot: Dropping frame " + str(n))
+            return False
+
+        if self.diff is None:
+            self.executor.submit(self.write, n, png)
+        else:
+            self.diff_executor.submit(self.compare, png)
+
+        return True
+
+    def compare(self, png):
+        t0 = time.monotonic()
+        try:
+            regions = self.diff.compare(png)
+        except Exception as e:
+            logging.error("screenshot: Failed to compare frame: " + str(e))
+            regions = None
+        self.stats_add("diff_ms", (time.monotonic() - t0) * 1000)
+
+        if regions == []:
+            self.stats_add("unchanged", 1)
+            self.pending.release()
+            if (self.freeze_s and not self.frozen
+                    and time.monotonic() - self.t_changed >= self.freeze_s):
+                self.frozen = True
+                logging.warning("screenshot: Page froze, no change for "
+                                + str(self.freeze_s) + " s")
+            return False
+
+        n = self.seq
+        self.seq += 1
+        self.t_changed = time.monotonic()
+        if self.frozen:
+            self.frozen = False
+            logging.info("screenshot: Page changed again")
+        if regions and self.files:
+            self.record_changes(n, regions)
+        if self.files:
+            self.executor.submit(self.write, n, png)
+        else:
+            self.pending.release()
+
+        return True
+
+    def record_changes(self, n, regions):
+        logging.info("screenshot: Page changed in " + str(len(regions))
+                     + " regions: " + str(regions))
+        change = {
+            "time": time.time(),
+            "file": self.filename(n).name,
+            "regions": regions
+        }
+        with open(self.img_path / "changes.jsonl", 'a') as f:
+            f.write(json.dumps(change) + "\n")
+
+    def write(self, n, png):
+        try:
+            t0 = time.monotonic()
+            data = screenshot_encode(png, self.img_format, self.quality)
+            filename = self.filename(n)
+            filename_tmp = filename.with_name("." + filename.name + ".tmp")
+            filename_tmp.write_bytes(data)
+            os.replace(filename_tmp, filename)
+            self.stats_add("encode_ms", (time.monotonic() - t0) * 1000)
+            self.stats_add("written", 1)
+            logging.debug("Browser screenshot saved to: " + str(filename))
+        except Exception as e:
+            logging.error("screenshot: Failed to write frame "
+                          + str(n) + ": " + str(e))
+        finally:
+            self.pending.release()
+
+    # Log frame rate and latencies over the last t_s seconds
+    def report(self, t_s):
+        with self.lock:
+            stats = self.stats
+            self.stats_reset()
+
+        captured = max(stats["captured"], 1)
+        written = max(stats["written"], 1)
+        logging.info("screenshot: "
+                     + "{:.2f}".format(stats["captured"] / t_s) + " fps, "
+                     + "capture " + str(int(stats["capture_ms"] / captured))
+                     + " ms, diff " + str(int(stats["diff_ms"] / captured))
+                     + " ms, encode " + str(int(stats["encode_ms"] / written))
+                     + " ms, " + str(stats["dropped"]) + " dropped, "
+                     + str(stats["unchanged"]) + " unchanged")
+
+        return stats
+
+    def close(self):
+        self.diff_executor.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
+        for sink in self.sinks:
+            sink.close()
+
+        return True
+
+
+# Tile PNG frames row by row into one PNG, cells sized to the largest frame
+def grid_composite(pngs, columns=0):
+    import numpy as np
+    from PIL import Image
+
+    frames = [np.asarray(Image.open(io.BytesIO(png)).convert("RGB"))
+              for png in pngs]
+    columns = columns or math.ceil(math.sqrt(len(frames)))
+    rows = -(-len(frames) // columns)
+    height = max(frame.shape[0] for frame in frames)
+    width = max(frame.shape[1] for frame in frames)
+
+    grid = np.zeros((rows * height, columns * width, 3), dtype=np.uint8)
+    for k, frame in enumerate(frames):
+        row, column = divmod(k, columns)
+        grid[row * height:row * height + frame.shape[0],
+             column * width:column * width + frame.shape[1]] = frame
+
+    buf = io.BytesIO()
+    Image.fromarray(grid).save(buf, format="PNG", compress_level=1)
+
+    return buf.getvalue()
+
+
+# Captures every window of browser once per cycle of t_cycle_s seconds
+# With mode "composite", the frames of a cycle are tiled into one image
+# for pipeline, with "tabs" every window has a pipeline of its own
+# A cycle ends within its interval: windows whose capture would not fit
+# in the remaining time keep their frame of the last cycle, starting
+# each cycle at another window so none is always left out
+# With an AdaptiveSchedule the interval follows the activity of all windows
+class GridCapture:
+
+    def __init__(self, browser, t_cycle_s, mode, pipelines, columns=0,
+                 schedule=None, activity="frames", diff_threshold=8):
+        if mode not in ("composite", "tabs"):
+            raise ValueError("Unsupported grid mode: " + mode)
+
+        self.browser = browser
+        self.t_cycle_s = t_cycle_s
+        self.schedule = schedule
+        self.activity = activity
+        self.diff_threshold = diff_threshold
+        # A FrameDiff per window to tell its activity by
+        self.diffs = {}
+        self.changed = False
+        self.mode = mode
+        self.pipelines = pipelines
+        self.columns = columns
+        self.frames = {}
+        self.stats = {}
+        self.start = 0
+        # Composites are built on one thread, dropping cycles it can not keep up with
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.compositing = threading.Semaphore(1)
+
+    def tab_stats(self, handle):
+        if handle not in self.stats:
+            self.stats[handle] = {"captured": 0, "stale": 0,
+                                  "capture_ms": 0.0, "max_ms": 0.0,
+                                  "estimate_ms": 0.0}
+
+        return self.stats[handle]
+
+    def cycle(self, n):
+        handles = self.browser.window_handles
+        t_end = time.monotonic() + self.t_cycle_s
+        self.start = (self.start + 1) % len(handles)
+
+        for handle in handles[self.start:] + handles[:self.start]:
+            stats = self.tab_stats(handle)
+            if (handle in self.frames and self.t_cycle_s > 0
+                    and time.monotonic() + stats["estimate_ms"] / 1000 > t_end):
+                stats["stale"] += 1
+                continue
+
+            t0 = time.monotonic()
+            with metrics.span("screenshot_capture", tab=handles.index(handle)):
+                self.browser.switch_to.window(handle)
+                png = self.browser.get_screenshot_as_png()
+            t_ms = (time.monotonic() - t0) * 1000
+            if self.schedule is not None:
+                if handle not in self.diffs and self.activity == "frames":
+                    self.diffs[handle] = FrameDiff(threshold=self.diff_threshold)
+                # Every window's diff has to see its frames, changed or not
+                changed = page_changed(self.browser, self.activity, png,
+                                       self.diffs.get(handle))
+                self.changed = self.changed or changed
+            self.frames[handle] = png
+            stats["captured"] += 1
+            stats["capture_ms"] += t_ms
+            stats["max_ms"] = max(stats["max_ms"], t_ms)
+            stats["estimate_ms"] = (t_ms if not stats["estimate_ms"]
+                                    else 0.8 * stats["estimate_ms"] + 0.2 * t_ms)
+
+        pngs = [self.frames[handle] for handle in handles]
+        if self.mode == "tabs":
+            for k, png in enumerate(pngs):
+                if k < len(self.pipelines):
+                    self.pipelines[k].submit(n, png)
+        elif self.compositing.acquire(blocking=False):
+            self.executor.submit(self.composite, n, pngs)
+        else:
+            self.pipelines[0].stats_add("dropped", 1)
+
+        return True
+
+    def composite(self, n, pngs):
+        try:
+            with metrics.span("screenshot_composite"):
+                png = grid_composite(pngs, self.columns)
+            self.pipelines[0].submit(n, png)
+        except Exception as e:
+            logging.error("screenshot: Failed to build composite: " + str(e))
+        finally:
+            self.compositing.release()
+
+    # Log per window capture latency over the last report
+    def report(self):
+        handles = self.browser.window_handles
+        order = {handle: k for k, handle in enumerate(handles)}
+        for handle, stats in sorted(self.stats.items(),
+                                    key=lambda item: order.get(item[0], len(order))):
+            tab = order.get(handle, "closed")
+            captured = max(stats["captured"], 1)
+            logging.info("screenshot: tab " + str(tab) + " capture "
+                         + str(int(stats["capture_ms"] / captured)) + " ms, max "
+                         + str(int(stats["max_ms"])) + " ms, "
+                         + str(stats["stale"]) + " stale")
+            stats.update(captured=0, stale=0, capture_ms=0.0, max_ms=0.0)
+
+    def run(self, max_cycles=None, report_s=10):
+        n = 0
+        t_next = time.monotonic()
+        t_report = t_next
+
+        while max_cycles is None or n < max_cycles:
+            self.cycle(n)
+            n += 1
+
+            if self.schedule is not None:
+                self.schedule.observe(self.changed)
+                self.changed = False
+                self.t_cycle_s = self.schedule.next_s()
+
+            t_next += self.t_cycle_s
+            now = time.monotonic()
+            if self.t_cycle_s > 0 and t_next <= now:
+                t_next += (int((now - t_next) / self.t_cycle_s) + 1) * self.t_cycle_s
+
+            if now - t_report >= report_s:
+                for pipeline in self.pipelines:
+                    pipeline.report(now - t_report)
+                self.report()
+                t_report = now
+
+            time.sleep(max(t_next - now, 0))
+
+        self.executor.shutdown(wait=True)
+        for pipeline in self.pipelines:
+            pipeline.close()
+
+        return True
+
+
+# Holds the latest frame for consumers running at their own pace
+# put never blocks, consumers waiting for a newer frame skip the
+# frames they were too slow for
+class FrameSlot:
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.frame = None
+        self.closed = False
+
+    def put(self, frame):
+        with self.cond:
+            self.seq += 1
+            self.frame = frame
+            self.cond.notify_all()
+
+    # The newest frame after seq as (seq, frame), (seq, None) on timeout
+    # and (None, None) once closed
+    def wait(self, seq, timeout_s=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > seq or self.closed, timeout_s)
+            if self.closed:
+                return None, None
+            if self.seq <= seq:
+                return seq, None
+
+            return self.seq, self.frame
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+        return True
+
+
+# Serves the latest frame as MJPEG over HTTP on host:port
+# Frames are encoded once, on a single thread and only while
+# someone watches, for all viewers
+class MjpegStream:
+
+    boundary = "frame"
+
+    def __init__(self, listen, quality=75):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        # Fail early when Pillow is missing
+        import PIL  # noqa: F401
+
+        self.quality = quality
+        self.frames = FrameSlot()
+        self.jpegs = FrameSlot()
+        self.viewers = 0
+        self.lock = threading.Lock()
+        stream = self
+
+        class MjpegHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path == "/frame.jpg":
+                    return self.frame()
+                if self.path not in ("/", "/stream.mjpg"):
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "multipart/x-mixed-replace; boundary="
+                                 + stream.boundary)
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+
+                with stream.lock:
+                    stream.viewers += 1
+                seq = 0
+                try:
+                    while True:
+                        seq, jpeg = stream.jpegs.wait(seq, timeout_s=5)
+                        if seq is None:
+                            return
+                        if jpeg is None:
+                            continue
+                        self.wfile.write(("--" + stream.boundary + "\r\n"
+                                          "Content-Type: image/jpeg\r\n"
+                                          "Content-Length: " + str(len(jpeg))
+                                          + "\r\n\r\n").encode("ascii"))
+                        self.wfile.write(jpeg)
+                        self.wfile.write(b"\r\n")
+                except OSError:
+                    pass
+                finally:
+                    with stream.lock:
+                        stream.viewers -= 1
+
+            def frame(self):
+                _, png = stream.frames.wait(-1, timeout_s=0)
+                if png is None:
+                    self.send_error(503, "No frame captured yet")
+                    return
+                jpeg = screenshot_encode(png, "jpeg", stream.quality)
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(jpeg)))
+                self.end_headers()
+                self.wfile.write(jpeg)
+
+            def log_message(self, format, *args):
+                logging.debug("mjpeg: " + format % args)
+
+        host, _, port = listen.rpartition(":")
+        self.server = ThreadingHTTPServer((host or "127.0.0.1", int(port)),
+                                          MjpegHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self.encode, daemon=True).start()
+        logging.info("mjpeg: Streaming on http://" + listen + "/stream.mjpg")
+
+    def put(self, png):
+        self.frames.put(png)
+
+    def encode(self):
+        seq = 0
+        while True:
+            seq, png = self.frames.wait(seq, timeout_s=1)
+            if seq is None:
+                return
+            if png is None or not self.viewers:
+                continue
+            try:
+                with metrics.span("mjpeg_encode"):
+                    self.jpegs.put(screenshot_encode(png, "jpeg", self.quality))
+            except Exception as e:
+                logging.error("mjpeg: Failed to encode frame: " + str(e))
+
+    def close(self):
+        self.frames.close()
+        self.jpegs.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+        return True
+
+
+# Pipes the latest frame at a constant fps into ffmpeg, which writes
+# video segments of segment_s seconds into path
+# The last frame is repeated when capture is slower than fps,
+# frames are skipped when ffmpeg is slower
+class SegmentWriter:
+
+    def __init__(self,
+                 path,
+                 fps,
+                 segment_s=60,
+                 ffmpeg="ffmpeg",
+                 codec_args=("-c:v", "libx264", "-preset", "veryfast",
+                             "-pix_fmt", "yuv420p")):
+        import subprocess
+
+        Path(path).mkdir(parents=True, exist_ok=True)
+        self.fps = fps
+        self.frames = FrameSlot()
+        self.skipped = 0
+        command = [ffmpeg, "-loglevel", "error",
+                   "-f", "image2pipe", "-framerate", str(fps), "-i", "-",
+                   *codec_args,
+                   # Even dimensions for yuv420p
+                   "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+                   "-f", "segment", "-segment_time", str(segment_s),
+                   "-reset_timestamps", "1", "-strftime", "1",
+                   os.path.join(path, "%Y%m%d-%H%M%S.mp4")]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.thread = threading.Thread(target=self.feed, daemon=True)
+        self.thread.start()
+        logging.info("video: Writing " + str(segment_s) + " s segments to " + path)
+
+    def put(self, png):
+        self.frames.put(png)
+
+    def feed(self):
+        seq, png = self.frames.wait(0)
+        t_next = time.monotonic()
+        while png is not None:
+            try:
+                self.process.stdin.write(png)
+            except OSError as e:
+                logging.error("video: ffmpeg stopped accepting frames: " + str(e))
+                return
+
+            t_next += 1 / self.fps
+            now = time.monotonic()
+            if t_next <= now:
+                missed = int((now - t_next) * self.fps) + 1
+                self.skipped += missed
+                t_next += missed / self.fps
+            newer_seq, newer = self.frames.wait(seq, timeout_s=t_next - now)
+            if newer_seq is None:
+                return
+            if newer is not None:
+                seq, png = newer_seq, newer
+                time.sleep(max(t_next - time.monotonic(), 0))
+
+    def close(self):
+        self.frames.close()
+        self.thread.join()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+        if self.skipped:
+            logging.info("video: Skipped " + str(self.skipped) + " frames")
+
+        return True
+
+
+# Rotates through browser tabs on a monotonic schedule
+# Each tab is shown for its dwell time, tabs with a higher weight are
+# shown more often per cycle. Tabs marked for refresh are reloaded
+# refresh_ahead_s before they are shown next, which brings them to
+# the front for a moment as WebDriver can only script the selected tab
+# Tabs can be added and removed from other threads while running,
+# the changes are applied by the rotation thread which owns the browser
+class TabRotation:
+
+    def __init__(self, browser, dwell_s=5, refresh_ahead_s=0, dwell_max_s=0,
+                 refresh_adaptive=False):
+        self.browser = browser
+        self.dwell_s = dwell_s
+        self.refresh_ahead_s = refresh_ahead_s
+        self.dwell_max_s = dwell_max_s
+        self.refresh_adaptive = refresh_adaptive
+        self.tabs = []
+        self.commands = queue.Queue()
+        self.wakeup = threading.Event()
+        self.stop = threading.Event()
+        self.watchdog = None
+
+    def tab(self, handle):
+        for tab in self.tabs:
+            if tab["handle"] == handle:
+                return tab
+
+        return None
+
+    # Take over a window that is already open
+    def adopt(self, handle, url, dwell_s=None, weight=1, refresh=False):
+        self.tabs.append({
+            "handle":  handle,
+            "url":     url,
+            "dwell_s": dwell_s or self.dwell_s,
+            "weight":  weight,
+            "refresh": refresh,
+            "live":    False,
+            "current": 0
+        })
+
+        return handle
+
+    def call(self, fn, *args, **kwargs):
+        future = Future()
+        self.commands.put((future, fn, args, kwargs))
+        self.wakeup.set()
+
+        return future
+
+    # Open url in a new tab and add it to the rotation
+    # Returns a future resolving to the window handle
+    def add_tab(self, url, dwell_s=None, weight=1, refresh=False):
+        return self.call(self.open, url, dwell_s, weight, refresh)
+
+    # Close the tab of handle and remove it from the rotation
+    def remove_tab(self, handle):
+        return self.call(self.close_tab, handle)
+
+    # The new tab loads in the background, it is only in front
+    # while the navigation is started
+    def open(self, url, dwell_s, weight, refresh):
+        visible = self.browser.current_window_handle
+        self.browser.switch_to.new_window('tab')
+        self.browser.execute_script("location.href = arguments[0];", url)
+        handle = self.adopt(self.browser.current_window_handle,
+                            url, dwell_s, weight, refresh)
+        self.browser.switch_to.window(visible)
+        logging.info("rotation: Added tab " + url)
+
+        return handle
+
+    def close_tab(self, handle):
+        tab = self.tab(handle)
+        if tab is None or len(self.tabs) == 1:
+            return False
+
+        visible = self.browser.current_window_handle
+        self.browser.switch_to.window(handle)
+        self.browser.close()
+        self.tabs.remove(tab)
+        if visible != handle:
+            self.browser.switch_to.window(visible)
+        else:
+            self.browser.switch_to.window(self.tabs[0]["handle"])
+        logging.info("rotation: Removed tab " + tab["url"])
+
+        return True
+
+    def process_commands(self):
+        while True:
+            try:
+                future, fn, args, kwargs = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+    # Smooth weighted round robin
+    def next_tab(self):
+        total = sum(tab["weight"] for tab in self.tabs)
+        for tab in self.tabs:
+            tab["current"] += tab["weight"]
+        tab = max(self.tabs, key=lambda t: t["current"])
+        tab["current"] -= total
+
+        return tab
+
+    # Dwell time of tab, stretched under host pressure up to dwell_max_s
+    def dwell(self, tab):
+        if self.dwell_max_s <= tab["dwell_s"]:
+            return tab["dwell_s"]
+
+        return min(self.dwell_max_s, tab["dwell_s"] * host_pressure.stretch())
+
+    # Reload a background tab without waiting for the load to finish,
+    # switching back right away to keep its flash as short as possible
+    def refresh(self, tab):
+        visible = self.browser.current_window_handle
+        self.browser.switch_to.window(tab["handle"])
+        self.browser.execute_script("setTimeout(function() { location.reload(); }, 0);")
+        self.browser.switch_to.window(visible)
+        logging.debug("rotation: Refreshing " + tab["url"])
+
+    def shutdown(self):
+        self.stop.set()
+        self.wakeup.set()
+
+        return True
+
+    # Sleep until t while applying commands as they arrive
+    def sleep_until(self, t):
+        while not self.stop.is_set():
+            remaining = t - time.monotonic()
+            if remaining <= 0:
+                return True
+            if self.wakeup.wait(remaining):
+                self.wakeup.clear()
+                self.process_commands()
+
+        return False
+
+    def run(self):
+        t_next = time.monotonic()
+        upcoming = None
+
+        while not self.stop.is_set():
+            self.process_commands()
+            if self.watchdog is not None:
+                self.watchdog.check(self)
+            if upcoming not in self.tabs:
+                if not self.tabs:
+                    self.wakeup.wait()
+                    continue
+                upcoming = self.next_tab()
+
+            tab = upcoming
+            if tab["handle"] != self.browser.current_window_handle:
+                shown = self.tab(self.browser.current_window_handle)
+                # Tabs updating themselves while shown need no reloads
+                if self.refresh_adaptive and shown is not None:
+                    shown["live"] = int(self.browser.execute_script(js_mutations) or 0) > 0
+                with metrics.span("tab_switch"):
+                    self.browser.switch_to.window(tab["handle"])
+                # Reloads asked for while the tab was in the background
+                if tab.pop("reload", False):
+                    self.browser.execute_script("location.reload();")
+                if self.refresh_adaptive:
+                    self.browser.execute_script(js_mutations)
+                logging.debug("rotation: Showing " + tab["url"])
+            upcoming = self.next_tab()
+
+            dwell_s = self.dwell(tab)
+            t_next += dwell_s
+            # Start over when we fell behind by more than a dwell time
+            if t_next < time.monotonic():
+                t_next = time.monotonic() + dwell_s
+
+            if (self.refresh_ahead_s > 0 and upcoming is not tab
+                    and upcoming["refresh"] and not upcoming["live"]):
+                if not self.sleep_until(t_next - self.refresh_ahead_s):
+                    break
+                if upcoming in self.tabs:
+                    self.refresh(upcoming)
+
+            self.sleep_until(t_next)
+
+        return True
+
+
+# Samples memory of a rotating session between tab switches and keeps it
+# within limits: reloads a tab when the resident memory of geckodriver and
+# firefox exceeds reload_mb or the JS heap of a tab exceeds heap_mb,
+# restarts the session of the Browser session beyond restart_mb
+# Samples and recycle events are appended as JSON lines to log_path
+class MemoryWatchdog:
+
+    def __init__(self,
+                 session,
+                 interval_s=60,
+                 reload_mb=0,
+                 restart_mb=0,
+                 heap_mb=0,
+                 log_path=None,
+                 trend_samples=60):
+        self.session = session
+        self.interval_s = interval_s
+        self.reload_mb = reload_mb
+        self.restart_mb = restart_mb
+        self.heap_mb = heap_mb
+        self.log_path = log_path
+        self.samples = collections.deque(maxlen=trend_samples)
+        self.t_next = time.monotonic() + interval_s
+        self.reloads = 0
+        self.restarts = 0
+
+    # Resident memory of the driver process tree, None without a local driver
+    def rss(self, browser):
+        try:
+            pid = browser.service.process.pid
+        except AttributeError:
+            return None
+
+        return process_tree_usage(pid)[0]
+
+    # JS heap of the visible tab where the browser exposes it
+    def heap(self, browser):
+        return browser.execute_script(
+            "return window.performance && performance.memory"
+            " ? performance.memory.usedJSHeapSize : null;")
+
+    # Growth of resident memory in MiB per hour over the kept samples
+    def trend(self):
+        if len(self.samples) < 2:
+            return 0.0
+        n = len(self.samples)
+        t_mean = sum(t for t, _ in self.samples) / n
+        m_mean = sum(m for _, m in self.samples) / n
+        var = sum((t - t_mean) ** 2 for t, _ in self.samples)
+        if var == 0:
+            return 0.0
+        cov = sum((t - t_mean) * (m - m_mean) for t, m in self.samples)
+
+        return cov / var * 3600 / 2**20
+
+    def record(self, event):
+        event["time"] = round(time.time(), 3)
+        if self.log_path:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(event) + "\n")
+
+    def check(self, rotation):
+        if time.monotonic() < self.t_next:
+            return False
+        self.t_next = time.monotonic() + self.interval_s
+
+        browser = rotation.browser
+        tab = rotation.tab(browser.current_window_handle)
+        try:
+            rss = self.rss(browser)
+            heap = self.heap(browser)
+        except WebDriverException as e:
+            logging.warning("watchdog: Session unresponsive: " + str(e).strip())
+            return self.restart(rotation, "unresponsive")
+
+        if tab is not None and heap is not None:
+            tab["heap"] = heap
+            metrics.set("memory_bytes", heap, kind="heap", url=tab["url"])
+        if rss is not None:
+            self.samples.append((time.monotonic(), rss))
+            metrics.set("memory_bytes", rss, kind="rss")
+        logging.info("watchdog: rss " + str(round((rss or 0) / 2**20)) + " MiB, "
+                     + "trend " + str(round(self.trend(), 1)) + " MiB/h")
+        self.record({"event": "sample", "rss": rss, "heap": heap,
+                     "url": tab["url"] if tab else None})
+
+        if rss is not None and self.restart_mb and rss > self.restart_mb * 2**20:
+            return self.restart(rotation, "rss")
+
+        if self.heap_mb:
+            for t in rotation.tabs:
+                if t.get("heap", 0) > self.heap_mb * 2**20:
+                    return self.reload(rotation, t, "heap")
+
+        if rss is not None and self.reload_mb and rss > self.reload_mb * 2**20:
+            # The tab with the largest known heap, else the one reloaded longest ago
+            t = min(rotation.tabs,
+                    key=lambda t: (-t.get("heap", 0), t.get("reloaded", 0)))
+            return self.reload(rotation, t, "rss")
+
+        return True
+
+    # Background tabs are reloaded as they are shown next,
+    # switching to them now would flash them
+    def reload(self, rotation, tab, reason):
+        if tab["handle"] == rotation.browser.current_window_handle:
+            rotation.browser.refresh()
+        else:
+            tab["reload"] = True
+        tab["reloaded"] = time.monotonic()
+        tab.pop("heap", None)
+        self.reloads += 1
+        metrics.inc("recycles", action="reload", reason=reason)
+        logging.warning("watchdog: Reloaded " + tab["url"] + " (" + reason + ")")
+        self.record({"event": "reload", "reason": reason, "url": tab["url"]})
+
+        return True
+
+    # New session with the urls of all tabs, keeping their rotation state
+    def restart(self, rotation, reason):
+        urls = [tab["url"] for tab in rotation.tabs]
+        with metrics.span("session_restart"):
+            handles = self.session.restart(urls)
+        rotation.browser = self.session.browser
+        for tab, handle in zip(rotation.tabs, handles):
+            tab["handle"] = handle
+            tab.pop("heap", None)
+        self.samples.clear()
+        self.restarts += 1
+        metrics.inc("recycles", action="restart", reason=reason)
+        logging.warning("watchdog: Restarted session (" + reason + ")")
+        self.record({"event": "restart", "reason": reason})
+
+        return True
+
+
+# Cookies and localStorage of the document in the current window
+def session_state_save(browser):
+    return {
+        "cookies": browser.get_cookies(),
+        "local_storage": browser.execute_script(
+            "var s = {};"
+            "for (var i = 0; i < localStorage.length; i++) {"
+            "  var k = localStorage.key(i); s[k] = localStorage.getItem(k);"
+            "}"
+            "return s;")
+    }
+
+
+# Open url and inject saved cookies and localStorage into its document
+def session_state_restore(browser, url, state):
+    browser.get(url)
+    for cookie in state["cookies"]:
+        try:
+            browser.add_cookie(cookie)
+        except WebDriverException:
+            logging.debug("Skipping cookie for " + str(cookie.get("domain")))
+    browser.execute_script(
+        "for (var k in arguments[0]) {"
+        "  localStorage.setItem(k, arguments[0][k]);"
+        "}", state["local_storage"])
+    browser.get(url)
+
+
+# Encrypted on-disk cache of authenticated session state
+# keyed by (target, url, user)
+# Entries expire after ttl_s, the least recently used ones
+# are evicted beyond max_entries
+class SessionCache:
+
+    def __init__(self, path, key=None, ttl_s=3600, max_entries=100):
+        from cryptography.fernet import Fernet
+
+        self.path = Path(path)
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        self.path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if key is None:
+            key = self.load_key(Fernet)
+        self.fernet = Fernet(key)
+
+    # Read the key from the cache directory, creating it on first use
+    def load_key(self, fernet):
+        path_key = self.path / "key"
+        try:
+            fd = os.open(path_key, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            return path_key.read_bytes()
+
+        key = fernet.generate_key()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+
+        return key
+
+    def entry_path(self, target, url, user):
+        h = hashlib.sha256("\0".join([target, url, user]).encode("utf-8"))
+        return self.path / (h.hexdigest() + ".session")
+
+    def load(self, target, url, user):
+        from cryptography.fernet import InvalidToken
+
+        path = self.entry_path(target, url, user)
+        try:
+            token = path.read_bytes()
+            state = json.loads(self.fernet.decrypt(token, ttl=self.ttl_s))
+        except FileNotFoundError:
+            return None
+        except (InvalidToken, ValueError):
+            logging.debug("session cache: Dropping expired or invalid entry")
+            self.drop(target, url, user)
+            return None
+
+        # Mark as recently used
+        os.utime(path)
+
+        return state
+
+    def store(self, target, url, user, state):
+        path = self.entry_path(target, url, user)
+        path_tmp = path.with_suffix(".tmp." + str(threading.get_ident()))
+        token = self.fernet.encrypt(json.dumps(state).encode("utf-8"))
+
+        fd = os.open(path_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(token)
+        os.replace(path_tmp, path)
+        self.evict()
+
+        return True
+
+    def drop(self, target, url, user):
+        try:
+            self.entry_path(target, url, user).unlink()
+        except FileNotFoundError:
+            pass
+
+        return True
+
+    def evict(self):
+        with self.lock:
+            now = time.time()
+            entries = []
+            for path in self.path.glob("*.session"):
+                try:
+                    entries.append((path.stat().st_mtime, path))
+                except FileNotFoundError:
+                    pass
+            entries.sort(reverse=True)
+            for k, (mtime, path) in enumerate(entries):
+                if k >= self.max_entries or now - mtime >= self.ttl_s:
+                    path.unlink(missing_ok=True)
+
+        return True
+
+
+# Keep-alive HTTP connections shared by all threads, by scheme and host
+class HttpPool:
+
+    def __init__(self, timeout_s=30, max_idle=8):
+        self.timeout_s = timeout_s
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    # An idle connection to netloc or a new one, with whether it is reused
+    def connection(self, scheme, netloc):
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+
+        import http.client
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout_s), False
+
+        return http.client.HTTPConnection(netloc, timeout=self.timeout_s), False
+
+    # Keep conn for reuse unless max_idle connections are idle already
+    def put(self, scheme, netloc, conn):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    # Returns (status, headers, body), retrying once when a
+    # reused connection was closed by the server in the meantime
+    # Broken connections are closed rather than put back
+    def request(self, method, url, body=None, headers=None):
+        import http.client
+
+        u = urlsplit(url)
+        path = (u.path or "/") + ("?" + u.query if u.query else "")
+        for attempt in range(2):
+            conn, reused = self.connection(u.scheme, u.netloc)
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                r = conn.getresponse()
+                data = r.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            if r.will_close:
+                conn.close()
+            else:
+                self.put(u.scheme, u.netloc, conn)
+
+            return r.status, r.msg, data
+
+
+http_pool = HttpPool()
+
+
+# Collects the forms of a page with their input fields
+class FormParser(HTMLParser):
+
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {k: v if v is not None else "" for k, v in attrs}
+        if tag == "form":
+            self.forms.append({"action": attrs.get("action", ""),
+                               "method": attrs.get("method", "get").lower(),
+                               "fields": []})
+        elif tag in ("input", "button", "select", "textarea") and self.forms:
+            attrs["tag"] = tag
+            self.forms[-1]["fields"].append(attrs)
+
+
+# Simple css selectors that resolve without a DOM: #id, [name=...]
+css_simple = re.compile(r"""^(?:form\s+)?[\w-]*(?:#([\w-]+)|\[(\w+)=['"]?([^'"\]]*)['"]?\])$""")
+
+
+# The field of form matching the first possible locator of a chain,
+# None if no locator can be resolved without a DOM
+def form_field(form, chain):
+    for method, value in chain:
+        if method == "css selector":
+            m = css_simple.match(value)
+            if m is None:
+                continue
+            method, value = ("id", m.group(1)) if m.group(1) else m.group(2, 3)
+        for field in form["fields"]:
+            if method in ("id", "name", "type") and field.get(method) == value:
+                return field
+
+    return None
+
+
+# Whether a page still contains a password field, as a login form does
+def form_has_password(html):
+    parser = FormParser()
+    parser.feed(html)
+
+    return any(field.get("type") == "password"
+               for form in parser.forms for field in form["fields"])
+
+
+# Cookies of jar in the format of WebDriver
+def jar_cookies(jar):
+    cookies = []
+    for c in jar:
+        cookie = {"name": c.name, "value": c.value, "path": c.path,
+                  "secure": c.secure}
+        # Host-only cookies must stay host-only in the browser
+        if c.domain_specified:
+            cookie["domain"] = c.domain
+        if c.expires:
+            cookie["expiry"] = int(c.expires)
+        cookies.append(cookie)
+
+    return cookies
+
+
+# Log in by posting the login form without a browser: fetch the form,
+# keep its hidden fields like CSRF tokens, fill in the credentials and
+# follow the redirects, then apply the target's success predicate, or
+# without one, require the password form to be gone
+# Returns a dict with ok, final_url, cookies and error where ok is None
+# when the login needs a browser
+def http_login(login, html_login, pool=None, max_redirects=10):
+    import http.client
+    import http.cookiejar
+    import urllib.request
+
+    pool = pool or http_pool
+    jar = http.cookiejar.CookieJar()
+    result = {"ok": None, "final_url": None, "cookies": [], "error": None}
+
+    class Response:
+        def __init__(self, headers):
+            self.headers = headers
+
+        def info(self):
+            return self.headers
+
+    def fetch(method, url, body=None):
+        for _ in range(max_redirects):
+            req = urllib.request.Request(url, method=method)
+            jar.add_cookie_header(req)
+            headers = dict(req.header_items())
+            if body is not None:
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+            status, msg, data = pool.request(method, url, body, headers)
+            jar.extract_cookies(Response(msg), req)
+            if status not in (301, 302, 303, 307, 308) or not msg.get("Location"):
+                return status, url, data.decode("utf-8", "replace")
+            url = urljoin(url, msg["Location"])
+            if status not in (307, 308):
+                method, body = "GET", None
+        raise ValueError("Too many redirects")
+
+    try:
+        locators = target_login_locators(login['target'], html_login)
+        _, url, html = fetch("GET", login['url'])
+
+        parser = FormParser()
+        parser.feed(html)
+        fields = None
+        for form in parser.forms:
+            fields = {k: form_field(form, locators[k]) for k in ("user", "pw")}
+            if fields["user"] is not None and fields["pw"] is not None:
+                break
+        else:
+            result["error"] = "No login form without JS"
+            return result
+
+        data = []
+        for field in form["fields"]:
+            name = field.get("name")
+            kind = field.get("type", "submit" if field["tag"] == "button" else "text")
+            if not name or kind in ("submit", "image", "button", "reset", "file"):
+                continue
+            if kind in ("checkbox", "radio") and "checked" not in field:
+                continue
+            value = field.get("value", "")
+            if field is fields["user"]:
+                value = login['user']
+            elif field is fields["pw"]:
+                value = login['pw']
+            data.append((name, value))
+        submit = form_field(form, locators["submit"])
+        if submit is not None and submit.get("name"):
+            data.append((submit["name"], submit.get("value", "")))
+
+        action = urljoin(url, form["action"] or url)
+        body = urlencode(data).encode("utf-8")
+        if form["method"] == "post":
+            status, final_url, html = fetch("POST", action, body)
+        else:
+            a = urlsplit(action)
+            query = "&".join(q for q in (a.query, body.decode("ascii")) if q)
+            status, final_url, html = fetch("GET", urlunsplit(a._replace(query=query)))
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        result["error"] = type(e).__name__ + ": " + str(e).strip()
+        return result
+
+    t = targets.get(login['target'])
+    if t is not None and t["validate"] is not None:
+        ok = t["validate"](final_url, login['url'])
+    else:
+        ok = status < 400 and not form_has_password(html)
+    result.update(ok=ok, final_url=final_url, cookies=jar_cookies(jar))
+    if not ok:
+        result["error"] = "Login validation failed"
+
+    return result
+
+
+# The engine to log into target with: http for targets known to
+# work without JS, or all targets when forced
+def login_engine(target, engine):
+    if engine == "auto":
+        t = targets.get(target)
+        return "http" if t is not None and t["engine"] == "http" else "browser"
+
+    return engine or "browser"
+
+
+# Log in, reusing the cached session of (target, url, user)
+# as long as it still validates, otherwise fill the login form
+# Returns whether the login validated
+def web_login_cached(browser, browser_options, login, html_login,
+                     cache=None, ready=None):
+    key = (login['target'], login['url'], login['user'])
+    if ready is None:
+        ready = readiness_login(login['target'], login['url'])
+
+    if cache is not None:
+        state = cache.load(*key)
+        if state is not None:
+            logging.info("Restoring cached session for " + login['url'])
+            with metrics.span("login_restore", target=login['target']):
+                session_state_restore(browser, login['url'], state)
+                wait_until(browser, ready, browser_options['ready_timeout'],
+                           what="cached login")
+            # Without a validate predicate only the login form being
+            # gone tells a live session from a stale one
+            if (web_validate_login(login['target'], browser.current_url, login['url'])
+                    and not form_has_password(browser.page_source)):
+                metrics.inc("logins", target=login['target'], result="cached")
+                return True
+            logging.info("Cached session was rejected, logging in")
+            cache.drop(*key)
+            browser.delete_all_cookies()
+
+    # Seed the session with the cookies of a login over plain HTTP
+    if login_engine(login['target'], browser_options.get('login_engine')) == "http":
+        with metrics.span("login_http", target=login['target']):
+            result = http_login(login, html_login)
+        if result["ok"]:
+            state = {"cookies": result["cookies"], "local_storage": {}}
+            with metrics.span("login_restore", target=login['target']):
+                session_state_restore(browser, login['url'], state)
+                wait_until(browser, ready, browser_options['ready_timeout'],
+                           what="http login")
+            # The seeded session must show the app, not the login form again
+            if (web_validate_login(login['target'], browser.current_url, login['url'])
+                    and not form_has_password(browser.page_source)):
+                metrics.inc("logins", target=login['target'], result="http")
+                if cache is not None:
+                    cache.store(*key, state)
+                return True
+            browser.delete_all_cookies()
+        logging.info("HTTP login not usable for " + login['url'] + ": "
+                     + str(result["error"] or "session rejected")
+                     + ", logging in with the browser")
+
+    if not web_login(browser, browser_options, login, html_login):
+        metrics.inc("logins", target=login['target'], result="failed")
+        return False
+    with metrics.span("login_validate", target=login['target']):
+        wait_until(browser, ready, browser_options['ready_timeout'],
+                   what="login")
+        ok = web_validate_login(login['target'],
+                                browser.current_url,
+                                login['url'])
+    if not ok:
+        metrics.inc("logins", target=login['target'], result="failed")
+        return False
+
+    metrics.inc("logins", target=login['target'], result="ok")
+    if cache is not None:
+        cache.store(*key, session_state_save(browser))
+
+    return True
+
+
+class Browser:
+
+    def __init__(self,
+                 args,
+                 log_level,
+                 target_registry,
+                 extensions,
+                 url_releases_geckodriver,
+                 pool=None,
+                 session_cache=None):
+
+        self.url_releases_geckodriver = "https://github.com/mozilla/geckodriver/releases/"
+        self.extensions = extensions
+        self.pool = pool
+        self.session_cache = session_cache
+        self.login = {}
+        self.logged_in = None
+
+        self.browser_options = browser_options_from_args(args, log_level)
+
+        self.target = args.target
+        self.urls = args.urls
+        self.perform_login = True
+
+        login_pw = args.login_pw
+        login_pw_base64 = False
+
+        if login_pw and login_pw_base64:
+            login_pw = base64.b64decode(login_pw).decode("utf-8")
+
+        if self.target == "":
+            self.target = "unknown"
+        elif self.target not in target_registry:
+            logging.error("Unknown target: " + self.target)
+            sys.exit(1)
+        else:
+            logging.info("Browser target: " + self.target)
+
+        self.login["target"] = self.target
+        self.login["urls"] = self.urls
+        self.login["url"] = self.urls[0]
+        self.login["url_payload"] = args.url_payload
+        self.login["user"] = args.login_user
+        self.login["pw"] = login_pw
+
+        if not self.login["user"]:
+            self.perform_login = False
+
+        html_login = {
+            "selector_user":          args.selector_user,
+            "selector_pw":            args.selector_pw,
+            "selector_submit":        args.selector_submit,
+            "selector_value_user":    args.selector_value_user,
+            "selector_value_pw":      args.selector_value_pw,
+            "selector_value_submit":  args.selector_value_submit
+        }
+
+        self.html_login = html_login
+
+        if self.perform_login:
+            try:
+                target_login_locators(self.target, html_login)
+            except ValueError as e:
+                logging.error(str(e))
+                sys.exit(1)
+
+        # Tabs are opened without waiting for their page loads
+        fast_open = (self.browser_options['fast_open']
+                     and not self.perform_login
+                     and self.pool is None)
+        if fast_open:
+            self.browser_options['page_load_strategy'] = "none"
+
+        # Take a warm session from the pool if there is one
+        if self.pool is not None:
+            self.browser = self.pool.acquire()
+            for url in self.urls + [self.login['url_payload']]:
+                self.pool.visit(self.browser, url)
+        else:
+            self.browser = self.gecko_browser_setup()
+        browser = self.browser
+
+        # Wait for the given readiness condition, or pick one by target
+        ready = None
+        if self.browser_options['ready'] != "auto":
+            ready = readiness_condition(self.browser_options['ready'])
+            if ready is None:
+                logging.error("Invalid readiness condition: "
+                              + self.browser_options['ready'])
+                sys.exit(1)
+        self.ready = ready
+
+        if self.perform_login:
+            logging.info("Performing Login")
+            self.logged_in = web_login_cached(browser,
+                                              self.browser_options,
+                                              self.login,
+                                              html_login,
+                                              self.session_cache,
+                                              ready)
+        elif fast_open:
+            self.open_tabs_fast(self.urls,
+                                self.browser_options['fast_open_concurrency'],
+                                self.browser_options['ready_timeout'])
+            if ready is not None:
+                wait_until(browser, ready,
+                           self.browser_options['ready_timeout'], what="page")
+        else:
+            nurls = len(self.urls)
+            logging.info("browser: Opening " + str(nurls) + " URLs")
+            self.get_url(self.urls[0])
+            if nurls > 1:
+                for k, url in enumerate(self.urls):
+                    if k > 0:
+                        self.open_tab_with_url(url)
+            if ready is None:
+                ready = ready_document
+            wait_until(browser, ready,
+                       self.browser_options['ready_timeout'], what="page")
+
+        if self.perform_login:
+            if not self.logged_in:
+                logging.error("Failed to log into "
+                              + self.login['target'] + " on: " + self.login['url'])
+            else:
+                logging.info("Successfully logged into "
+                             + self.login['target'] + " on: " + self.login['url'])
+
+            # Open payload
+            if not self.login['url_payload']:
+                logging.info("No payload supplied")
+            else:
+                logging.info("Opening payload: " + self.login['url_payload'])
+                with metrics.span("payload"):
+                    browser.get(self.login['url_payload'])
+
+            if self.browser_options['close']:
+                logging.info("Logging out of " + self.login['url'])
+                web_logout(browser,
+                           self.login['target'],
+                           self.login['url'])
+                if self.session_cache is not None:
+                    self.session_cache.drop(self.login['target'],
+                                            self.login['url'],
+                                            self.login['user'])
+                if self.pool is None:
+                    browser.close()
+
+    # Replace the session by a new one, logging in again in the first tab
+    # and opening urls[1:] in tabs of their own, or all urls without login
+    # Returns the window handles in the order of urls
+    def restart(self, urls):
+        try:
+            self.browser.quit()
+        except WebDriverException as e:
+            logging.warning("browser: Failed to end session: " + str(e).strip())
+
+        self.browser = self.gecko_browser_setup()
+        if self.perform_login:
+            self.logged_in = web_login_cached(self.browser,
+                                              self.browser_options,
+                                              self.login,
+                                              self.html_login,
+                                              self.session_cache,
+                                              self.ready)
+            if self.login['url_payload']:
+                self.browser.get(self.login['url_payload'])
+        else:
+            self.browser.get(urls[0])
+
+        handles = [self.browser.current_window_handle]
+        for url in urls[1:]:
+            self.browser.switch_to.new_window('tab')
+            self.browser.get(url)
+            handles.append(self.browser.current_window_handle)
+        self.browser.switch_to.window(handles[0])
+
+        return handles
+
+    # Hand the session back to the pool or end it
+    def release(self):
+        if self.pool is not None:
+            self.pool.release(self.browser)
+        else:
+            self.browser.quit()
+
+        return True
+
+    def get_url(self, url):
+        logging.debug("browser: Requesting " + url)
+        self.browser.get(url)
+        return True
+
+    def open_tab_with_url(self, url):
+        self.browser.switch_to.new_window('tab')
+        self.get_url(url)
+
+        return True
+
+    # Open every URL in its own tab, starting the next navigation while
+    # up to concurrency pages are still loading
+    # Needs the "none" page load strategy so navigation does not block
+    # Returns the load time of each URL in ms, None if it timed out
+    def open_tabs_fast(self, urls, concurrency, timeout_s, poll_s=0.05):
+        t_start = time.monotonic()
+        pending = list(urls)
+        loading = {}
+        load_ms = {}
+        first = self.browser.current_window_handle
+
+        logging.info("browser: Opening " + str(len(urls)) + " URLs, "
+                     + str(concurrency) + " at a time")
+
+        while pending or loading:
+            while pending and len(loading) < concurrency:
+                url = pending.pop(0)
+                if len(load_ms) + len(loading) > 0:
+                    self.browser.switch_to.new_window('tab')
+                loading[self.browser.current_window_handle] = (url, time.monotonic())
+                self.get_url(url)
+
+            now = time.monotonic()
+            for handle, (url, t0) in list(loading.items()):
+                self.browser.switch_to.window(handle)
+                try:
+                    ready = ready_document(self.browser)
+                except WebDriverException:
+                    ready = False
+                if ready:
+                    load_ms[url] = int(round((time.monotonic() - t0) * 1000))
+                    logging.debug("browser: " + url + " loaded in "
+                                  + str(load_ms[url]) + " ms")
+                    del loading[handle]
+                elif now - t0 >= timeout_s:
+                    load_ms[url] = None
+                    logging.warning("browser: " + url + " not loaded after "
+                                    + str(timeout_s) + " s")
+                    del loading[handle]
+
+            if loading:
+                time.sleep(poll_s)
+
+        self.browser.switch_to.window(first)
+
+        t_ms = int(round((time.monotonic() - t_start) * 1000))
+        logging.info("browser: Opened all tabs after " + str(t_ms) + " ms")
+        for url in urls:
+            logging.info("browser: " + url + ": "
+                         + (str(load_ms[url]) + " ms"
+                            if load_ms[url] is not None else "timed out"))
+
+        return load_ms
+
+    def gecko_browser_setup(self):
+        return gecko_browser_setup(self.browser_options, self.extensions)
+
+    def install_extensions(self):
+        return install_extensions(self.browser, self.extensions)
+
+    # Capture screenshots every t_wait_s seconds on a fixed schedule
+    # Encoding and writing happens in pipeline, which drops frames
+    # rather than letting the capture loop fall behind
+    # With an AdaptiveSchedule the interval follows the page activity
+    # as seen by page_changed instead
+    def screenshot(self, img_path, t_wait_s, pipeline=None, max_frames=None,
+                   report_s=10, schedule=None, activity="frames",
+                   diff_threshold=8):
+        if pipeline is None:
+            pipeline = ScreenshotPipeline(img_path)
+
+        n = 0
+        t_next = time.monotonic()
+        t_report = t_next
+        diff = None
+        if schedule is not None and activity == "frames":
+            diff = FrameDiff(threshold=diff_threshold)
+
+        while max_frames is None or n < max_frames:
+            t0 = time.monotonic()
+            with metrics.span("screenshot_capture"):
+                png = self.browser.get_screenshot_as_png()
+            pipeline.stats_add("capture_ms", (time.monotonic() - t0) * 1000)
+            pipeline.submit(n, png)
+            n += 1
+
+            if schedule is not None:
+                schedule.observe(page_changed(self.browser, activity, png, diff))
+                t_wait_s = schedule.next_s()
+
+            # Skip the slots we missed instead of drifting
+            t_next += t_wait_s
+            now = time.monotonic()
+            if t_wait_s > 0 and t_next <= now:
+                missed = int((now - t_next) / t_wait_s) + 1
+                pipeline.stats_add("dropped", missed)
+                t_next += missed * t_wait_s
+
+            if now - t_report >= report_s:
+                pipeline.report(now - t_report)
+                t_report = now
+
+            time.sleep(max(t_next - now, 0))
+
+        pipeline.close()
+
+        return True
+
+    def switch_tab(self, current_window):
+        logging.debug("browser: Current window is " + str(current_window))
+        handles = self.browser.window_handles
+        for k, window in enumerate(handles):
+            logging.debug("browser: " + window)
+            if window == current_window:
+                next_window = handles[(k + 1) % len(handles)]
+                with metrics.span("tab_switch"):
+                    self.browser.switch_to.window(next_window)
+
+                return True
+
+        return False
+
+
+# Run one Browser per job on sessions taken from pool
+# Each job is a list of URLs replacing --url
+def run_pooled_jobs(args, log_level, extensions, pool, jobs,
+                    session_cache=None):
+    for urls in jobs:
+        if not urls:
+            continue
+        t0 = time.monotonic()
+        job_args = copy.copy(args)
+        job_args.urls = urls
+        try:
+            b = Browser(job_args,
+                        log_level,
+                        targets,
+                        extensions,
+                        url_releases_geckodriver,
+                        pool=pool,
+                        session_cache=session_cache)
+        except (WebDriverException, queue.Empty) as e:
+            logging.error("pool: Job " + " ".join(urls) + " failed, no session: "
+                          + type(e).__name__ + " " + str(e).strip())
+            continue
+        b.release()
+        t_ms = int(round((time.monotonic() - t0) * 1000))
+        logging.info("pool: Job " + " ".join(urls) + " done in "
+                     + str(t_ms) + " ms")
+
+    return True
+
+
+# Job fields as found in batch job files
+job_fields = [
+    "target",
+    "url",
+    "url_payload",
+    "user",
+    "pw",
+    "selector_user",
+    "selector_pw",
+    "selector_submit",
+    "selector_value_user",
+    "selector_value_pw",
+    "selector_value_submit"
+]
+
+
+# Read login jobs from a JSON, YAML or CSV file, one job per entry/row
+def load_jobs(path):
+    try:
+        if os.path.splitext(path)[1].lower() == ".csv":
+            with open(path, newline='') as f:
+                jobs = list(csv.DictReader(f))
+        else:
+            jobs = load_data_file(path)
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(1)
+
+    if not isinstance(jobs, list):
+        logging.error("Job file must contain a list of jobs: " + path)
+        sys.exit(1)
+
+    for k, job in enumerate(jobs):
+        if not job.get("url"):
+            logging.error("Job " + str(k) + " in " + path + " has no url")
+            sys.exit(1)
+        job_normalize(job)
+        job.setdefault("id", k)
+
+    return jobs
+
+
+# Fill in the optional fields of a job
+def job_normalize(job):
+    for field in job_fields:
+        job[field] = job.get(field) or ""
+    job["target"] = job["target"] or "unknown"
+
+    return job
+
+
+# Login dict and html selectors as used by web_login of a job
+def job_login(job):
+    login = {
+        "target":      job["target"],
+        "url":         job["url"],
+        "url_payload": job["url_payload"],
+        "user":        job["user"],
+        "pw":          job["pw"]
+    }
+    html_login = {k: job[k] for k in job_fields if k.startswith("selector")}
+
+    return login, html_login
+
+
+# Log into the target of a single job on a pooled session
+# Returns the result record of this attempt
+# Jobs of the http engine without a payload to open only touch the
+# pool when the HTTP login fails, their cookies go to the session
+# cache for later sessions
+def run_login_job(pool, job, session_cache=None, engine=None):
+    login, html_login = job_login(job)
+    result = {
+        "id":        job["id"],
+        "target":    job["target"],
+        "url":       job["url"],
+        "success":   False,
+        "final_url": None,
+        "latency_ms": None,
+        "error":     None
+    }
+
+    t0 = time.monotonic()
+    if login_engine(login['target'], engine) == "http" and not login["url_payload"]:
+        with metrics.span("login_http", target=login['target']):
+            r = http_login(login, html_login)
+        if r["ok"] or pool is None:
+            result["success"] = bool(r["ok"])
+            result["final_url"] = r["final_url"]
+            result["error"] = r["error"] or ("Login needs a browser" if r["ok"] is None else None)
+            metrics.inc("logins", target=login['target'],
+                        result="http" if r["ok"] else "failed")
+            if r["ok"] and session_cache is not None:
+                session_cache.store(login['target'], login['url'], login['user'],
+                                    {"cookies": r["cookies"], "local_storage": {}})
+            result["latency_ms"] = int(round((time.monotonic() - t0) * 1000))
+            return result
+        logging.info("batch: HTTP login not usable for job " + str(job["id"])
+                     + ": " + str(r["error"]))
+
+    browser = None
+    try:
+        browser = pool.acquire()
+        pool.visit(browser, login["url"])
+        pool.visit(browser, login["url_payload"])
+        result["success"] = web_login_cached(browser,
+                                             dict(pool.browser_options,
+                                                  login_engine="browser"),
+                                             login,
+                                             html_login,
+                                             session_cache)
+        result["final_url"] = browser.current_url
+        if not result["success"]:
+            result["error"] = "Login validation failed"
+        elif login["url_payload"]:
+            browser.get(login["url_payload"])
+    except (WebDriverException, queue.Empty) as e:
+        result["error"] = type(e).__name__ + ": " + str(e).strip()
+    finally:
+        if browser is not None:
+            pool.release(browser)
+
+    result["latency_ms"] = int(round((time.monotonic() - t0) * 1000))
+
+    return result
+
+
+# The result record of a job that raised e instead of finishing
+def job_error_result(job, e):
+    return {
+        "id":      job["id"],
+        "target":  job.get("target"),
+        "url":     job.get("url"),
+        "success": False,
+        "error":   type(e).__name__ + ": " + str(e).strip()
+    }
+
+
+# Run login jobs on up to concurrency pooled sessions
+# Failed jobs are resubmitted up to retries times while the others continue
+# Result records are passed to on_result as jobs finish
+def run_batch(jobs, pool, concurrency, retries, on_result, session_cache=None,
+              engine=None):
+    attempts = {}
+    nok = 0
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+        for job in jobs:
+            attempts[job["id"]] = 1
+            f = executor.submit(run_login_job, pool, job, session_cache, engine)
+            pending[f] = job
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                job = pending.pop(f)
+                try:
+                    result = f.result()
+                except Exception as e:
+                    logging.error("batch: Job " + str(job["id"]) + " raised " + repr(e))
+                    result = job_error_result(job, e)
+                result["attempts"] = attempts[job["id"]]
+                if not result["success"] and attempts[job["id"]] <= retries:
+                    logging.info("batch: Retrying job " + str(job["id"])
+                                 + ": " + str(result["error"]))
+                    attempts[job["id"]] += 1
+                    f = executor.submit(run_login_job, pool, job,
+                                        session_cache, engine)
+                    pending[f] = job
+                    continue
+                if result["success"]:
+                    nok += 1
+                on_result(result)
+
+    logging.info("batch: " + str(nok) + " of " + str(len(jobs))
+                 + " logins succeeded")
+
+    return nok == len(jobs)
+
+
+# Capture a screenshot of the payload or login URL of a job on a
+# pooled session, logging in first if the job has a user
+# Returns the result record of this attempt
+def run_capture_job(pool, job, img_path, session_cache=None,
+                    img_format="png", quality=85):
+    login, html_login = job_login(job)
+    result = {
+        "id":         job["id"],
+        "target":     job["target"],
+        "url":        job["url"],
+        "success":    False,
+        "final_url":  None,
+        "latency_ms": None,
+        "error":      None,
+        "file":       None
+    }
+
+    t0 = time.monotonic()
+    browser = None
+    try:
+        browser = pool.acquire()
+        pool.visit(browser, login["url"])
+        pool.visit(browser, login["url_payload"])
+        if login["user"] and not web_login_cached(browser,
+                                                  pool.browser_options,
+                                                  login,
+                                                  html_login,
+                                                  session_cache):
+            result["error"] = "Login validation failed"
+        else:
+            browser.get(login["url_payload"] or login["url"])
+            wait_until(browser, ready_document,
+                       pool.browser_options['ready_timeout'], what="capture")
+            with metrics.span("screenshot_capture"):
+                png = browser.get_screenshot_as_png()
+            metrics.inc("frames", state="captured")
+            ext = "jpg" if img_format == "jpeg" else img_format
+            path = os.path.join(img_path, "job_" + str(job["id"]) + "." + ext)
+            with open(path, 'wb') as f:
+                f.write(screenshot_encode(png, img_format, quality))
+            result["file"] = path
+            result["success"] = True
+        result["final_url"] = browser.current_url
+    except (WebDriverException, OSError, queue.Empty) as e:
+        result["error"] = type(e).__name__ + ": " + str(e).strip()
+    finally:
+        if browser is not None:
+            pool.release(browser)
+
+    result["latency_ms"] = int(round((time.monotonic() - t0) * 1000))
+
+    return result
+
+
+# The worker owning shard among workers by rendezvous hashing, so
+# only the shards of a worker joining or leaving move
+def shard_owner(shard, workers):
+    return max(workers, default=None,
+               key=lambda w: hashlib.sha256((w + " " + shard).encode("utf-8")).digest())
+
+
+# Job queue in an SQLite database, shared by the workers of a host
+# or of many hosts on a filesystem with working locks
+# A leased job is invisible until its lease runs out, the jobs of a
+# worker that died are leased again, so every job completes at least once
+class SqliteQueue:
+
+    schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id       INTEGER PRIMARY KEY,
+    shard    TEXT NOT NULL,
+    job      TEXT NOT NULL,
+    visible  REAL NOT NULL,
+    worker   TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    done     INTEGER NOT NULL DEFAULT 0,
+    result   TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_visible ON jobs (done, shard, visible);
+CREATE TABLE IF NOT EXISTS workers (
+    worker TEXT PRIMARY KEY,
+    seen   REAL NOT NULL,
+    stats  TEXT NOT NULL
+);
+"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.db().executescript(self.schema)
+
+    # A connection per thread, committing every statement on its own
+    def db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            import sqlite3
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+
+        return db
+
+    def put(self, job):
+        cur = self.db().execute(
+            "INSERT INTO jobs (shard, job, visible) VALUES (?, ?, ?)",
+            (job["target"], json.dumps(job), time.time()))
+
+        return cur.lastrowid
+
+    # Lease the oldest visible job of the owned shards, or of any shard
+    # once it has been waiting for steal_after_s
+    def lease(self, worker, owned, steal_after_s, lease_s):
+        now = time.time()
+        db = self.db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            owned = sorted(owned)
+            row = db.execute(
+                "SELECT id, job, attempts FROM jobs WHERE done = 0 AND visible <= ?"
+                " AND shard IN (" + ", ".join("?" * len(owned)) + ")"
+                " ORDER BY visible LIMIT 1", [now] + owned).fetchone()
+            if row is None:
+                row = db.execute(
+                    "SELECT id, job, attempts FROM jobs WHERE done = 0 AND visible <= ?"
+                    " ORDER BY visible LIMIT 1", (now - steal_after_s,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET visible = ?, worker = ?,"
+                           " attempts = attempts + 1 WHERE id = ?",
+                           (now + lease_s, worker, row[0]))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+
+        return dict(json.loads(row[1]), id=row[0], attempts=row[2] + 1)
+
+    # Store the result of a job, or with retry make it visible again
+    def complete(self, job, worker, result, retry=False):
+        if retry:
+            self.db().execute("UPDATE jobs SET visible = ?, worker = NULL"
+                              " WHERE id = ? AND worker = ? AND done = 0",
+                              (time.time(), job["id"], worker))
+        else:
+            self.db().execute("UPDATE jobs SET done = 1, result = ? WHERE id = ?",
+                              (json.dumps(result), job["id"]))
+
+    def heartbeat(self, worker, stats):
+        self.db().execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?)",
+                          (worker, time.time(), json.dumps(stats)))
+
+    # Stats of the workers seen within alive_s
+    def workers(self, alive_s=None):
+        t_min = time.time() - alive_s if alive_s else 0
+        return {w: json.loads(stats) for w, stats in self.db().execute(
+            "SELECT worker, stats FROM workers WHERE seen >= ?", (t_min,))}
+
+    def shards(self):
+        return [shard for shard, in self.db().execute(
+            "SELECT DISTINCT shard FROM jobs WHERE done = 0")]
+
+    def depth(self):
+        depth = {"queued": 0, "leased": 0, "done": 0, "shards": {}}
+        for shard, done, leased, n in self.db().execute(
+                "SELECT shard, done, visible > ?, count(*) FROM jobs"
+                " GROUP BY shard, done, visible > ?", (time.time(), time.time())):
+            state = "done" if done else "leased" if leased else "queued"
+            depth[state] += n
+            if not done:
+                depth["shards"][shard] = depth["shards"].get(shard, 0) + n
+
+        return depth
+
+    def results(self):
+        return [json.loads(r) for r, in self.db().execute(
+            "SELECT result FROM jobs WHERE done = 1 ORDER BY id")]
+
+
+class RedisError(Exception):
+    pass
+
+
+# Client of the Redis protocol with a connection per thread,
+# covering the commands of RedisQueue on any server speaking it
+class RedisClient:
+
+    def __init__(self, url):
+        u = urlsplit(url)
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 6379
+        self.password = u.password
+        self.db = int(u.path.strip("/") or 0)
+        self.local = threading.local()
+
+    def connection(self):
+        f = getattr(self.local, "f", None)
+        if f is None:
+            import socket
+            sock = socket.create_connection((self.host, self.port), timeout=30)
+            f = self.local.f = sock.makefile('rwb')
+            if self.password:
+                self.call("AUTH", self.password)
+            if self.db:
+                self.call("SELECT", self.db)
+
+        return f
+
+    def call(self, *args):
+        f = self.connection()
+        request = [b"*" + str(len(args)).encode("ascii") + b"\r\n"]
+        for arg in args:
+            arg = str(arg).encode("utf-8")
+            request += [b"$" + str(len(arg)).encode("ascii") + b"\r\n", arg, b"\r\n"]
+        try:
+            f.write(b"".join(request))
+            f.flush()
+            return self.reply(f)
+        except OSError:
+            self.local.f = None
+            raise
+
+    def reply(self, f):
+        line = f.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection to redis closed")
+        kind, data = line[:1], line[1:-2]
+        if kind == b"+":
+            return data.decode("utf-8")
+        if kind == b"-":
+            raise RedisError(data.decode("utf-8"))
+        if kind == b":":
+            return int(data)
+        if kind == b"$":
+            if int(data) < 0:
+                return None
+            return f.read(int(data) + 2)[:-2].decode("utf-8")
+        if kind == b"*":
+            if int(data) < 0:
+                return None
+            return [self.reply(f) for _ in range(int(data))]
+
+        raise RedisError("Unexpected reply: " + repr(line))
+
+
+# Job queue on a Redis-compatible server with the semantics of SqliteQueue
+# Each shard is a sorted set of job ids scored by the time they become
+# visible, a lease is a key set only if absent that expires with it
+class RedisQueue:
+
+    def __init__(self, url, prefix="webdriver_util"):
+        self.redis = RedisClient(url)
+        self.prefix = prefix + ":"
+
+    def put(self, job):
+        r = self.redis
+        job_id = r.call("INCR", self.prefix + "seq")
+        r.call("SET", self.prefix + "job:" + str(job_id), json.dumps(job))
+        r.call("SADD", self.prefix + "shards", job["target"])
+        r.call("ZADD", self.prefix + "queue:" + job["target"], time.time(), job_id)
+
+        return job_id
+
+    def lease(self, worker, owned, steal_after_s, lease_s):
+        r = self.redis
+        now = time.time()
+        shards = r.call("SMEMBERS", self.prefix + "shards")
+        candidates = [(s, now) for s in shards if s in owned]
+        candidates += [(s, now - steal_after_s) for s in shards if s not in owned]
+        for shard, visible in candidates:
+            key = self.prefix + "queue:" + shard
+            for job_id in r.call("ZRANGEBYSCORE", key, "-inf", visible,
+                                 "LIMIT", 0, 8):
+                lease = self.prefix + "lease:" + job_id
+                if r.call("SET", lease, worker, "NX", "PX", int(lease_s * 1000)) is None:
+                    continue
+                # Completed by another worker in the meantime
+                if not r.call("ZADD", key, "XX", "CH", now + lease_s, job_id):
+                    r.call("DEL", lease)
+                    continue
+                attempts = r.call("HINCRBY", self.prefix + "attempts", job_id, 1)
+                job = json.loads(r.call("GET", self.prefix + "job:" + job_id))
+                return dict(job, id=int(job_id), attempts=attempts)
+
+        return None
+
+    def complete(self, job, worker, result, retry=False):
+        r = self.redis
+        job_id = str(job["id"])
+        key = self.prefix + "queue:" + job["target"]
+        if retry:
+            if r.call("GET", self.prefix + "lease:" + job_id) == worker:
+                r.call("ZADD", key, "XX", time.time(), job_id)
+                r.call("DEL", self.prefix + "lease:" + job_id)
+            return
+        r.call("HSET", self.prefix + "results", job_id, json.dumps(result))
+        r.call("ZREM", key, job_id)
+        r.call("DEL", self.prefix + "lease:" + job_id, self.prefix + "job:" + job_id)
+
+    def heartbeat(self, worker, stats):
+        self.redis.call("HSET", self.prefix + "workers", worker,
+                        json.dumps({"seen": time.time(), "stats": stats}))
+
+    def workers(self, alive_s=None):
+        t_min = time.time() - alive_s if alive_s else 0
+        entries = self.redis.call("HGETALL", self.prefix + "workers")
+        workers = {}
+        for w, entry in zip(entries[::2], entries[1::2]):
+            entry = json.loads(entry)
+            if entry["seen"] >= t_min:
+                workers[w] = entry["stats"]
+
+        return workers
+
+    def shards(self):
+        return [s for s in self.redis.call("SMEMBERS", self.prefix + "shards")
+                if self.redis.call("ZCARD", self.prefix + "queue:" + s)]
+
+    def depth(self):
+        r = self.redis
+        now = time.time()
+        depth = {"queued": 0, "leased": 0,
+                 "done": r.call("HLEN", self.prefix + "results"), "shards": {}}
+        for shard in r.call("SMEMBERS", self.prefix + "shards"):
+            key = self.prefix + "queue:" + shard
+            n = r.call("ZCARD", key)
+            queued = r.call("ZCOUNT", key, "-inf", now)
+            depth["queued"] += queued
+            depth["leased"] += n - queued
+            if n:
+                depth["shards"][shard] = n
+
+        return depth
+
+    def results(self):
+        entries = self.redis.call("HGETALL", self.prefix + "results")
+        return [json.loads(r) for _, r in
+                sorted(zip(entries[::2], entries[1::2]), key=lambda e: int(e[0]))]
+
+
+# Open the job queue at url: redis://[:password@]host[:port][/db],
+# sqlite:///path or the path of an SQLite database
+def queue_open(url):
+    if url.startswith("redis://"):
+        return RedisQueue(url)
+    if url.startswith("sqlite://"):
+        url = url[len("sqlite://"):]
+    if not url:
+        raise ValueError("No queue given")
+
+    return SqliteQueue(url)
+
+
+# Per target counts and latencies of the results of a queue
+def results_aggregate(results):
+    import statistics
+
+    targets_results = {}
+    for result in results:
+        t = targets_results.setdefault(result["target"], {"ok": 0, "failed": 0,
+                                                          "latency_ms": []})
+        t["ok" if result["success"] else "failed"] += 1
+        t["latency_ms"].append(result["latency_ms"])
+    for t in targets_results.values():
+        latency_ms = t.pop("latency_ms")
+        t["p50_ms"] = statistics.median(latency_ms)
+        t["max_ms"] = max(latency_ms)
+
+    return targets_results
+
+
+# Runs login and capture jobs leased from a queue on the sessions of pool
+# Jobs are leased from the shards this worker owns among the workers
+# alive, others only once they waited for steal_after_s. Failed jobs
+# are handed back up to retries times. Stats are published every
+# stats_interval_s, the worker stops after being idle for exit_idle_s
+class Worker:
+
+    def __init__(self, job_queue, pool, name, concurrency=2, retries=1,
+                 session_cache=None, engine=None, img_path=".",
+                 img_format="png", quality=85, lease_s=300,
+                 steal_after_s=30, stats_interval_s=30, exit_idle_s=0):
+        self.queue = job_queue
+        self.pool = pool
+        self.name = name
+        self.concurrency = concurrency
+        self.retries = retries
+        self.session_cache = session_cache
+        self.engine = engine
+        self.img_path = img_path
+        self.img_format = img_format
+        self.quality = quality
+        self.lease_s = lease_s
+        self.steal_after_s = steal_after_s
+        self.stats_interval_s = stats_interval_s
+        self.exit_idle_s = exit_idle_s
+        self.owned = set()
+        self.counts = {"ok": 0, "failed": 0, "retried": 0}
+        self.counts_last = 0
+        self.busy = 0
+        self.t_idle = time.monotonic()
+        self.t0 = time.monotonic()
+        self.t_report = self.t0
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+    # Run a leased job, turning any error into a failed result
+    # so that the job is retried or completed like any other
+    def run_job(self, job):
+        try:
+            if job.get("kind") == "capture":
+                result = run_capture_job(self.pool, job, self.img_path,
+                                         self.session_cache, self.img_format,
+                                         self.quality)
+            else:
+                result = run_login_job(self.pool, job, self.session_cache, self.engine)
+        except Exception as e:
+            logging.error("worker: Job " + str(job["id"]) + " raised " + repr(e))
+            result = job_error_result(job, e)
+        result["kind"] = job.get("kind") or "login"
+        result["worker"] = self.name
+        result["attempts"] = job["attempts"]
+
+        return result
+
+    def loop(self):
+        while not self.stop.is_set():
+            try:
+                job = self.queue.lease(self.name, self.owned,
+                                       self.steal_after_s, self.lease_s)
+            except Exception as e:
+                logging.error("worker: Failed to lease a job: " + repr(e))
+                self.stop.wait(5)
+                continue
+
+            if job is None:
+                with self.lock:
+                    idle_s = time.monotonic() - self.t_idle
+                    if self.exit_idle_s and not self.busy and idle_s >= self.exit_idle_s:
+                        logging.info("worker: Idle for " + str(int(idle_s))
+                                     + " s, stopping")
+                        self.stop.set()
+                self.stop.wait(0.5)
+                continue
+
+            with self.lock:
+                self.busy += 1
+            try:
+                result = self.run_job(job)
+                retry = not result["success"] and job["attempts"] <= self.retries
+                self.queue.complete(job, self.name, result, retry)
+            except Exception as e:
+                # The lease runs out and the job goes to the next worker
+                logging.error("worker: Failed to complete job " + str(job["id"])
+                              + ": " + repr(e))
+                continue
+            finally:
+                with self.lock:
+                    self.busy -= 1
+                    self.t_idle = time.monotonic()
+
+            state = "retried" if retry else "ok" if result["success"] else "failed"
+            with self.lock:
+                self.counts[state] += 1
+            metrics.inc("queue_jobs", worker=self.name, result=state)
+            if state != "ok":
+                logging.info("worker: Job " + str(job["id"]) + " " + state
+                             + ": " + str(result["error"]))
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            counts = dict(self.counts)
+        n = counts["ok"] + counts["failed"]
+        stats = dict(counts,
+                     owned=sorted(self.owned),
+                     jobs_per_min=round((n - self.counts_last)
+                                        / max(now - self.t_report, 1e-3) * 60, 2),
+                     jobs_per_min_total=round(n / max(now - self.t0, 1e-3) * 60, 2))
+        self.counts_last = n
+        self.t_report = now
+
+        return stats
+
+    # Publish the stats of this worker and take over the shards
+    # it owns among the workers seen since the last two reports
+    def report(self):
+        stats = self.stats()
+        try:
+            self.queue.heartbeat(self.name, stats)
+            workers = set(self.queue.workers(alive_s=3 * self.stats_interval_s))
+            workers.add(self.name)
+            self.owned = {shard for shard in self.queue.shards()
+                          if shard_owner(shard, workers) == self.name}
+            depth = self.queue.depth()
+        except (OSError, RedisError) as e:
+            logging.error("worker: Failed to report stats: " + str(e))
+            return None
+
+        for state in ("queued", "leased", "done"):
+            metrics.set("queue_depth", depth[state], state=state)
+        metrics.set("worker_jobs_per_min", stats["jobs_per_min"], worker=self.name)
+        logging.info("worker: " + self.name + " " + str(stats["ok"]) + " ok, "
+                     + str(stats["failed"]) + " failed, "
+                     + str(stats["jobs_per_min"]) + " jobs/min, queue "
+                     + str(depth["queued"]) + " queued, "
+                     + str(depth["leased"]) + " leased, "
+                     + str(len(workers)) + " workers, shards "
+                     + ", ".join(sorted(self.owned)))
+
+        return stats
+
+    def run(self):
+        self.report()
+        threads = [threading.Thread(target=self.loop, daemon=True)
+                   for _ in range(self.concurrency)]
+        for t in threads:
+            t.start()
+        try:
+            while not self.stop.wait(self.stats_interval_s):
+                self.report()
+        except KeyboardInterrupt:
+            self.stop.set()
+        for t in threads:
+            t.join()
+
+        return self.report()
+
+
+class DaemonError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Keeps browser sessions alive between requests of a local control API
+# Sessions are taken from pool and handed back when deleted,
+# every WebDriver command on a session is serialized by its lock
+class Daemon:
+
+    def __init__(self, pool, session_cache=None):
+        self.pool = pool
+        self.session_cache = session_cache
+        self.sessions = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.t_start = time.monotonic()
 
-    return True
+    def session(self, session_id):
+        with self.lock:
+            entry = self.sessions.get(session_id)
+        if entry is None:
+            raise DaemonError(404, "No session " + session_id)
 
+        return entry
 
-# Log into web-app
-def web_login(browser, browser_options, login, html_login):
+    # Take a session from the pool, logging in if a job is given
+    # The session goes back to the pool if that fails
+    def session_create(self, job):
+        browser = self.pool.acquire()
+        entry = {
+            "id":        str(next(self.ids)),
+            "browser":   browser,
+            "lock":      threading.Lock(),
+            "created":   time.monotonic(),
+            "login":     None,
+            "logged_in": False
+        }
+        with self.lock:
+            self.sessions[entry["id"]] = entry
 
-    if login['target'] == "grafana5":
-        xpath_login_grafana5 = "/html/body/grafana-app/div/div/div/div/div/div[2]/div[1]/form/div[3]/button"
-        html_login_selector_user = "name"
-        html_login_selector_pw = "id"
-        html_login_selector_submit = "xpath"
-        html_login_selector_value_user = "username"
-        html_login_selector_value_pw = "inputPassword"
-        html_login_selector_value_submit = xpath_login_grafana5
-    elif login['target'] == "roundcube":
-        html_login_selector_user = "id"
-        html_login_selector_pw = "id"
-        html_login_selector_submit = "id"
-        html_login_selector_value_user = "rcmloginuser"
-        html_login_selector_value_pw = "rcmloginpwd"
-        html_login_selector_value_submit = "rcmloginsubmit"
-    elif login['target'] == "spotify":
-        html_login_selector_user = "name"
-        html_login_selector_pw = "name"
-        html_login_selector_submit = "id"
-        html_login_selector_value_user = "username"
-        html_login_selector_value_pw = "password"
-        html_login_selector_value_submit = "login-button"
-    else:
-        # Selection by: id / name / css-selector / xpath
-        html_login_selector_user = html_login['selector_user']
-        html_login_selector_pw = html_login['selector_pw']
-        html_login_selector_submit = html_login['selector_submit']
-        html_login_selector_value_user = html_login['selector_value_user']
-        html_login_selector_value_pw = html_login['selector_value_pw']
-        html_login_selector_value_submit = html_login['selector_value_submit']
+        try:
+            if job.get("url") and job.get("user"):
+                self.session_login(entry, job)
+            elif job.get("url"):
+                self.pool.visit(browser, job["url"])
+                with entry["lock"]:
+                    browser.get(job["url"])
+        except BaseException:
+            self.session_delete(entry)
+            raise
 
-    try:
-        logging.info("Opening " + login['url'] + " with browser")
-        browser.get(login['url'])
+        return self.session_health(entry)
 
-        # User: Find and fill user input
-        if html_login_selector_user == "name":
-            e = browser.find_element(By.NAME, html_login_selector_value_user)
-        elif html_login_selector_user == "id":
-            e = browser.find_element(By.ID, html_login_selector_value_user)
-        elif html_login_selector_user == "xpath":
-            e = browser.find_element(By.XPATH, html_login_selector_value_user)
-        else:
-            logging.error(msg_error_selector)
-            sys.exit(1)
-        e.send_keys(login['user'])
+    def session_login(self, entry, job):
+        if not job.get("url"):
+            raise DaemonError(400, "A login needs an url")
+        login, html_login = job_login(job_normalize(job))
 
-        # Password: Find and fill password input
-        if html_login_selector_pw == "name":
-            e = browser.find_element(By.NAME, html_login_selector_value_pw)
-        elif html_login_selector_pw == "id":
-            e = browser.find_element(By.ID, html_login_selector_value_pw)
-        elif html_login_selector_pw == "xpath":
-            e = browser.find_element(By.XPATH, html_login_selector_value_pw)
-        else:
-            logging.error(msg_error_selector)
-            sys.exit(1)
-        e.send_keys(login['pw'])
+        self.pool.visit(entry["browser"], login["url"])
+        self.pool.visit(entry["browser"], login["url_payload"])
+        with entry["lock"]:
+            entry["login"] = login
+            entry["logged_in"] = web_login_cached(entry["browser"],
+                                                  self.pool.browser_options,
+                                                  login,
+                                                  html_login,
+                                                  self.session_cache)
+            if entry["logged_in"] and login["url_payload"]:
+                with metrics.span("payload"):
+                    entry["browser"].get(login["url_payload"])
 
-        # Submit: Find and click submit button
-        if html_login_selector_submit == "name":
-            e = browser.find_element(By.NAME,
-                                     html_login_selector_value_submit)
-        elif html_login_selector_submit == "id":
-            e = browser.find_element(By.ID,
-                                     html_login_selector_value_submit)
-        elif html_login_selector_submit == "xpath":
-            e = browser.find_element(By.XPATH,
-                                     html_login_selector_value_submit)
-        else:
-            logging.error(msg_error_selector)
-            sys.exit(1)
-        logging.info("Trying to log into " + login['url'])
-        e.click()
+        return self.session_health(entry)
 
-    finally:
-        if browser is not None:
-            return True
+    def session_open(self, entry, url):
+        self.pool.visit(entry["browser"], url)
+        with entry["lock"]:
+            browser = entry["browser"]
+            browser.switch_to.new_window('tab')
+            browser.get(url)
 
-    return False
+            return {"handle": browser.current_window_handle, "url": url}
 
+    def session_close_window(self, entry, handle):
+        with entry["lock"]:
+            browser = entry["browser"]
+            handles = browser.window_handles
+            if handle not in handles:
+                raise DaemonError(404, "No window " + handle)
+            if len(handles) == 1:
+                raise DaemonError(409, "Can not close the last window")
+            browser.switch_to.window(handle)
+            browser.close()
+            browser.switch_to.window([h for h in handles if h != handle][0])
 
-class Browser:
+        return self.session_health(entry)
 
-    def __init__(self,
-                 args,
-                 log_level,
-                 path_login,
-                 extensions,
-                 url_releases_geckodriver):
+    def session_screenshot(self, entry, img_format="png", quality=85):
+        with entry["lock"]:
+            with metrics.span("screenshot_capture"):
+                png = entry["browser"].get_screenshot_as_png()
+        metrics.inc("frames", state="captured")
 
-        self.url_releases_geckodriver = "https://github.com/mozilla/geckodriver/releases/"
-        self.extensions = extensions
-        self.login = {}
+        return screenshot_encode(png, img_format, quality)
 
-        self.browser_options = {
-            "gecko_logfile":          args.gecko_logfile,
-            "log_level":              log_level,
-            "headless":               args.browser_headless,
-            "fullscreen":             args.browser_fullscreen,
-            "gracetime_headless":     3,
-            "gracetime_non_headless": 30,
-            "drm":                    args.browser_drm,
-            "close":                  args.browser_close,
-            # Optional explicit paths to bypass Selenium Manager
-            "geckodriver_path":       args.geckodriver_path or os.getenv('GECKODRIVER'),
-            "firefox_binary":         args.firefox_binary or os.getenv('FIREFOX_BIN'),
+    def session_health(self, entry):
+        health = {
+            "id":        entry["id"],
+            "age_s":     round(time.monotonic() - entry["created"], 3),
+            "target":    entry["login"]["target"] if entry["login"] else None,
+            "logged_in": entry["logged_in"],
+            "healthy":   False,
+            "windows":   0,
+            "url":       None
         }
+        with entry["lock"]:
+            try:
+                health["windows"] = len(entry["browser"].window_handles)
+                health["url"] = entry["browser"].current_url
+                health["healthy"] = True
+            except WebDriverException as e:
+                health["error"] = str(e).strip()
 
-        self.target = args.target
-        self.urls = args.urls
-        self.perform_login = True
+        return health
 
-        login_pw = args.login_pw
-        login_pw_base64 = False
+    def session_delete(self, entry):
+        with self.lock:
+            self.sessions.pop(entry["id"], None)
+        with entry["lock"]:
+            self.pool.release(entry["browser"])
 
-        if login_pw and login_pw_base64:
-            login_pw = base64.b64decode(login_pw).decode("utf-8")
+        return {"id": entry["id"], "deleted": True}
 
-        if self.target == "":
-            self.target = "unknown"
-            path_logout_target = "unknown"
-        else:
-            logging.info("Browser target: " + self.target)
-            path_logout_target = path_logout[self.target]
+    def health(self):
+        with self.lock:
+            nsessions = len(self.sessions)
 
-        self.login["target"] = self.target
-        self.login["urls"] = self.urls
-        self.login["url_payload"] = args.url_payload
-        self.login["user"] = args.login_user
-        self.login["pw"] = login_pw
-        self.login["path_logout_target"] = path_logout_target
+        return {
+            "uptime_s": round(time.monotonic() - self.t_start, 3),
+            "sessions": nsessions,
+            "idle":     self.pool.idle.qsize()
+        }
 
-        if not self.login["user"]:
-            self.perform_login = False
+    # Map a request to its handler, returning (content type, body)
+    def dispatch(self, method, path, query, body):
+        parts = path.strip("/").split("/")
 
-        html_login = {
-            "selector_user":          args.selector_user,
-            "selector_pw":            args.selector_pw,
-            "selector_submit":        args.selector_submit,
-            "selector_value_user":    args.selector_value_user,
-            "selector_value_pw":      args.selector_value_pw,
-            "selector_value_submit":  args.selector_value_submit
-        }
+        if (method, parts) == ("GET", ["health"]):
+            return self.health()
+        if (method, parts) == ("GET", ["metrics"]):
+            return "text/plain; version=0.0.4", metrics.render().encode("utf-8")
+        if parts[0] != "sessions":
+            raise DaemonError(404, "Unknown path " + path)
 
-        self.browser = self.gecko_browser_setup()
+        if len(parts) == 1:
+            if method == "GET":
+                with self.lock:
+                    entries = list(self.sessions.values())
+                return [self.session_health(e) for e in entries]
+            if method == "POST":
+                return self.session_create(body)
+            raise DaemonError(405, "Method not allowed")
 
-        if self.perform_login:
-            logging.info("Performing Login")
-            web_login(browser, self.browser_options, self.login, html_login)
-        else:
-            nurls = len(self.urls)
-            logging.info("browser: Opening " + str(nurls) + " URLs")
-            self.get_url(self.urls[0])
-            if nurls > 1:
-                for k, url in enumerate(self.urls):
-                    if k > 0:
-                        self.open_tab_with_url(url)
+        entry = self.session(parts[1])
+        command = (method, "/".join(parts[2:]))
+        if command == ("GET", ""):
+            return self.session_health(entry)
+        elif command == ("DELETE", ""):
+            return self.session_delete(entry)
+        elif command == ("POST", "login"):
+            return self.session_login(entry, body)
+        elif command == ("POST", "windows"):
+            if not body.get("url"):
+                raise DaemonError(400, "Opening a window needs an url")
+            return self.session_open(entry, body["url"])
+        elif method == "DELETE" and len(parts) == 4 and parts[2] == "windows":
+            return self.session_close_window(entry, parts[3])
+        elif command == ("GET", "screenshot"):
+            img_format = query.get("format", ["png"])[0]
+            if img_format not in ("png", "jpeg", "webp"):
+                raise DaemonError(400, "Unsupported format " + img_format)
+            quality = int(query.get("quality", ["85"])[0])
+            return ("image/" + img_format,
+                    self.session_screenshot(entry, img_format, quality))
 
-        # Add some grace time
-        # We need less time when running headless
-        if not self.browser_options['headless']:
-            time.sleep(self.browser_options['gracetime_non_headless'])
-        else:
-            time.sleep(self.browser_options['gracetime_headless'])
+        raise DaemonError(404, "Unknown command " + method + " " + path)
 
-        if self.perform_login:
-            # Validate Login
-            if not web_validate_login(self.login['target'],
-                                      browser.current_url,
-                                      self.login['url']):
+    # Serve the control API on host:port or unix:<path>
+    def server(self, listen):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        import socket
+        import socketserver
 
-                logging.error("Failed to log into "
-                              + self.login['target'] + " on: " + self.login['url'])
-            else:
-                logging.info("Successfully logged into "
-                             + self.login['target'] + " on: " + self.login['url'])
+        daemon = self
 
-            # Open payload
-            if not self.login['url_payload']:
-                logging.info("No payload supplied")
-            else:
-                logging("Opening payload: ", self.login['url_payload'])
-                browser.get(self.login['url_payload'])
+        class UnixHTTPServer(ThreadingHTTPServer):
 
-            if self.browser_options['close']:
-                logging.info("Logging out of " + self.login['url'])
-                web_logout(browser,
-                           self.login['target'],
-                           self.login['url'],
-                           self.login['path_logout'])
-                browser.close()
+            address_family = socket.AF_UNIX
 
-    def gecko_browser_setup(self):
-        options = Options()
-        geckodriver_path = self.browser_options.get('geckodriver_path')
-        firefox_binary = self.browser_options.get('firefox_binary')
-
-        # Explicit Firefox binary prevents Selenium Manager browser resolution
-        if firefox_binary:
-            options.binary_location = firefox_binary
-
-        # Providing geckodriver path prevents Selenium Manager driver resolution:
-        # Did not work for linux/aarch64
-        if geckodriver_path:
-            service = Service(executable_path=geckodriver_path, log_path=os.devnull)
-        else:
-            service = Service(log_path=os.devnull)
+            def server_bind(self):
+                socketserver.TCPServer.server_bind(self)
+                self.server_name = "localhost"
+                self.server_port = 0
 
-        service.log_path = os.devnull
-        options.log.level = self.browser_options['log_level']
+        class DaemonHandler(BaseHTTPRequestHandler):
 
-        if self.browser_options['headless']:
-            options.headless = True
+            def reply(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
 
-        if self.browser_options["drm"]:
-            options.firefox_profile.set_preference("media.gmp-manager.updateEnabled",
-                                                   True)
-            options.firefox_profile.set_preference("media.eme.enabled",
-                                                   True)
+            def handle_request(self, method):
+                url = urlsplit(self.path)
+                try:
+                    n = int(self.headers.get("Content-Length", 0))
+                    body = json.loads(self.rfile.read(n)) if n else {}
+                    if not isinstance(body, dict):
+                        raise DaemonError(400, "The request body must be a JSON object")
+                    result = daemon.dispatch(method, url.path,
+                                             parse_qs(url.query), body)
+                except DaemonError as e:
+                    result, status = {"error": str(e)}, e.status
+                except ValueError as e:
+                    result, status = {"error": str(e)}, 400
+                except Exception as e:
+                    if not isinstance(e, (WebDriverException, queue.Empty)):
+                        logging.error("daemon: " + method + " " + url.path
+                                      + " failed: " + repr(e))
+                    result = {"error": type(e).__name__ + ": " + str(e).strip()}
+                    status = 500
+                else:
+                    status = 200
 
-        browser = webdriver.Firefox(options=options,
-                                    service=service)
+                if isinstance(result, tuple):
+                    self.reply(status, *result)
+                else:
+                    self.reply(status, "application/json",
+                               json.dumps(result).encode("utf-8"))
 
-        self.install_extensions()
+            def do_GET(self):
+                self.handle_request("GET")
 
-        if self.browser_options['fullscreen']:
-            browser.fullscreen_window()
+            def do_POST(self):
+                self.handle_request("POST")
 
-        return browser
+            def do_DELETE(self):
+                self.handle_request("DELETE")
 
-    def get_url(self, url):
-        logging.debug("browser: Requesting " + url)
-        self.browser.get(url)
-        return True
+            def log_message(self, format, *args):
+                logging.debug("daemon: " + format % args)
 
-    def open_tab_with_url(self, url):
-        self.browser.switch_to.new_window('tab')
-        self.get_url(url)
+        if listen.startswith("unix:"):
+            path = listen[len("unix:"):]
+            if os.path.exists(path):
+                os.unlink(path)
+            server = UnixHTTPServer(path, DaemonHandler)
+            os.chmod(path, 0o600)
+        else:
+            host, _, port = listen.rpartition(":")
+            server = ThreadingHTTPServer((host or "127.0.0.1", int(port)),
+                                         DaemonHandler)
+        logging.info("daemon: Listening on " + listen)
 
-        return True
+        return server
 
-    def install_extensions(self):
-        for ext in self.extensions:
-            driver.install_addon(ext, temporary=True)
+    def close(self):
+        with self.lock:
+            entries = list(self.sessions.values())
+        for entry in entries:
+            self.session_delete(entry)
 
         return True
 
-    def screenshot(self, img_path, t_wait_s):
-        t0 = int(round(time.time() * 1000))
-        n = 0
 
-        Path(img_path).mkdir(parents=True, exist_ok=True)
+# Subcommands of main
+commands = {
+    "login":           "Log in, open the payload and exit, or run job files",
+    "kiosk":           "Log in and rotate through the tabs of all URLs",
+    "capture":         "Log in and capture screenshots of the current tab",
+    "daemon":          "Keep browser sessions running and serve a control API",
+    "enqueue":         "Add the jobs of BATCH_JOBS to the shared QUEUE",
+    "worker":          "Run login and capture jobs from the shared QUEUE",
+    "queue-status":    "Print queue depth, worker stats and aggregated results",
+    "validate-config": "Check options, targets and job files without a browser",
+    "bench":           "Run benchmarks, see webdriver_bench.py --help"
+}
 
-        while True:
-            filename = img_path + '/image_' + str(0).zfill(4) + '.png'
-            self.browser.save_screenshot(filename)
-            t1 = int(round(time.time() * 1000))
-            logging.debug("Browser screenshot saved to: " \
-                          + filename + " in " + str(t1 - t0) + " ms")
-            t0 = t1
 
-            time.sleep(t_wait_s)
+# The command of runs not naming one, as before there were subcommands
+def command_default(args):
+    if args.batch_jobs or args.pool_jobs_stdin:
+        return "login"
+    if args.screenshots:
+        return "capture"
 
-            if 10 == n:
-                n = 0
-            else:
-                n += 1
+    return "kiosk"
 
-    def switch_tab(self, current_window):
-        logging.debug("browser: Current window is " + str(current_window))
-        for k, window in enumerate(b.browser.window_handles):
-            logging.debug("browser: " + window)
-            if window == current_window:
-                next_window = b.browser.window_handles[(k + 1) % len(b.browser.window_handles)]
-                b.browser.switch_to.window(next_window)
 
-                return True
+# Value of an option that defaults to True, where any non-empty
+# string would be true with type=bool
+def option_bool(value):
+    value = value.strip().lower()
+    if value in ("1", "true", "yes", "on"):
+        return True
+    if value in ("0", "false", "no", "off"):
+        return False
 
+    raise ValueError(value)
 
-if __name__ == '__main__':
 
-    parser = configargparse.ArgParser(description="")
+# Options of all commands but bench
+def parser_create():
+    import configargparse
+
+    parser = configargparse.ArgParser(description="Automated and optionally headless "
+                                                  "login for web-applications")
+    parser.add_argument('command',
+                        help="One of: " + ", ".join(commands)
+                             + ", picked from the other options if omitted",
+                        choices=list(commands),
+                        nargs='?')
     parser.add_argument('--browser-headless',
                         dest='browser_headless',
                         env_var='BROWSER_HEADLESS',
@@ -383,8 +4315,132 @@ if __name__ == '__main__':
                         dest='browser_tab_switch_pause_s',
                         env_var='BROWSER_TABSWITCH_PAUSE',
                         help="Time between tab switches in seconds",
-                        type=int,
+                        type=float,
                         default=5)
+    parser.add_argument('--browser-tab-dwell',
+                        dest='browser_tab_dwell_s',
+                        env_var='BROWSER_TAB_DWELL',
+                        help="Time to show the tab of the --url at the same position "
+                             "in seconds, can be specified multiple times",
+                        type=float,
+                        action='append')
+    parser.add_argument('--browser-tab-weight',
+                        dest='browser_tab_weight',
+                        env_var='BROWSER_TAB_WEIGHT',
+                        help="How often per rotation to show the tab of the --url "
+                             "at the same position, can be specified multiple times",
+                        type=int,
+                        action='append')
+    parser.add_argument('--browser-tab-refresh-ahead',
+                        dest='browser_tab_refresh_ahead_s',
+                        env_var='BROWSER_TAB_REFRESH_AHEAD',
+                        help="Reload background tabs this many seconds before "
+                             "they are shown, briefly bringing them to the front, "
+                             "0 disables reloading",
+                        type=float,
+                        default=0)
+    parser.add_argument('--browser-tab-refresh-adaptive',
+                        dest='browser_tab_refresh_adaptive',
+                        env_var='BROWSER_TAB_REFRESH_ADAPTIVE',
+                        help="Only reload tabs whose DOM did not change while shown",
+                        type=bool,
+                        default=False)
+    parser.add_argument('--browser-tab-switch-pause-max',
+                        dest='browser_tab_switch_pause_max_s',
+                        env_var='BROWSER_TABSWITCH_PAUSE_MAX',
+                        help="Longest time between tab switches in seconds, "
+                             "tabs are shown longer up to this under host load, "
+                             "0 keeps dwell times fixed",
+                        type=float,
+                        default=0)
+    parser.add_argument('--watchdog-interval',
+                        dest='watchdog_interval_s',
+                        env_var='WATCHDOG_INTERVAL',
+                        help="Time between memory samples of the tab rotation "
+                             "in seconds",
+                        type=float,
+                        default=60)
+    parser.add_argument('--watchdog-reload-rss',
+                        dest='watchdog_reload_mb',
+                        env_var='WATCHDOG_RELOAD_RSS',
+                        help="Reload a tab when geckodriver and firefox use more "
+                             "than this many MiB, 0 disables",
+                        type=int,
+                        default=0)
+    parser.add_argument('--watchdog-restart-rss',
+                        dest='watchdog_restart_mb',
+                        env_var='WATCHDOG_RESTART_RSS',
+                        help="Restart the session when geckodriver and firefox "
+                             "use more than this many MiB, 0 disables",
+                        type=int,
+                        default=0)
+    parser.add_argument('--watchdog-heap',
+                        dest='watchdog_heap_mb',
+                        env_var='WATCHDOG_HEAP',
+                        help="Reload a tab whose JS heap exceeds this many MiB "
+                             "where the browser reports it, 0 disables",
+                        type=int,
+                        default=0)
+    parser.add_argument('--watchdog-log',
+                        dest='watchdog_log',
+                        env_var='WATCHDOG_LOG',
+                        help="File to append memory samples and recycle events to",
+                        type=str)
+    parser.add_argument('--browser-ready',
+                        dest='browser_ready',
+                        env_var='BROWSER_READY',
+                        help="Readiness condition to wait for after login or "
+                             "opening URLs: auto, readystate, networkidle[:ms], "
+                             "element:<css-selector> or url:<prefix>",
+                        type=str,
+                        default="auto")
+    parser.add_argument('--browser-ready-timeout',
+                        dest='browser_ready_timeout',
+                        env_var='BROWSER_READY_TIMEOUT',
+                        help="Maximum time to wait for the page to become ready in seconds",
+                        type=float,
+                        default=30)
+    parser.add_argument('--browser-fast-open',
+                        dest='browser_fast_open',
+                        env_var='BROWSER_FAST_OPEN',
+                        help="Open all URLs without waiting for each page to load",
+                        type=bool,
+                        default=False)
+    parser.add_argument('--browser-fast-open-concurrency',
+                        dest='browser_fast_open_concurrency',
+                        env_var='BROWSER_FAST_OPEN_CONCURRENCY',
+                        help="Maximum number of pages loading at the same time",
+                        type=int,
+                        default=8)
+    parser.add_argument('--browser-profile',
+                        dest='browser_profile',
+                        env_var='BROWSER_PROFILE',
+                        help="Preset of Firefox prefs and window settings: "
+                             + ", ".join(profile_presets),
+                        type=str,
+                        choices=list(profile_presets),
+                        default="default")
+    parser.add_argument('--browser-prefs',
+                        dest='browser_prefs_files',
+                        env_var='BROWSER_PREFS',
+                        help="JSON or YAML file of Firefox prefs applied on top of "
+                             "the preset, can be specified multiple times",
+                        type=str,
+                        action='append')
+    parser.add_argument('--browser-extension',
+                        dest='browser_extensions',
+                        env_var='BROWSER_EXTENSION',
+                        help="Firefox extension (.xpi) to install, "
+                             "can be specified multiple times",
+                        type=str,
+                        action='append')
+    parser.add_argument('--profile-cache',
+                        dest='profile_cache',
+                        env_var='PROFILE_CACHE',
+                        help="Directory to keep template profiles in, "
+                             "cloned for every session",
+                        type=str,
+                        default="")
     parser.add_argument('--browser-enable-drm',
                         dest='browser_drm',
                         env_var='BROWSER_DRM',
@@ -406,8 +4462,7 @@ if __name__ == '__main__':
                         env_var='URL',
                         help="URL to open on browser startup, can be specified multiple times",
                         type=str,
-                        action='append',
-                        required=True)
+                        action='append')
     parser.add_argument('--url-payload',
                         dest='url_payload',
                         env_var='URL_PAYLOAD',
@@ -426,6 +4481,30 @@ if __name__ == '__main__':
                         help="Password to user for web-app login",
                         type=str,
                         required=False)
+    parser.add_argument('--login-fill',
+                        dest='login_fill',
+                        env_var='LOGIN_FILL',
+                        help="How to fill the login form: keys types into each "
+                             "element, fast sets all values in a single script",
+                        type=str,
+                        choices=["keys", "fast"],
+                        default="keys")
+    parser.add_argument('--login-engine',
+                        dest='login_engine',
+                        env_var='LOGIN_ENGINE',
+                        help="How to log in: browser fills the form, http posts it "
+                             "without a browser and hands the cookies to the session, "
+                             "auto uses http for targets marked as working without JS",
+                        type=str,
+                        choices=["browser", "http", "auto"],
+                        default="browser")
+    parser.add_argument('--locator-cache',
+                        dest='locator_cache',
+                        env_var='LOCATOR_CACHE',
+                        help="JSON file remembering which locator of a chain found "
+                             "each login form element, per target, URL and app version",
+                        type=str,
+                        default="")
     parser.add_argument('--selector-user',
                         dest='selector_user',
                         env_var='SELECTOR_USER',
@@ -474,9 +4553,122 @@ if __name__ == '__main__':
                         dest='screenshots_pause',
                         env_var='SCREENSHOTS_PAUSE',
                         help="Time between two screenshots in seconds",
-                        type=int,
+                        type=float,
                         default=0.5
                         )
+    parser.add_argument('--screenshots-pause-max',
+                        dest='screenshots_pause_max',
+                        env_var='SCREENSHOTS_PAUSE_MAX',
+                        help="Longest time between two screenshots in seconds, "
+                             "adapting the pause between SCREENSHOTS_PAUSE and this "
+                             "to page activity and host load, 0 keeps it fixed",
+                        type=float,
+                        default=0)
+    parser.add_argument('--screenshots-activity',
+                        dest='screenshots_activity',
+                        env_var='SCREENSHOTS_ACTIVITY',
+                        help="How to tell a page changed for the adaptive pause: "
+                             "frames compares screenshots, mutations counts DOM changes",
+                        type=str,
+                        choices=["frames", "mutations"],
+                        default="frames")
+    parser.add_argument('--screenshots-format',
+                        dest='screenshots_format',
+                        env_var='SCREENSHOTS_FORMAT',
+                        help="Image format of screenshots: png, jpeg or webp",
+                        type=str,
+                        choices=["png", "jpeg", "webp"],
+                        default="png"
+                        )
+    parser.add_argument('--screenshots-quality',
+                        dest='screenshots_quality',
+                        env_var='SCREENSHOTS_QUALITY',
+                        help="Quality of jpeg and webp screenshots",
+                        type=int,
+                        default=85
+                        )
+    parser.add_argument('--screenshots-keep',
+                        dest='screenshots_keep',
+                        env_var='SCREENSHOTS_KEEP',
+                        help="Number of screenshots to keep on disk",
+                        type=int,
+                        default=100
+                        )
+    parser.add_argument('--screenshots-workers',
+                        dest='screenshots_workers',
+                        env_var='SCREENSHOTS_WORKERS',
+                        help="Number of threads encoding and writing screenshots",
+                        type=int,
+                        default=2
+                        )
+    parser.add_argument('--screenshots-dedupe',
+                        dest='screenshots_dedupe',
+                        env_var='SCREENSHOTS_DEDUPE',
+                        help="Only keep screenshots that differ from the last one kept",
+                        type=bool,
+                        default=False
+                        )
+    parser.add_argument('--screenshots-diff-threshold',
+                        dest='screenshots_diff_threshold',
+                        env_var='SCREENSHOTS_DIFF_THRESHOLD',
+                        help="Mean gray value difference of a tile to count as changed",
+                        type=float,
+                        default=8
+                        )
+    parser.add_argument('--screenshots-freeze-alert',
+                        dest='screenshots_freeze_alert_s',
+                        env_var='SCREENSHOTS_FREEZE_ALERT',
+                        help="Warn when screenshots did not change for this many seconds",
+                        type=float,
+                        default=0
+                        )
+    parser.add_argument('--screenshots-grid',
+                        dest='screenshots_grid',
+                        env_var='SCREENSHOTS_GRID',
+                        help="Capture all tabs every cycle: composite tiles them into "
+                             "one image, tabs writes each to a directory of its own",
+                        type=str,
+                        choices=["", "composite", "tabs"],
+                        default="")
+    parser.add_argument('--screenshots-grid-columns',
+                        dest='screenshots_grid_columns',
+                        env_var='SCREENSHOTS_GRID_COLUMNS',
+                        help="Number of columns of the composite, 0 for a square grid",
+                        type=int,
+                        default=0)
+    parser.add_argument('--screenshots-files',
+                        dest='screenshots_files',
+                        env_var='SCREENSHOTS_FILES',
+                        help="Write screenshots to --screenshots-img-path, "
+                             "false to only stream them",
+                        type=option_bool,
+                        default=True)
+    parser.add_argument('--screenshots-mjpeg',
+                        dest='screenshots_mjpeg',
+                        env_var='SCREENSHOTS_MJPEG',
+                        help="Stream screenshots as MJPEG on host:port",
+                        type=str,
+                        default="")
+    parser.add_argument('--screenshots-video',
+                        dest='screenshots_video',
+                        env_var='SCREENSHOTS_VIDEO',
+                        help="Directory to write video segments of the screenshots to "
+                             "with ffmpeg",
+                        type=str,
+                        default="")
+    parser.add_argument('--screenshots-video-segment',
+                        dest='screenshots_video_segment_s',
+                        env_var='SCREENSHOTS_VIDEO_SEGMENT',
+                        help="Length of video segments in seconds",
+                        type=int,
+                        default=60)
+    parser.add_argument('--screenshots-video-fps',
+                        dest='screenshots_video_fps',
+                        env_var='SCREENSHOTS_VIDEO_FPS',
+                        help="Frame rate of video segments, "
+                             "defaults to the screenshot rate",
+                        type=float,
+                        default=0)
     parser.add_argument('--logfile',
                         dest='logfile',
                         env_var='LOGFILE',
@@ -504,17 +4696,150 @@ if __name__ == '__main__':
                         env_var='FIREFOX_BIN',
                         help='Path to firefox binary (bypasses Selenium Manager)',
                         type=str)
-    args = parser.parse_args()
+    parser.add_argument('--pool-size',
+                        dest='pool_size',
+                        env_var='POOL_SIZE',
+                        help="Number of pre-warmed browser sessions to keep",
+                        type=int,
+                        default=2)
+    parser.add_argument('--pool-max-uses',
+                        dest='pool_max_uses',
+                        env_var='POOL_MAX_USES',
+                        help="Recycle a pooled session after this many uses",
+                        type=int,
+                        default=50)
+    parser.add_argument('--pool-max-age',
+                        dest='pool_max_age_s',
+                        env_var='POOL_MAX_AGE',
+                        help="Recycle a pooled session after this many seconds",
+                        type=int,
+                        default=3600)
+    parser.add_argument('--pool-jobs-stdin',
+                        dest='pool_jobs_stdin',
+                        env_var='POOL_JOBS_STDIN',
+                        help="Keep running and read further jobs from stdin, "
+                             "one line of whitespace separated URLs per job, "
+                             "reusing pooled browser sessions",
+                        type=bool,
+                        default=False)
+    parser.add_argument('--batch-jobs',
+                        dest='batch_jobs',
+                        env_var='BATCH_JOBS',
+                        help="Log into every job of a JSON, YAML or CSV job file",
+                        type=str)
+    parser.add_argument('--batch-concurrency',
+                        dest='batch_concurrency',
+                        env_var='BATCH_CONCURRENCY',
+                        help="Number of browsers to run batch jobs on, "
+                             "defaults to the number of CPUs",
+                        type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument('--batch-retries',
+                        dest='batch_retries',
+                        env_var='BATCH_RETRIES',
+                        help="Number of times to retry a failed batch job",
+                        type=int,
+                        default=1)
+    parser.add_argument('--batch-results',
+                        dest='batch_results',
+                        env_var='BATCH_RESULTS',
+                        help="File to write batch job results to as JSON lines, "
+                             "defaults to stdout",
+                        type=str)
+    parser.add_argument('--queue',
+                        dest='queue',
+                        env_var='QUEUE',
+                        help="Shared job queue of the enqueue, worker and queue-status "
+                             "commands: redis://host:port/db, sqlite:///path or a path",
+                        type=str,
+                        default="")
+    parser.add_argument('--queue-lease',
+                        dest='queue_lease_s',
+                        env_var='QUEUE_LEASE',
+                        help="Seconds a leased job is reserved for its worker before "
+                             "it is handed to another one",
+                        type=int,
+                        default=300)
+    parser.add_argument('--queue-steal-after',
+                        dest='queue_steal_after_s',
+                        env_var='QUEUE_STEAL_AFTER',
+                        help="Seconds a job waits for the worker owning its target "
+                             "before any worker may take it",
+                        type=int,
+                        default=30)
+    parser.add_argument('--worker-name',
+                        dest='worker_name',
+                        env_var='WORKER_NAME',
+                        help="Name of this worker, defaults to host:pid",
+                        type=str,
+                        default="")
+    parser.add_argument('--worker-stats-interval',
+                        dest='worker_stats_interval_s',
+                        env_var='WORKER_STATS_INTERVAL',
+                        help="Seconds between reports of worker stats and queue depth",
+                        type=int,
+                        default=30)
+    parser.add_argument('--worker-exit-idle',
+                        dest='worker_exit_idle_s',
+                        env_var='WORKER_EXIT_IDLE',
+                        help="Stop the worker after being idle for this many seconds, "
+                             "0 to run until interrupted",
+                        type=int,
+                        default=0)
+    parser.add_argument('--session-cache',
+                        dest='session_cache',
+                        env_var='SESSION_CACHE',
+                        help="Directory to cache encrypted session state in, "
+                             "reused to skip repeated logins",
+                        type=str)
+    parser.add_argument('--session-cache-key',
+                        dest='session_cache_key',
+                        env_var='SESSION_CACHE_KEY',
+                        help="Fernet key to encrypt the session cache with, "
+                             "defaults to a key generated in the cache directory",
+                        type=str)
+    parser.add_argument('--session-cache-ttl',
+                        dest='session_cache_ttl_s',
+                        env_var='SESSION_CACHE_TTL',
+                        help="Time in seconds a cached session is reused for",
+                        type=int,
+                        default=3600)
+    parser.add_argument('--session-cache-size',
+                        dest='session_cache_size',
+                        env_var='SESSION_CACHE_SIZE',
+                        help="Maximum number of cached sessions",
+                        type=int,
+                        default=100)
+    parser.add_argument('--targets-file',
+                        dest='targets_files',
+                        env_var='TARGETS_FILE',
+                        help="JSON or YAML file with additional target definitions, "
+                             "can be specified multiple times",
+                        type=str,
+                        action='append')
+    parser.add_argument('--metrics-port',
+                        dest='metrics_port',
+                        env_var='METRICS_PORT',
+                        help="Serve Prometheus metrics on this local port, "
+                             "0 disables the exporter",
+                        type=int,
+                        default=0)
+    parser.add_argument('--trace-file',
+                        dest='trace_file',
+                        env_var='TRACE_FILE',
+                        help="Write the timing of every phase as JSON to this file on exit",
+                        type=str)
+    parser.add_argument('--daemon-listen',
+                        dest='daemon_listen',
+                        env_var='DAEMON_LISTEN',
+                        help="Address of the control API: host:port or unix:<path>",
+                        type=str,
+                        default="127.0.0.1:8150")
 
-    logfile = args.logfile
-    log_level = args.log_level
-    screenshots = args.screenshots
-    screenshots_img_path = args.screenshots_img_path
-    t_screenshots_interval_s = args.screenshots_pause
-    t_tab_switch_interval_s = args.browser_tab_switch_pause_s
+    return parser
 
-    browser_extensions = []
 
+def logging_setup(logfile, log_level):
     log_format = '[%(asctime)s] \
     {%(filename)s:%(lineno)d} %(levelname)s - %(message)s'
 
@@ -550,40 +4875,437 @@ if __name__ == '__main__':
     level = logging.getLevelName(log_level)
     logger.setLevel(level)
 
-    # Validate driver either by explicit path or PATH
+    return True
+
+
+# Problems finding geckodriver and firefox either by explicit path or PATH
+def browser_check(args):
+    problems = []
+
     geckopath = args.geckodriver_path or os.environ.get('GECKODRIVER')
     if geckopath:
         if not (os.path.isfile(geckopath) and os.access(geckopath, os.X_OK)):
-            logging.error('GECKODRIVER not executable at: ' + str(geckopath))
-            sys.exit(1)
+            problems.append('GECKODRIVER not executable at: ' + str(geckopath))
     else:
         if which('geckodriver') is None:
-            logging.error('Could not find geckodriver.\nYou can download it from: ' + url_releases_geckodriver)
-            sys.exit(1)
+            problems.append('Could not find geckodriver.\nYou can download it from: '
+                            + url_releases_geckodriver)
 
-    # Validate browser either by explicit path or PATH
     firefox_bin = args.firefox_binary or os.environ.get('FIREFOX_BIN')
     if firefox_bin:
         if not (os.path.isfile(firefox_bin) and os.access(firefox_bin, os.X_OK)):
-            logging.error('FIREFOX_BIN not executable at: ' + str(firefox_bin))
-            sys.exit(1)
+            problems.append('FIREFOX_BIN not executable at: ' + str(firefox_bin))
     else:
         if which('firefox') is None:
-            logging.error('Could not find firefox. Aborting..')
+            problems.append('Could not find firefox')
+
+    return problems
+
+
+# Check the configuration a command would run with, without starting a browser
+# Returns a list of errors
+def config_validate(args):
+    import importlib.util
+
+    errors = []
+
+    for path in args.targets_files or []:
+        try:
+            load_targets(path)
+        except (OSError, ValueError) as e:
+            errors.append("Failed to load targets: " + str(e))
+
+    try:
+        profile_preset(args.browser_profile, args.browser_prefs_files)
+    except (OSError, ValueError) as e:
+        errors.append("Failed to load prefs: " + str(e))
+
+    for ext in args.browser_extensions or []:
+        if not os.path.isfile(ext):
+            errors.append("Extension not found: " + ext)
+        elif args.profile_cache and extension_id(ext) is None:
+            logging.warning(ext + " has no add-on id and is installed per session")
+
+    html_login = {k: getattr(args, k) for k in job_fields
+                  if k.startswith("selector")}
+    jobs = []
+    if args.urls:
+        jobs.append(dict(html_login,
+                         target=args.target,
+                         url=args.urls[0],
+                         user=args.login_user))
+    if args.batch_jobs:
+        try:
+            jobs.extend(load_jobs(args.batch_jobs))
+        except (OSError, ValueError) as e:
+            errors.append("Failed to load jobs: " + str(e))
+
+    for job in jobs:
+        target = job.get("target") or "unknown"
+        if target not in targets:
+            errors.append("Unknown target: " + target)
+        elif job.get("user"):
+            try:
+                target_login_locators(target, job_normalize(dict(job)))
+            except ValueError as e:
+                errors.append(target + ": " + str(e))
+
+    if 0 < args.screenshots_pause_max < args.screenshots_pause:
+        errors.append("SCREENSHOTS_PAUSE_MAX is below SCREENSHOTS_PAUSE")
+
+    if (args.browser_ready != "auto"
+            and readiness_condition(args.browser_ready) is None):
+        errors.append("Invalid readiness condition: " + args.browser_ready)
+
+    modules = []
+    if args.screenshots_format != "png":
+        modules.append(("PIL", "SCREENSHOTS_FORMAT " + args.screenshots_format))
+    if args.screenshots_dedupe:
+        modules.append(("numpy", "SCREENSHOTS_DEDUPE"))
+    if args.session_cache:
+        modules.append(("cryptography", "SESSION_CACHE"))
+    for module, option in modules:
+        if importlib.util.find_spec(module) is None:
+            errors.append(option + " requires " + module)
+
+    return errors
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = parser_create()
+
+    # Benchmarks have options of their own, the ones shared with
+    # the browser options are handed on
+    helps = [a for a in argv if a in ("-h", "--help")]
+    args, rest = parser.parse_known_args([a for a in argv if a not in helps])
+    if args.command == "bench":
+        import webdriver_bench
+        for option, value in (("--geckodriver-path", args.geckodriver_path),
+                              ("--firefox-binary", args.firefox_binary)):
+            if value:
+                rest += [option, value]
+        return webdriver_bench.main(rest + helps)
+
+    args = parser.parse_args(argv)
+    command = args.command or command_default(args)
+
+    if command in ("login", "kiosk", "capture"):
+        if not args.urls and not args.batch_jobs:
+            parser.error("the following arguments are required: --url")
+
+    logfile = args.logfile
+    log_level = args.log_level
+    screenshots_img_path = args.screenshots_img_path
+    t_screenshots_interval_s = args.screenshots_pause
+    t_tab_switch_interval_s = args.browser_tab_switch_pause_s
+
+    browser_extensions = args.browser_extensions or []
+
+    logging_setup(logfile, log_level)
+
+    if command == "validate-config":
+        errors = config_validate(args)
+        for problem in browser_check(args):
+            logging.warning(problem)
+        for error in errors:
+            logging.error(error)
+        if errors:
+            sys.exit(1)
+        logging.info("Configuration is valid")
+        sys.exit(0)
+
+    # Queue commands but the worker don't start a browser
+    problems = []
+    if command not in ("enqueue", "queue-status"):
+        problems = browser_check(args)
+    for problem in problems:
+        logging.error(problem)
+    if problems:
+        sys.exit(1)
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.trace_file:
+        metrics.trace_enable()
+        atexit.register(metrics.trace_write, args.trace_file)
+
+    for path in args.targets_files or []:
+        try:
+            load_targets(path)
+        except (OSError, ValueError) as e:
+            logging.error("Failed to load targets: " + str(e))
+            sys.exit(1)
+
+    try:
+        profile_preset(args.browser_profile, args.browser_prefs_files)
+    except (OSError, ValueError) as e:
+        logging.error("Failed to load prefs: " + str(e))
+        sys.exit(1)
+
+    for ext in browser_extensions:
+        if not os.path.isfile(ext):
+            logging.error("Extension not found: " + ext)
+            sys.exit(1)
+
+    session_cache = None
+    if args.session_cache:
+        try:
+            session_cache = SessionCache(args.session_cache,
+                                         args.session_cache_key,
+                                         ttl_s=args.session_cache_ttl_s,
+                                         max_entries=args.session_cache_size)
+        except ImportError:
+            logging.error("The session cache requires cryptography")
+            sys.exit(1)
+
+    if command in ("enqueue", "worker", "queue-status"):
+        try:
+            job_queue = queue_open(args.queue)
+        except (OSError, ValueError) as e:
+            logging.error("Failed to open queue: " + str(e))
+            sys.exit(1)
+
+    if command == "enqueue":
+        if not args.batch_jobs:
+            logging.error("enqueue needs BATCH_JOBS")
+            sys.exit(1)
+        jobs = load_jobs(args.batch_jobs)
+        for job in jobs:
+            job.pop("id")
+            job_queue.put(job)
+        logging.info("Queued " + str(len(jobs)) + " jobs from " + args.batch_jobs)
+        sys.exit(0)
+
+    if command == "queue-status":
+        results = job_queue.results()
+        if args.batch_results:
+            with open(args.batch_results, 'a') as f:
+                for result in results:
+                    f.write(json.dumps(result) + "\n")
+        print(json.dumps({"depth":   job_queue.depth(),
+                          "workers": job_queue.workers(),
+                          "targets": results_aggregate(results)}, indent=1))
+        sys.exit(0)
+
+    if command == "worker":
+        import socket
+
+        os.makedirs(screenshots_img_path, exist_ok=True)
+        concurrency = max(1, args.pool_size)
+        pool = SessionPool(browser_options_from_args(args, log_level),
+                           browser_extensions,
+                           size=concurrency,
+                           max_uses=args.pool_max_uses,
+                           max_age_s=args.pool_max_age_s)
+        worker = Worker(job_queue, pool,
+                        args.worker_name or socket.gethostname() + ":" + str(os.getpid()),
+                        concurrency=concurrency,
+                        retries=args.batch_retries,
+                        session_cache=session_cache,
+                        engine=args.login_engine,
+                        img_path=screenshots_img_path,
+                        img_format=args.screenshots_format,
+                        quality=args.screenshots_quality,
+                        lease_s=args.queue_lease_s,
+                        steal_after_s=args.queue_steal_after_s,
+                        stats_interval_s=args.worker_stats_interval_s,
+                        exit_idle_s=args.worker_exit_idle_s)
+        worker.run()
+        pool.close()
+        sys.exit(0)
+
+    if command == "daemon":
+        pool = SessionPool(browser_options_from_args(args, log_level),
+                           browser_extensions,
+                           size=max(1, args.pool_size),
+                           max_uses=args.pool_max_uses,
+                           max_age_s=args.pool_max_age_s)
+        daemon = Daemon(pool, session_cache)
+        server = daemon.server(args.daemon_listen)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        daemon.close()
+        pool.close()
+        sys.exit(0)
+
+    if args.batch_jobs:
+        jobs = load_jobs(args.batch_jobs)
+        concurrency = max(1, min(args.batch_concurrency, len(jobs)))
+        # Only warm browsers for jobs the http engine can't do alone,
+        # the others start theirs when the HTTP login needs a browser
+        n_browser = sum(1 for job in jobs
+                        if job.get("url_payload")
+                        or login_engine(job.get("target"), args.login_engine) != "http")
+        pool = SessionPool(browser_options_from_args(args, log_level),
+                           browser_extensions,
+                           size=concurrency,
+                           max_uses=args.pool_max_uses,
+                           max_age_s=args.pool_max_age_s,
+                           prewarm=n_browser)
+        if args.batch_results:
+            results = open(args.batch_results, 'a')
+        else:
+            results = sys.stdout
+        results_lock = threading.Lock()
+
+        def write_result(result):
+            with results_lock:
+                results.write(json.dumps(result) + "\n")
+                results.flush()
+
+        ok = run_batch(jobs, pool, concurrency, args.batch_retries,
+                       write_result, session_cache, args.login_engine)
+        pool.close()
+        sys.exit(0 if ok else 1)
+
+    if args.pool_jobs_stdin:
+        pool = SessionPool(browser_options_from_args(args, log_level),
+                           browser_extensions,
+                           size=max(1, args.pool_size),
+                           max_uses=args.pool_max_uses,
+                           max_age_s=args.pool_max_age_s)
+        jobs = [args.urls]
+        jobs = itertools.chain(jobs, (line.split() for line in sys.stdin))
+        run_pooled_jobs(args, log_level, browser_extensions, pool, jobs,
+                        session_cache)
+        pool.close()
+        sys.exit(0)
+
+    # Adapt the pause between screenshots up to SCREENSHOTS_PAUSE_MAX
+    schedule = None
+    if command == "capture" and args.screenshots_pause_max > 0:
+        try:
+            schedule = AdaptiveSchedule(t_screenshots_interval_s,
+                                        args.screenshots_pause_max)
+        except ValueError as e:
+            logging.error(str(e) + ": SCREENSHOTS_PAUSE_MAX below SCREENSHOTS_PAUSE")
+            sys.exit(1)
+
+    # A pipeline writing to img_path with the frame options, tab k of
+    # the tabs grid streams on the MJPEG port + k and records to a
+    # tab_NN directory of its own
+    def pipeline_create(img_path, k=None):
+        diff = None
+        if args.screenshots_dedupe:
+            diff = FrameDiff(threshold=args.screenshots_diff_threshold)
+        sinks = []
+        if args.screenshots_mjpeg:
+            listen = args.screenshots_mjpeg
+            if k:
+                host, _, port = listen.rpartition(":")
+                listen = host + ":" + str(int(port) + k)
+            sinks.append(MjpegStream(listen, quality=args.screenshots_quality))
+        if args.screenshots_video:
+            fps = args.screenshots_video_fps
+            if not fps:
+                fps = 1 / t_screenshots_interval_s if t_screenshots_interval_s > 0 else 10
+            path = args.screenshots_video
+            if k is not None:
+                path = os.path.join(path, "tab_" + str(k).zfill(2))
+            sinks.append(SegmentWriter(path,
+                                       fps,
+                                       segment_s=args.screenshots_video_segment_s,
+                                       ffmpeg=ffmpeg))
+
+        return ScreenshotPipeline(img_path,
+                                  img_format=args.screenshots_format,
+                                  quality=args.screenshots_quality,
+                                  ring_size=args.screenshots_keep,
+                                  workers=args.screenshots_workers,
+                                  diff=diff,
+                                  freeze_s=args.screenshots_freeze_alert_s,
+                                  sinks=sinks,
+                                  files=args.screenshots_files)
+
+    # Fail before starting the browser if an encoder is missing
+    if command == "capture":
+        ffmpeg = None
+        if args.screenshots_video:
+            ffmpeg = which("ffmpeg")
+            if ffmpeg is None:
+                logging.error("Could not find ffmpeg for SCREENSHOTS_VIDEO")
+                sys.exit(1)
+        try:
+            # Composites and telling activity by frames need both
+            if (args.screenshots_grid == "composite"
+                    or (schedule is not None and args.screenshots_activity == "frames")):
+                import numpy  # noqa: F401
+                import PIL  # noqa: F401
+            if args.screenshots_grid == "tabs":
+                screenshots_img_path = os.path.join(screenshots_img_path, "tab_00")
+                pipeline = pipeline_create(screenshots_img_path, 0)
+            else:
+                pipeline = pipeline_create(screenshots_img_path)
+        except ImportError as e:
+            logging.error("Screenshot options require " + e.name)
+            sys.exit(1)
+        except OSError as e:
+            logging.error("Failed to set up screenshot output: " + str(e))
             sys.exit(1)
 
     b = Browser(args,
                 log_level,
-                path_logout,
+                targets,
                 browser_extensions,
-                url_releases_geckodriver)
+                url_releases_geckodriver,
+                session_cache=session_cache)
 
-    if screenshots:
-        b.screenshot(screenshots_img_path, t_screenshots_interval_s)
+    if command == "login":
+        if not b.browser_options['close']:
+            b.release()
+        sys.exit(0 if b.logged_in is not False else 1)
+    elif command == "capture" and args.screenshots_grid == "tabs":
+        # A pipeline per tab, writing to a directory of its own
+        try:
+            pipelines = [pipeline] + [
+                pipeline_create(os.path.join(os.path.dirname(screenshots_img_path),
+                                             "tab_" + str(k).zfill(2)), k)
+                for k in range(1, len(b.browser.window_handles))]
+        except OSError as e:
+            logging.error("Failed to set up screenshot output: " + str(e))
+            sys.exit(1)
+        GridCapture(b.browser, t_screenshots_interval_s, "tabs", pipelines,
+                    schedule=schedule, activity=args.screenshots_activity,
+                    diff_threshold=args.screenshots_diff_threshold).run()
+    elif command == "capture" and args.screenshots_grid == "composite":
+        GridCapture(b.browser, t_screenshots_interval_s, "composite", [pipeline],
+                    columns=args.screenshots_grid_columns,
+                    schedule=schedule, activity=args.screenshots_activity,
+                    diff_threshold=args.screenshots_diff_threshold).run()
+    elif command == "capture":
+        b.screenshot(screenshots_img_path, t_screenshots_interval_s, pipeline,
+                     schedule=schedule, activity=args.screenshots_activity,
+                     diff_threshold=args.screenshots_diff_threshold)
     else:
-        while True:
-            if len(b.browser.window_handles) > 1:
-                current_window = b.browser.current_window_handle
-                b.switch_tab(current_window)
-                time.sleep(t_tab_switch_interval_s)
+        rotation = TabRotation(b.browser,
+                               dwell_s=t_tab_switch_interval_s,
+                               refresh_ahead_s=args.browser_tab_refresh_ahead_s,
+                               dwell_max_s=args.browser_tab_switch_pause_max_s,
+                               refresh_adaptive=args.browser_tab_refresh_adaptive)
+        dwell = args.browser_tab_dwell_s or []
+        weight = args.browser_tab_weight or []
+        for k, handle in enumerate(b.browser.window_handles):
+            rotation.adopt(handle,
+                           b.urls[k] if k < len(b.urls) else "",
+                           dwell_s=dwell[k] if k < len(dwell) else None,
+                           weight=weight[k] if k < len(weight) else 1,
+                           refresh=args.browser_tab_refresh_ahead_s > 0)
+        if (args.watchdog_reload_mb or args.watchdog_restart_mb
+                or args.watchdog_heap_mb or args.watchdog_log):
+            rotation.watchdog = MemoryWatchdog(b,
+                                               interval_s=args.watchdog_interval_s,
+                                               reload_mb=args.watchdog_reload_mb,
+                                               restart_mb=args.watchdog_restart_mb,
+                                               heap_mb=args.watchdog_heap_mb,
+                                               log_path=args.watchdog_log)
+        rotation.run()
 
+
+if __name__ == '__main__':
+    main()